@@ -1,8 +1,13 @@
 from bs4 import BeautifulSoup
 from pathlib import Path
 import base64
+import os
+import json
+import re
+from enum import Enum
 import requests
 import sys
+import threading
 import argparse
 from distutils.util import strtobool
 import logging
@@ -12,6 +17,16 @@ logger = logging.getLogger(__name__)
 
 #root_path="/workspaces/microbe_masst" 
 
+# shared asset bundle next to the HTML shims of the shared output mode
+SHARED_ASSETS_JS = "masst_viewer.js"
+SHARED_ASSETS_CSS = "masst_viewer.css"
+
+
+class HtmlOutput(Enum):
+    single = "single"  # self-contained HTML file with all libraries and data
+    shared = "shared"  # small HTML shims with the data that load one shared asset bundle per output directory
+    none = "none"  # no HTML and JSON trees, e.g., when all spectra are viewed from the results store
+
 def replace_by_local_file(path):
     """
     Replaces web ressources by local files if possible
@@ -31,6 +46,17 @@ def replace_by_local_file(path):
     return path
 
 
+def read_data(data):
+    """
+    :param data: data might be passed as file or other data structure like json
+    :return: the file content or the data itself
+    """
+    try:
+        return Path(data).read_text()
+    except:
+        return data
+
+
 def replace_data_in_file(data_json_file, text, placeholder_str):
     """
 
@@ -39,31 +65,113 @@ def replace_data_in_file(data_json_file, text, placeholder_str):
     :param placeholder_str: the placeholder string to replace
     :return: the final text
     """
-    try:
-        tree_data = Path(data_json_file).read_text()
-    except:
-        tree_data = data_json_file
-        pass
-    text = text.replace(placeholder_str, tree_data, 1)
+    text = text.replace(placeholder_str, read_data(data_json_file), 1)
 
     return text
 
 
-def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
+class CompiledTemplate:
     """
-    Creates a single distributable HTML file.
-    Reads the input_html and internalizes all CSS, JS, and data files into the output html. For web ressources: First
-    try to load a local file, else try to download file.
-    :param replace_dict: dict of key (placeholder string in HTML) and the value to insert either from a file or as a
-    string
-    :param input_html: the input html file that defines all dependencies
-    :param output_html: the bundled HTML file
-    :param data_json_file: data as a file or as json (or dictionary / array)
-    :param placeholder_str: the placeholder is replaced with the data
-    :return: None
+    Bundled and minified HTML split at the placeholders. Writing an output only interleaves the static segments
+    with the data, the libraries are not parsed or minified again.
+    """
+
+    def __init__(self, segments, placeholders, quotes):
+        """
+        :param segments: static text before, between, and after the placeholders (one more than placeholders)
+        :param placeholders: the placeholders in the order of their position
+        :param quotes: the quote character if the placeholder is inside a JS string literal, else None
+        """
+        self.segments = segments
+        self.placeholders = placeholders
+        self.quotes = quotes
+
+    def write(self, output_html, replace_dict):
+        with open(output_html, "w", encoding="utf-8") as outfile:
+            outfile.write(self.segments[0])
+            for placeholder, quote, segment in zip(
+                self.placeholders, self.quotes, self.segments[1:]
+            ):
+                replace_data = replace_dict.get(placeholder)
+                data = "" if replace_data is None else read_data(replace_data)
+                if quote is not None:
+                    data = escape_js_string(data, quote)
+                outfile.write(data)
+                outfile.write(segment)
+
+
+# compiled templates by input html, compression, and placeholders
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_compiled_template(input_html, placeholders, compress=False):
+    """
+    The template is compiled once per process and shared by all outputs
+    :return: CompiledTemplate or None if the placeholders did not survive minification
+    """
+    key = (str(input_html), tuple(sorted(placeholders)), compress)
+    with _templates_lock:
+        if key not in _templates:
+            _templates[key] = compile_template(input_html, placeholders, compress)
+        return _templates[key]
+
+
+def compile_template(input_html, placeholders, compress=False):
+    """
+    Bundles and minifies the input html with the placeholders in place and splits it at the first occurrence of each
+    placeholder
+    :return: CompiledTemplate or None if the placeholders did not survive minification
+    """
+    bundled_text = bundle_html(input_html)
+    text = compress_html(bundled_text) if compress else bundled_text
+    positions = []
+    for placeholder in placeholders:
+        if text.count(placeholder) != bundled_text.count(placeholder):
+            logger.warning(
+                "Placeholder %s changed during minification, bundling each output separately",
+                placeholder,
+            )
+            return None
+        position = text.find(placeholder)
+        if position >= 0:
+            positions.append((position, placeholder))
+
+    segments = []
+    quotes = []
+    start = 0
+    for position, placeholder in sorted(positions):
+        if position < start:
+            logger.warning("Placeholders %s overlap, bundling each output separately", placeholder)
+            return None
+        segments.append(text[start:position])
+        end = position + len(placeholder)
+        before = text[position - 1 : position]
+        # minification might change the quotes of string literals
+        in_string = before != "" and before in "'\"`" and before == text[end : end + 1]
+        quotes.append(before if in_string else None)
+        start = end
+    segments.append(text[start:])
+    return CompiledTemplate(segments, [placeholder for _, placeholder in sorted(positions)], quotes)
+
+
+def escape_js_string(text, quote):
+    """
+    Escapes text for a JS string literal in quote characters
+    """
+    text = text.replace("\\", "\\\\").replace(quote, "\\" + quote)
+    text = text.replace("\n", "\\n").replace("\r", "\\r")
+    if quote == "`":
+        text = text.replace("${", "\\${")
+    return text
+
+
+def bundle_html(input_html):
+    """
+    Reads the input_html and internalizes all CSS, JS, and image files. For web ressources: First try to load a local
+    file, else try to download file.
+    :return: the bundled html text
     """
-    if replace_dict is None:
-        replace_dict = {}
     original_html_text = Path(input_html).read_text(encoding="utf-8")
     soup = BeautifulSoup(original_html_text, "html.parser")
 
@@ -113,7 +221,42 @@ def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
                 base64_file_content.decode("ascii")
             )
 
-    out_text = str(soup)
+    return str(soup)
+
+
+def compress_html(text):
+    try:
+        import minify_html
+
+        return minify_html.minify(text, minify_js=True, minify_css=True)
+
+    except Exception as e:
+        logger.warning("Error during output compression.")
+        logger.exception(e)
+    return text
+
+
+def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
+    """
+    Creates a single distributable HTML file.
+    Reads the input_html and internalizes all CSS, JS, and data files into the output html. For web ressources: First
+    try to load a local file, else try to download file. The bundled and minified input_html is compiled once per
+    process, see get_compiled_template.
+    :param replace_dict: dict of key (placeholder string in HTML) and the value to insert either from a file or as a
+    string
+    :param input_html: the input html file that defines all dependencies
+    :param output_html: the bundled HTML file
+    :param compress: minify the HTML, CSS, and JS (needs minify_html)
+    :return: True
+    """
+    if replace_dict is None:
+        replace_dict = {}
+    template = get_compiled_template(input_html, replace_dict.keys(), compress)
+    if template is not None:
+        template.write(output_html, replace_dict)
+        return True
+
+    out_text = bundle_html(input_html)
 
     # try to replace data with PLACEHOLDER_JSON_DATA
     for placeholder, replace_data in replace_dict.items():
@@ -123,14 +266,7 @@ def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
             out_text = replace_data_in_file("", out_text, placeholder)
 
     if compress:
-        try:
-            import minify_html
-
-            out_text = minify_html.minify(out_text, minify_js=True, minify_css=True)
-
-        except Exception as e:
-            logger.warning("Error during output compression.")
-            logger.exception(e)
+        out_text = compress_html(out_text)
 
     # Save onefile
 
@@ -140,6 +276,228 @@ def build_dist_html(input_html, output_html, replace_dict=None, compress=False):
     return True
 
 
+class SharedTemplate:
+    """
+    HTML markup of the shared output mode. The CSS and JS are written once per output directory and read the
+    per-output data from the MASST_DATA object in the HTML shim.
+    """
+
+    def __init__(self, html_start, html_end, css, js, string_placeholders):
+        """
+        :param html_start: markup before the data script
+        :param html_end: markup after the data script that loads the shared JS
+        :param string_placeholders: placeholders that were inside JS string literals, all others are JS expressions
+        """
+        self.html_start = html_start
+        self.html_end = html_end
+        self.css = css
+        self.js = js
+        self.string_placeholders = string_placeholders
+
+    def write_assets(self, out_dir):
+        # worker processes of the same run write the same assets, readers never see a partial file
+        for file, text in ((SHARED_ASSETS_CSS, self.css), (SHARED_ASSETS_JS, self.js)):
+            tmp_file = Path(out_dir, ".{}.{}".format(file, os.getpid()))
+            tmp_file.write_text(text, encoding="utf-8")
+            os.replace(tmp_file, Path(out_dir, file))
+
+    def write(self, output_html, replace_dict):
+        data = []
+        for placeholder, replace_data in replace_dict.items():
+            value = "" if replace_data is None else read_data(replace_data)
+            if placeholder in self.string_placeholders:
+                value = json.dumps(value)
+            elif not value:
+                value = "null"
+            data.append("{}:{}".format(json.dumps(placeholder), value))
+        # the data must not close the script element
+        data_script = "var MASST_DATA={{{}}};".format(",".join(data)).replace("</", "<\\/")
+        with open(output_html, "w", encoding="utf-8") as outfile:
+            outfile.write(self.html_start)
+            outfile.write("<script>")
+            outfile.write(data_script)
+            outfile.write("</script>")
+            outfile.write(self.html_end)
+
+
+def build_output_html(
+    input_html, output_html, replace_dict=None, compress=False, html_output=HtmlOutput.single
+):
+    """
+    :param html_output: single for a self-contained HTML file, shared for an HTML shim and shared assets
+    :return: True
+    """
+    if HtmlOutput(html_output) == HtmlOutput.shared:
+        return build_shared_html(input_html, output_html, replace_dict)
+    return build_dist_html(input_html, output_html, replace_dict, compress)
+
+
+# shared templates by input html and placeholders, asset directories that were written in this process
+_shared_templates = {}
+_shared_asset_dirs = set()
+
+
+def build_shared_html(input_html, output_html, replace_dict=None):
+    """
+    Creates a small HTML file with the data that loads the shared CSS and JS from the same directory. The shared
+    assets are written once per process and output directory.
+    :param replace_dict: dict of key (placeholder string in HTML) and the value to insert either from a file or as a
+    string
+    :return: True
+    """
+    if replace_dict is None:
+        replace_dict = {}
+    template = get_shared_template(input_html, replace_dict.keys(), Path(output_html).parent)
+    template.write(output_html, replace_dict)
+    return True
+
+
+def get_shared_template(input_html, placeholders, out_dir) -> SharedTemplate:
+    """
+    The template is compiled once per process and its assets are written once per output directory
+    :param out_dir: directory of the shared assets
+    """
+    key = (str(input_html), tuple(sorted(placeholders)))
+    out_dir = Path(out_dir).resolve()
+    with _templates_lock:
+        template = _shared_templates.get(key)
+        if template is None:
+            template = compile_shared_template(input_html, placeholders)
+            _shared_templates[key] = template
+        if (key, out_dir) not in _shared_asset_dirs:
+            template.write_assets(out_dir)
+            _shared_asset_dirs.add((key, out_dir))
+    return template
+
+
+def compile_shared_template(input_html, placeholders) -> SharedTemplate:
+    """
+    Moves all CSS and JS of the input html into the shared assets. Placeholders in the JS are replaced by
+    MASST_DATA properties.
+    """
+    original_html_text = Path(input_html).read_text(encoding="utf-8")
+    soup = BeautifulSoup(original_html_text, "html.parser")
+
+    css = []
+    for tag in soup.find_all("link", href=True):
+        css.append(Path(replace_by_local_file(tag["href"])).read_text(encoding="utf-8"))
+        tag.extract()
+
+    js = []
+    for tag in soup.find_all("script", src=True):
+        path = replace_by_local_file(tag["src"])
+        if path.startswith("http"):
+            response = requests.get(path)
+            response.raise_for_status()
+            js.append(response.text)
+        else:
+            js.append(Path(path).read_text())
+        tag.extract()
+    js = "\n;\n".join(js)
+
+    # one pass, the references contain the placeholders
+    string_placeholders = set()
+    pattern = re.compile(
+        r"""(['"`]?)({})(['"`]?)""".format(
+            "|".join(re.escape(p) for p in sorted(placeholders, key=len, reverse=True))
+        )
+    )
+
+    def data_reference(match):
+        quote, placeholder, end_quote = match.groups()
+        reference = "MASST_DATA[{}]".format(json.dumps(placeholder))
+        if quote and quote == end_quote:
+            string_placeholders.add(placeholder)
+            return reference
+        return quote + reference + end_quote
+
+    if placeholders:
+        js = pattern.sub(data_reference, js)
+
+    # images are small and stay inline
+    for tag in soup.find_all("img", src=True):
+        file_content = Path(tag["src"]).read_bytes()
+        base64_file_content = base64.b64encode(file_content)
+        tag["src"] = "data:image/png;base64, {}".format(
+            base64_file_content.decode("ascii")
+        )
+
+    stylesheet = soup.new_tag("link", rel="stylesheet", type="text/css", href=SHARED_ASSETS_CSS)
+    soup.html.head.append(stylesheet)
+    html_text = str(soup)
+    # data and scripts go to the end of the document so that all elements exist when the viewer starts
+    end = html_text.rindex("</html>")
+    html_end = '<script src="{}"></script>\n'.format(SHARED_ASSETS_JS) + html_text[end:]
+    return SharedTemplate(html_text[:end], html_end, "\n".join(css), js, string_placeholders)
+
+
+def write_shared_index(out_filename_no_ext):
+    """
+    Writes {out_filename_no_ext}_index.html that lists all HTML files of this output prefix and loads them on demand
+    :return: the index file
+    """
+    out_prefix = Path(out_filename_no_ext)
+    index_file = Path("{}_index.html".format(out_filename_no_ext))
+    files = sorted(
+        file.name
+        for file in out_prefix.parent.glob("{}_*.html".format(out_prefix.name))
+        if file != index_file
+    )
+    files_json = json.dumps(files).replace("</", "<\\/")
+    index_file.write_text(
+        INDEX_HTML.replace("INDEX_TITLE_PLACEHOLDER", out_prefix.name).replace(
+            "INDEX_FILES_PLACEHOLDER", files_json
+        ),
+        encoding="utf-8",
+    )
+    logger.info("Wrote index of %d HTML files to %s", len(files), index_file)
+    return index_file
+
+
+INDEX_HTML = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>INDEX_TITLE_PLACEHOLDER</title>
+<style>
+body { margin: 0; display: flex; height: 100vh; font-family: sans-serif; }
+#list { width: 22em; overflow: auto; border-right: 1px solid #ccc; }
+#list input { width: 95%; margin: 4px; }
+#list a { display: block; padding: 2px 6px; cursor: pointer; white-space: nowrap; }
+#list a.selected { background: #e8f4fa; }
+#viewer { flex: 1; border: none; }
+</style>
+</head>
+<body>
+<div id="list"><input id="filter" placeholder="Filter" type="text"/></div>
+<iframe id="viewer" name="viewer"></iframe>
+<script>
+var files = INDEX_FILES_PLACEHOLDER;
+var list = document.getElementById("list");
+var links = files.map(function (file) {
+    var link = document.createElement("a");
+    link.textContent = file.replace(/\\.html$/, "");
+    link.onclick = function () {
+        links.forEach(function (other) { other.className = ""; });
+        link.className = "selected";
+        // trees are only loaded when selected
+        document.getElementById("viewer").src = encodeURIComponent(file);
+    };
+    list.appendChild(link);
+    return link;
+});
+document.getElementById("filter").oninput = function () {
+    var text = this.value.toLowerCase();
+    links.forEach(function (link) {
+        link.style.display = link.textContent.toLowerCase().indexOf(text) >= 0 ? "" : "none";
+    });
+};
+</script>
+</body>
+</html>
+"""
+
+
 if __name__ == "__main__":
     # parsing the arguments (all optional)
     parser = argparse.ArgumentParser(
@@ -724,7 +724,7 @@ function update(source) {
                 .style("opacity", .9);
             tooltipDiv.html(
                 // show mouse over tooltip. Just for the fun count the clicks in the click method
-                "Name: " + d.name
+                (d.stub ? "Collapsed unmatched nodes: " + d.collapsed_nodes : "Name: " + d.name)
                 + (d.NCBI != null ? "<br/>NCBI: " + d.NCBI : "")
                 + (d.Rank != null ? "<br/>Rank: " + d.Rank : "")
                 + (d.Interventions != null ? "<br/>Interventions: " + d.Interventions : "")
@@ -846,6 +846,10 @@ function update(source) {
             return calcRadius(d);
         })
         .style("stroke", nodeStrokeColor)
+        // stubs of pruned unmatched nodes have a dashed outline
+        .style("stroke-dasharray", function (d) {
+            return d.stub ? "2,2" : null;
+        })
         .style("fill", function (d) {
             // set fill color depending on matches and children
             var matches = d.matched_size
@@ -1015,6 +1019,8 @@ function getAllChildren(parent) {
 // sort the tree according to the node names
 function sortTree() {
     tree.sort(function (a, b) {
+        // stubs of pruned unmatched nodes go last
+        if (a.stub || b.stub) return (a.stub ? 1 : 0) - (b.stub ? 1 : 0);
         return b.name.toLowerCase() < a.name.toLowerCase() ? 1 : -1;
     });
 }
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+import logging
+from email.utils import parsedate_to_datetime
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# server side overload - back off and shrink the number of requests in flight
+OVERLOAD_STATUS_CODES = [429, 502, 503, 504]
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD (additive increase, multiplicative decrease) limit on the number of fastMASST requests in flight.
+    Every successful request grows the limit by increase/limit, so the limit grows by about `increase` per round of
+    requests. Errors, timeouts, 429 responses, and latencies far above the observed baseline shrink the limit by
+    decrease_factor, at most once per round trip so that a burst of failures of requests that were already in flight
+    counts as one congestion signal. Retry-After headers pause all new requests.
+    """
+
+    def __init__(
+        self,
+        initial=10,
+        minimum=1,
+        maximum=100,
+        increase=1.0,
+        decrease_factor=0.5,
+        latency_tolerance=3.0,
+    ):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency_ewma = None
+        self.latency_baseline = None
+        self._start_time = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # (seconds since start, limit)
+        self.history = [(0.0, int(self.limit))]
+
+    def acquire(self) -> float:
+        """
+        Blocks until a request slot is free.
+        :return: start time that needs to be passed to release
+        """
+        with self._condition:
+            while True:
+                wait = self._wait_time()
+                if wait <= 0:
+                    break
+                self._condition.wait(timeout=wait)
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def acquire_async(self) -> float:
+        """
+        Waits without blocking the event loop until a request slot is free.
+        :return: start time that needs to be passed to release
+        """
+        while True:
+            with self._condition:
+                wait = self._wait_time()
+                if wait <= 0:
+                    self.in_flight += 1
+                    return time.monotonic()
+            await asyncio.sleep(wait)
+
+    def release(
+        self,
+        start: float,
+        error: Exception = None,
+        status: int = None,
+        retry_after=None,
+    ):
+        """
+        Frees a request slot and adapts the limit.
+        :param start: start time from acquire
+        :param error: the exception if the request failed
+        :param status: HTTP status code of a failed request
+        :param retry_after: seconds to pause all requests, e.g., from the Retry-After header
+        """
+        now = time.monotonic()
+        latency = now - start
+        with self._condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if retry_after is not None and retry_after > 0:
+                self._paused_until = max(self._paused_until, now + retry_after)
+                logger.info("fastMASST asked to retry after %.1f s", retry_after)
+
+            if error is not None or (
+                status is not None and status in OVERLOAD_STATUS_CODES
+            ):
+                self.errors += 1
+                self._decrease(now)
+            else:
+                self._update_latency(latency)
+                if self.latency_ewma > self.latency_baseline * self.latency_tolerance:
+                    self._decrease(now)
+                else:
+                    self._set_limit(self.limit + self.increase / self.limit, now)
+            self._condition.notify_all()
+
+    def report(self) -> str:
+        """
+        :return: summary of the concurrency limit over time
+        """
+        steps = ", ".join("{:.0f}s:{}".format(t, limit) for t, limit in self.history)
+        return "Adaptive concurrency: {} requests, {} errors, final limit {}; limit over time {}".format(
+            self.requests, self.errors, int(self.limit), steps
+        )
+
+    def export_history(self, out_file):
+        with open(out_file, "w") as file:
+            file.write("seconds\tconcurrency\n")
+            for t, limit in self.history:
+                file.write("{:.3f}\t{}\n".format(t, limit))
+
+    def _wait_time(self) -> float:
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            return pause
+        if self.in_flight >= int(self.limit):
+            return 0.05
+        return 0
+
+    def _update_latency(self, latency):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+            self.latency_baseline = latency
+            return
+        self.latency_ewma = 0.9 * self.latency_ewma + 0.1 * latency
+        # baseline follows improvements immediately and drifts slowly upwards
+        self.latency_baseline = min(self.latency_ewma, self.latency_baseline * 1.001)
+
+    def _decrease(self, now):
+        # at least one second between decreases
+        round_trip = max(self.latency_ewma or 0.0, 1.0)
+        if now - self._last_decrease < round_trip:
+            return
+        self._last_decrease = now
+        self._set_limit(self.limit * self.decrease_factor, now)
+
+    def _set_limit(self, limit, now):
+        old = int(self.limit)
+        self.limit = float(min(max(limit, self.minimum), self.maximum))
+        if int(self.limit) != old:
+            self.history.append((now - self._start_time, int(self.limit)))
+            logger.debug("fastMASST concurrency limit %d -> %d", old, int(self.limit))
+
+
+def retry_after_seconds(headers) -> float | None:
+    """
+    :param headers: response headers
+    :return: the Retry-After header in seconds or None
+    """
+    if headers is None:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
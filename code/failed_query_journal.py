@@ -0,0 +1,84 @@
+import os
+import json
+import threading
+import logging
+from datetime import datetime
+from pathlib import Path
+
+import masst_utils
+from utils import prepare_paths
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class FailedQueryJournal:
+    """
+    JSONL journal of queries that failed permanently (after all retries). Each line holds the query type (usi or
+    spectrum), the compound name, the inputs to replay the query, the error class (transient or permanent) and the
+    error message. Failures are written to {journal_file}.tmp, which replaces the journal of the previous run on
+    close. An interrupted run keeps the previous journal, e.g., the queries that a retry did not replay yet.
+    """
+
+    def __init__(self, journal_file):
+        self.journal_file = str(journal_file)
+        self.tmp_file = "{}.tmp".format(self.journal_file)
+        self.failed = 0
+        self.error_classes = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, query_type, compound_name, inputs: dict, error: Exception):
+        error_class = masst_utils.error_class(error)
+        entry = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "query_type": query_type,
+            "compound_name": compound_name,
+            "inputs": inputs,
+            "error_class": error_class,
+            "error": "{}: {}".format(type(error).__name__, error),
+        }
+        line = json.dumps(entry)
+        with self._lock:
+            if self._file is None:
+                prepare_paths(file=self.tmp_file)
+                self._file = open(self.tmp_file, "w", encoding="utf-8")
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.failed += 1
+            self.error_classes[error_class] = self.error_classes.get(error_class, 0) + 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                os.replace(self.tmp_file, self.journal_file)
+            elif self.failed == 0:
+                # all queries of this run succeeded
+                Path(self.journal_file).unlink(missing_ok=True)
+        if self.failed > 0:
+            logger.info(
+                "%d failed queries %s written to %s",
+                self.failed,
+                self.error_classes,
+                self.journal_file,
+            )
+
+
+def read_journal(journal_file) -> list[dict]:
+    """
+    :return: the latest journal entry per compound name
+    """
+    entries = {}
+    with open(journal_file, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                entries[entry["compound_name"]] = entry
+    return list(entries.values())
+
+
+def default_journal_file(out_filename_no_ext):
+    return "{}_failed_queries.jsonl".format(out_filename_no_ext)
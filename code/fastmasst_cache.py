@@ -0,0 +1,235 @@
+import sqlite3
+import threading
+import hashlib
+import json
+import time
+import zlib
+import logging
+from enum import Enum
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# parameters that only change the results when analog search is active
+ANALOG_PARAMS = ["delta_mass_below", "delta_mass_above"]
+
+
+class CacheMode(Enum):
+    off = "off"  # no caching
+    on = "on"  # read cached responses and store new ones
+    refresh = "refresh"  # bypass cached responses but store new ones
+    prune = "prune"  # only remove expired and least recently used entries
+
+
+class FastMasstCache:
+    """
+    Persistent cache of fastMASST responses in a local SQLite file. Responses are stored zlib compressed and keyed by
+    the canonical request (see cache_key). Entries expire after ttl_days and the least recently used entries are
+    evicted once the cache grows above max_size_mb.
+    """
+
+    def __init__(
+        self, cache_file="fastmasst_cache.sqlite", ttl_days=7.0, max_size_mb=2048.0
+    ):
+        self.cache_file = str(cache_file)
+        self.ttl_seconds = float(ttl_days) * 24 * 3600
+        self.max_size_bytes = int(float(max_size_mb) * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.cache_file, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, created REAL, last_access REAL, size INTEGER, data BLOB)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+        self._size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key) -> bytes | None:
+        """
+        :param key: the canonical request key
+        :return: the raw response content or None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT created, data FROM responses WHERE key=?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            created, data = row
+            if now - created > self.ttl_seconds:
+                self._delete(key)
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE responses SET last_access=? WHERE key=?", (now, key)
+            )
+            self.hits += 1
+        return zlib.decompress(data)
+
+    def put(self, key, content: bytes):
+        """
+        :param key: the canonical request key
+        :param content: the raw response content
+        """
+        data = zlib.compress(content, 6)
+        now = time.time()
+        with self._lock:
+            self._delete(key)
+            self._connection.execute(
+                "INSERT INTO responses (key, created, last_access, size, data) VALUES (?, ?, ?, ?, ?)",
+                (key, now, now, len(data), data),
+            )
+            self._size += len(data)
+            if self._size > self.max_size_bytes:
+                self._evict_lru()
+
+    def prune(self):
+        """
+        Removes all expired entries and evicts least recently used entries above the size limit
+        :return: number of removed entries
+        """
+        with self._lock:
+            removed = self._connection.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (time.time() - self.ttl_seconds,),
+            ).rowcount
+            self._size = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if self._size > self.max_size_bytes:
+                removed += self._evict_lru()
+            self._connection.execute("VACUUM")
+        logger.info(
+            "Pruned %d entries from fastMASST cache %s (%.1f MB left)",
+            removed,
+            self.cache_file,
+            self._size / 1024 / 1024,
+        )
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _delete(self, key):
+        row = self._connection.execute(
+            "SELECT size FROM responses WHERE key=?", (key,)
+        ).fetchone()
+        if row is not None:
+            self._connection.execute("DELETE FROM responses WHERE key=?", (key,))
+            self._size -= row[0]
+
+    def _evict_lru(self):
+        # evict down to 90% to avoid evicting on every insert
+        target = int(self.max_size_bytes * 0.9)
+        removed = 0
+        rows = self._connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall()
+        for key, size in rows:
+            if self._size <= target:
+                break
+            self._connection.execute("DELETE FROM responses WHERE key=?", (key,))
+            self._size -= size
+            removed += 1
+        return removed
+
+
+def cache_key(params: dict) -> str:
+    """
+    Canonical key of a fastMASST request. Numbers are normalized, spectra peaks are rounded like in
+    fast_masst_spectrum_dict, and the analog window is ignored if analog search is off.
+    :param params: the request parameters sent to fastMASST
+    :return: hex digest
+    """
+    analog = str(params.get("analog", "No")) == "Yes"
+    canonical = {}
+    for key, value in params.items():
+        if key in ANALOG_PARAMS and not analog:
+            continue
+        if key == "query_spectrum":
+            spec = json.loads(value) if isinstance(value, str) else value
+            canonical[key] = {
+                "peaks": [
+                    [round(float(mz), 5), round(float(i), 1)] for mz, i in spec["peaks"]
+                ],
+                "precursor_mz": round(float(spec["precursor_mz"]), 5),
+                "precursor_charge": abs(int(spec.get("precursor_charge", 1))),
+            }
+        else:
+            canonical[key] = _normalize_value(value)
+    text = json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _normalize_value(value):
+    if isinstance(value, bool):
+        return value
+    try:
+        return round(float(value), 6)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+# the active cache used by masst_utils._fast_masst
+_cache: FastMasstCache | None = None
+_mode = CacheMode.off
+
+
+def configure_cache(
+    mode: CacheMode | str = CacheMode.on,
+    cache_file="fastmasst_cache.sqlite",
+    ttl_days=7.0,
+    max_size_mb=2048.0,
+):
+    """
+    Activates the persistent fastMASST response cache for this process.
+    :param mode: off, on, refresh (bypass reads but store responses), or prune (prune and deactivate)
+    :return: the cache or None if off
+    """
+    global _cache, _mode
+    mode = CacheMode(mode if not isinstance(mode, CacheMode) else mode.value)
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    _mode = mode
+    if mode == CacheMode.off:
+        return None
+
+    cache = FastMasstCache(cache_file, ttl_days, max_size_mb)
+    if mode == CacheMode.prune:
+        cache.prune()
+        cache.close()
+        _mode = CacheMode.off
+        return None
+
+    _cache = cache
+    return _cache
+
+
+def lookup(params: dict) -> tuple[str | None, bytes | None]:
+    """
+    :return: (key, cached response content) - key is None if caching is off, content None on cache miss or refresh
+    """
+    if _cache is None:
+        return None, None
+    key = cache_key(params)
+    if _mode == CacheMode.refresh:
+        return key, None
+    return key, _cache.get(key)
+
+
+def store(key, content: bytes):
+    if _cache is not None and key is not None:
+        _cache.put(key, content)
@@ -0,0 +1,327 @@
+import json
+import logging
+import numpy as np
+from dataclasses import dataclass
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# node fields that are summed up over the tree
+COUNT_FIELDS = ["group_size", "matched_size"]
+
+
+@dataclass
+class TreeCounts:
+    # node index and its (column, value) pairs from the matched rows, matches_json is parsed on export
+    overlays: dict
+    group_sizes: np.ndarray
+    matched_sizes: np.ndarray
+    # occurrence_fraction, 0 is exported as int if group_size is 0
+    fractions: np.ndarray
+    # accumulated fields are set in all nodes
+    accumulate_groups: bool
+    accumulate_matches: bool
+
+
+class FlatTree:
+    """
+    Array representation of a nested ontology tree ({"children": [...]}) in pre-order. The subtree of node i spans
+    the nodes [i, subtree_end[i]), so subtree sums are two lookups in a cumulative sum. Children are stored as
+    offsets into child_indices (CSR), node IDs in a dict of ID and node indices, and count fields as columns.
+    The template node dicts are only read - enrich creates new nested dicts for the JSON export.
+    """
+
+    def __init__(self, root: dict, node_key):
+        """
+        :param root: root node of the nested tree
+        :param node_key: node field with the ID to match the metadata
+        """
+        nodes = []
+        parent = []
+        subtree_end = []
+        # iterative pre-order walk, subtree ends are set when leaving a node
+        stack = [(root, -1, False)]
+        while stack:
+            node, parent_index, leaving = stack.pop()
+            if leaving:
+                subtree_end[parent_index] = len(nodes)
+                continue
+            index = len(nodes)
+            nodes.append(node)
+            parent.append(parent_index)
+            subtree_end.append(index + 1)
+            stack.append((None, index, True))
+            for child in reversed(node.get("children", [])):
+                stack.append((child, index, False))
+
+        size = len(nodes)
+        parent = np.array(parent, dtype=np.int32)
+        # children of node i are child_indices[child_offsets[i]:child_offsets[i + 1]] in their original order
+        child_offsets = np.zeros(size + 1, dtype=np.int32)
+        np.add.at(child_offsets, parent[1:] + 1, 1)
+        child_offsets = np.cumsum(child_offsets, dtype=np.int32)
+        child_indices = np.arange(1, size, dtype=np.int32)[
+            np.argsort(parent[1:], kind="stable")
+        ]
+        self._set_arrays(
+            nodes,
+            node_key,
+            parent,
+            np.array(subtree_end, dtype=np.int32),
+            child_offsets,
+            child_indices,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls, nodes: list, node_key, parent, subtree_end, child_offsets, child_indices
+    ) -> "FlatTree":
+        """
+        Creates the FlatTree from its stored arrays without walking a nested tree, e.g., from memory-mapped artifacts
+        :param nodes: node dicts in pre-order, only the presence of their children field is used
+        """
+        flat_tree = cls.__new__(cls)
+        flat_tree._set_arrays(
+            nodes, node_key, parent, subtree_end, child_offsets, child_indices
+        )
+        return flat_tree
+
+    def _set_arrays(
+        self, nodes, node_key, parent, subtree_end, child_offsets, child_indices
+    ):
+        self.node_key = node_key
+        self.nodes = nodes
+        self.size = len(nodes)
+        self.parent = parent
+        self.subtree_end = subtree_end
+        self.child_offsets = child_offsets
+        self.child_indices = child_indices
+        self._children_lists = [
+            self.child_indices[start:end].tolist()
+            for start, end in zip(self.child_offsets[:-1], self.child_offsets[1:])
+        ]
+
+        self.id_index = {}
+        self.missing_ids = 0
+        for index, node in enumerate(self.nodes):
+            node_id = node.get(node_key)
+            if node_id is None:
+                self.missing_ids += 1
+            else:
+                self.id_index.setdefault(str(node_id), []).append(index)
+
+        # (values, present) of each count field
+        self.columns = {field: self._read_column(field) for field in COUNT_FIELDS}
+
+    def children(self, index) -> list:
+        return self._children_lists[index]
+
+    def subtree_sums(self, values: np.ndarray) -> np.ndarray:
+        """
+        :param values: value per node
+        :return: sum of the values in the subtree of each node including the node
+        """
+        if np.issubdtype(values.dtype, np.integer):
+            cumulative = np.concatenate(([0], np.cumsum(values)))
+            return cumulative[self.subtree_end] - cumulative[:-1]
+        # floats are summed in the same order as the recursive walk
+        sums = list(values)
+        for index in range(self.size - 1, -1, -1):
+            for child in self.children(index):
+                sums[index] += sums[child]
+        return np.array(sums, dtype=values.dtype)
+
+    def enrich(self, indexed_rows: dict, prune: bool = False) -> dict:
+        """
+        Adds the matched rows to the nodes with the same ID, sums up group_size and matched_size if they are
+        missing in any node, and calculates occurrence_fraction and the pie chart data, same as
+        json_ontology_extender.add_data_to_node followed by the field_missing, accumulate_field_in_parents,
+        calc_stats, calc_root_stats, and add_pie_data_to_node_and_children passes.
+        :param indexed_rows: dict of ID and list of (column, value), see json_ontology_extender.index_rows
+        :param prune: only keep matched nodes and their ancestors, see to_nested
+        :return: new nested tree for the JSON export
+        """
+        return self.to_nested(self.aggregate(indexed_rows), prune)
+
+    def aggregate(self, indexed_rows: dict) -> "TreeCounts":
+        """
+        Vectorized part of enrich
+        :param indexed_rows: dict of ID and list of (column, value), see json_ontology_extender.index_rows
+        :return: the matched rows by node and the counts of all nodes
+        """
+        # matched nodes get the row values
+        overlays = {}
+        for key, row in indexed_rows.items():
+            for index in self.id_index.get(key, ()):
+                overlays[index] = row
+
+        counts = {}
+        for field in COUNT_FIELDS:
+            values, present = self._overlay_column(field, overlays)
+            accumulate = not present.all()
+            if accumulate:
+                values = self.subtree_sums(
+                    np.where(present, values, 0).astype(values.dtype)
+                )
+            counts[field] = (values, accumulate)
+        group_sizes, accumulate_groups = counts["group_size"]
+        matched_sizes, accumulate_matches = counts["matched_size"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fractions = np.where(group_sizes == 0, 0.0, matched_sizes / group_sizes)
+        return TreeCounts(
+            overlays,
+            group_sizes,
+            matched_sizes,
+            fractions,
+            accumulate_groups,
+            accumulate_matches,
+        )
+
+    def to_nested(self, counts: "TreeCounts", prune: bool = False) -> dict:
+        """
+        Creates the nested tree that the viewer expects, the template nodes are copied
+        :param prune: only keep nodes with matches in their subtree and replace the unmatched children of each node
+        by one stub node with their summed up group_size, see stub_node
+        :return: root node
+        """
+        root_template = self.nodes[0]
+        if root_template.get(self.node_key) is None:
+            logger.error("Missing: {}".format(root_template.get("name", "NONAME")))
+        if self.missing_ids > 0:
+            logger.error("{} id is missing in a node".format(self.node_key))
+
+        overlays = counts.overlays
+        empty_groups = (counts.group_sizes == 0).tolist()
+        fractions = counts.fractions.tolist()
+        group_sizes = counts.group_sizes.tolist()
+        matched_sizes = counts.matched_sizes.tolist()
+        # the root sums up its children
+        root_children = self.children(0)
+        root_group_size = sum(group_sizes[child] for child in root_children)
+        root_matched_size = sum(matched_sizes[child] for child in root_children)
+
+        if prune:
+            kept = self.subtree_sums((counts.matched_sizes > 0).astype(np.int64)) > 0
+            kept[0] = True
+            subtree_sizes = (self.subtree_end - np.arange(self.size)).tolist()
+            order = np.flatnonzero(kept)[::-1].tolist()
+            kept = kept.tolist()
+        else:
+            order = range(self.size - 1, -1, -1)
+
+        built = [None] * self.size
+        for index in order:
+            node = dict(self.nodes[index])
+            for col, value in overlays.get(index, ()):
+                if col == "matches_json":
+                    node["matches"] = json.loads(value)
+                else:
+                    node[col] = value
+            if index == 0 and node.get(self.node_key) is None:
+                node[self.node_key] = node.get("name", "")
+            if counts.accumulate_groups:
+                node["group_size"] = group_sizes[index]
+            if counts.accumulate_matches:
+                node["matched_size"] = matched_sizes[index]
+            if index == 0:
+                group_size = node["group_size"] = root_group_size
+                matched_size = node["matched_size"] = root_matched_size
+                fraction = 0 if group_size == 0 else matched_size / group_size
+            else:
+                group_size = node["group_size"]
+                matched_size = node["matched_size"]
+                fraction = 0 if empty_groups[index] else fractions[index]
+            node["occurrence_fraction"] = fraction
+            node["pie_data"] = [
+                {
+                    "occurrence_fraction": fraction,
+                    "index": 0,
+                    "group_size": group_size,
+                    "matched_size": matched_size,
+                },
+                {
+                    "occurrence_fraction": 1.0 - fraction,
+                    "index": 1,
+                    "group_size": group_size,
+                    "matched_size": matched_size,
+                },
+            ]
+            if "children" in node:
+                children = self._children_lists[index]
+                if prune:
+                    pruned = [child for child in children if not kept[child]]
+                    children = [built[child] for child in children if kept[child]]
+                    if pruned:
+                        children.append(
+                            stub_node(
+                                sum(subtree_sizes[child] for child in pruned),
+                                sum(group_sizes[child] for child in pruned),
+                            )
+                        )
+                    node["children"] = children
+                else:
+                    node["children"] = [built[child] for child in children]
+            built[index] = node
+        return built[0]
+
+    def _read_column(self, field):
+        raw = [node.get(field) for node in self.nodes]
+        present = np.array([value is not None for value in raw])
+        values = [0 if value is None else value for value in raw]
+        dtype = np.int64 if all(_is_int(value) for value in values) else np.float64
+        return np.array(values, dtype=dtype), present
+
+    def _overlay_column(self, field, overlays: dict):
+        values, present = self.columns[field]
+        updates = [
+            (index, value)
+            for index, row in overlays.items()
+            for col, value in row
+            if col == field
+        ]
+        if not updates:
+            return values, present
+        values = values.copy()
+        present = present.copy()
+        if values.dtype != np.float64 and not all(
+            _is_int(value) for _, value in updates
+        ):
+            values = values.astype(np.float64)
+        for index, value in updates:
+            present[index] = value is not None
+            values[index] = 0 if value is None else value
+        return values, present
+
+
+def stub_node(collapsed_nodes, group_size) -> dict:
+    """
+    Placeholder for pruned sibling subtrees without matches, the viewer shows it as one unmatched leaf
+    :param collapsed_nodes: number of pruned nodes including all their descendants
+    :param group_size: summed up group_size of the pruned subtrees
+    """
+    return {
+        "name": "{} unmatched".format(collapsed_nodes),
+        "stub": True,
+        "collapsed_nodes": collapsed_nodes,
+        "group_size": group_size,
+        "matched_size": 0,
+        "occurrence_fraction": 0,
+        "pie_data": [
+            {
+                "occurrence_fraction": 0,
+                "index": 0,
+                "group_size": group_size,
+                "matched_size": 0,
+            },
+            {
+                "occurrence_fraction": 1.0,
+                "index": 1,
+                "group_size": group_size,
+                "matched_size": 0,
+            },
+        ],
+    }
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, (int, np.integer)) and not isinstance(value, bool)
@@ -7,6 +7,7 @@ from distutils.util import strtobool
 import logging
 
 from masst_utils import SpecialMasst
+import masst_registry
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -24,34 +25,59 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def add_data_to_node(node, meta_matched_df: pd.DataFrame, node_field, data_field):
+def add_data_to_node(
+    node,
+    meta_matched_df: pd.DataFrame,
+    node_field,
+    data_field,
+    indexed_rows: dict = None,
+):
     """
     Merge data into node and apply to all children
     :param node: the current node in a tree structure with ["children"] property
     :param meta_matched_df: the data frame with additional data
     :param node_field: node[field] determines the key to align tree and additional data
     :param data_field: data[field] determines the key to align tree and additional data
+    :param indexed_rows: rows of meta_matched_df by data_field, see index_rows. Created on the first call
     """
+    if indexed_rows is None:
+        indexed_rows = index_rows(meta_matched_df, data_field)
     try:
         ncbi = node.get(node_field)
         if ncbi is None:
             logger.warning("node has no id {}".format(node.get("name", "NONAME")))
         else:
             # use string for comparison of IDs
-            filtered = meta_matched_df[meta_matched_df[data_field] == str(ncbi)]
-            if len(filtered) > 0:
-                rowi = filtered.index[0]
-                for col, value in meta_matched_df.items():
+            row = indexed_rows.get(str(ncbi))
+            if row is not None:
+                for col, value in row:
                     if col == "matches_json":
-                        node["matches"] = json.loads(value[rowi])
-                    elif col != data_field:
-                        node[col] = value[rowi]
+                        node["matches"] = json.loads(value)
+                    else:
+                        node[col] = value
     except Exception as ex:
         logger.exception(ex)
     # apply to all children
     if "children" in node:
         for child in node["children"]:
-            add_data_to_node(child, meta_matched_df, node_field, data_field)
+            add_data_to_node(
+                child, meta_matched_df, node_field, data_field, indexed_rows
+            )
+
+
+def index_rows(meta_matched_df: pd.DataFrame, data_field) -> dict:
+    """
+    :param data_field: the ID column
+    :return: dict of ID and the list of (column, value) of its first row without the ID column
+    """
+    columns = [col for col in meta_matched_df.columns if col != data_field]
+    indexed_rows = {}
+    for key, *values in zip(
+        meta_matched_df[data_field], *(meta_matched_df[col] for col in columns)
+    ):
+        if key not in indexed_rows:
+            indexed_rows[key] = list(zip(columns, values))
+    return indexed_rows
 
 
 def accumulate_field_in_parents(node, field):
@@ -129,47 +155,51 @@ def add_data_to_ontology_file(
     in_data="../examples/caffeic_acid.tsv",
     meta_matched_df: pd.DataFrame = None,
     format_out_json=False,
+    prune_tree=False,
 ):
+    """
+    :param prune_tree: only export matched nodes, their ancestors, and one stub per parent for the unmatched children
+    :return: the enriched tree
+    """
+    # read the additional data
+    if meta_matched_df is None:
+        meta_matched_df = pd.read_csv(in_data, sep="\t")
+    treeRoot = enrich_ontology(special_masst, meta_matched_df, prune_tree)
+    write_json_tree(treeRoot, output, format_out_json)
+    return treeRoot
+
+
+def enrich_ontology(
+    special_masst: SpecialMasst, meta_matched_df: pd.DataFrame, prune_tree=False
+) -> dict:
+    """
+    :param meta_matched_df: matches grouped by the metadata key, the key column is converted to str
+    :return: new enriched tree of the SpecialMasst
+    """
     data_key = special_masst.metadata_key
-    node_key = special_masst.tree_node_key
-    with open(special_masst.tree_file) as json_file:
-        treeRoot = json.load(json_file)
-
-        # read the additional data
-        if meta_matched_df is None:
-            meta_matched_df = pd.read_csv(in_data, sep="\t")
-        # ensure that the grouping columns are strings as we usually match string ids
-        meta_matched_df[data_key] = meta_matched_df[data_key].astype(str)
-
-        # loop over all children
-        add_data_to_node(treeRoot, meta_matched_df, node_key, data_key)
-
-        # check if group_size is available otherwise propagate
-        if (
-            field_missing(
-                treeRoot, node_key, report_missing=True, replace_with_field="name"
-            )
-            > 0
-        ):
-            logger.error("{} id is missing in a node".format(node_key))
-        if field_missing(treeRoot, "group_size") > 0:
-            accumulate_field_in_parents(treeRoot, "group_size")
-        if field_missing(treeRoot, "matched_size") > 0:
-            accumulate_field_in_parents(treeRoot, "matched_size")
-
-        calc_stats(treeRoot)
-
-        # calc gfop specific data for root
-        calc_root_stats(treeRoot)
-        # add data in format for pie charts
-        add_pie_data_to_node_and_children(treeRoot)
-
-        with open(output, "w") as file:
-            if format_out_json:
-                out_tree = json.dumps(treeRoot, indent=2, cls=NpEncoder)
-            else:
-                out_tree = json.dumps(treeRoot, cls=NpEncoder)
-            print(out_tree, file=file)
+    # array representation of the tree that is built once per process
+    flat_tree = masst_registry.get_flat_tree(special_masst)
+    # ensure that the grouping columns are strings as we usually match string ids
+    meta_matched_df[data_key] = meta_matched_df[data_key].astype(str)
+
+    # adds the data to all matching nodes, propagates group_size and matched_size, and calculates the stats and
+    # pie data in vectorized passes - same as add_data_to_node, accumulate_field_in_parents, calc_stats,
+    # calc_root_stats, and add_pie_data_to_node_and_children
+    return flat_tree.enrich(index_rows(meta_matched_df, data_key), prune=prune_tree)
+
+
+def write_json_tree(treeRoot, output, format_out_json=False) -> str:
+    """
+    :return: the written JSON text
+    """
+    if format_out_json:
+        out_tree = json.dumps(treeRoot, indent=2, cls=NpEncoder)
+    else:
+        out_tree = json.dumps(treeRoot, cls=NpEncoder)
+    out_tree += "\n"
+    with open(output, "w") as file:
+        file.write(out_tree)
+    return out_tree
 
 
 def calc_stats(node):
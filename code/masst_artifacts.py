@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import logging
+from distutils.util import strtobool
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from flat_tree import FlatTree
+from masst_utils import SpecialMasst
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# increase when the file layout changes, older artifacts are rebuilt
+ARTIFACT_VERSION = 2
+DEFAULT_ARTIFACT_DIR = "data/artifacts"
+TREE_ARRAYS = ["parent", "subtree_end", "child_offsets", "child_indices"]
+
+
+def file_sha256(file) -> str:
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_fingerprint(file) -> dict:
+    stat = Path(file).stat()
+    return {
+        "file": str(file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(file),
+    }
+
+
+def is_current(fingerprint: dict) -> bool:
+    """
+    Size and modification time are checked first, the content hash only if the file was touched, e.g., by a checkout
+    :param fingerprint: recorded source_fingerprint
+    :return: True if the source file still has the recorded content
+    """
+    file = Path(fingerprint["file"])
+    if not file.is_file():
+        return False
+    stat = file.stat()
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime_ns == fingerprint["mtime_ns"]:
+        return True
+    if file_sha256(file) != fingerprint["sha256"]:
+        return False
+    fingerprint["mtime_ns"] = stat.st_mtime_ns
+    return True
+
+
+def read_info(info_file, version, sources: list):
+    """
+    :param sources: source files of the artifact
+    :return: the info of the artifact or None if it is missing, has another version, or a source changed
+    """
+    info_file = Path(info_file)
+    if not info_file.is_file():
+        return None
+    info = json.loads(info_file.read_text())
+    recorded = info.get("sources", [])
+    if info.get("version") != version or [source["file"] for source in recorded] != [
+        str(s) for s in sources
+    ]:
+        return None
+    mtimes = [source["mtime_ns"] for source in recorded]
+    if not all(is_current(source) for source in recorded):
+        logger.info("Rebuilding %s, the sources changed", info_file)
+        return None
+    if mtimes != [source["mtime_ns"] for source in recorded]:
+        # same content, the next check only compares the modification time
+        try:
+            write_atomic(info_file, json.dumps(info, indent=2).encode())
+        except OSError:
+            pass
+    return info
+
+
+def write_info(info_file, version, sources: list, **values):
+    """
+    Records the fingerprints of the sources, written after the artifact files so that readers never see a partial
+    artifact
+    """
+    info = dict(
+        version=version,
+        sources=[source_fingerprint(source) for source in sources],
+        **values,
+    )
+    write_atomic(info_file, json.dumps(info, indent=2).encode())
+
+
+def write_atomic(file, content: bytes):
+    """
+    Writes to a temporary file of this process and moves it to file
+    """
+    write_atomic_files({file: content})
+
+
+def write_atomic_files(contents: dict):
+    """
+    Writes all files to temporary files of this process first and then moves them back to back, so that a failed
+    write leaves all files unchanged
+    :param contents: dict of file and content bytes
+    """
+    tmp_files = {}
+    for file, content in contents.items():
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = file.with_name("{}.{}.tmp".format(file.name, os.getpid()))
+        tmp_file.write_bytes(content)
+        tmp_files[tmp_file] = file
+    for tmp_file, file in tmp_files.items():
+        os.replace(tmp_file, file)
+
+
+def save_array(file, values: np.ndarray):
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file.with_name("{}.{}.tmp.npy".format(file.stem, os.getpid()))
+    np.save(tmp_file, np.ascontiguousarray(values))
+    os.replace(tmp_file, file)
+
+
+def load_or_build(
+    name,
+    sources: list,
+    load_function,
+    build_function,
+    write_function,
+    artifact_dir,
+    **values
+):
+    """
+    :param name: artifact name, the info is written to {artifact_dir}/{name}.json
+    :param values: additional info values that must match, e.g., the tree node key
+    :return: the loaded artifact if it is current, otherwise the built value that is also written as artifact
+    """
+    info_file = Path(artifact_dir, "{}.json".format(name))
+    info = read_info(info_file, ARTIFACT_VERSION, sources)
+    if info is not None and all(
+        info.get(key) == value for key, value in values.items()
+    ):
+        try:
+            return load_function(info)
+        except Exception as e:
+            logger.warning("Rebuilding unreadable artifact %s: %s", name, e)
+    value = build_function()
+    try:
+        info_values = write_function(value) or {}
+        write_info(info_file, ARTIFACT_VERSION, sources, **values, **info_values)
+        logger.debug("Wrote artifact %s", info_file)
+    except (OSError, ValueError) as e:
+        # e.g., a read-only data directory or unsupported column types
+        logger.warning("Cannot write artifact %s: %s", name, e)
+    return value
+
+
+def load_metadata(
+    special_masst: SpecialMasst, build_function, artifact_dir=DEFAULT_ARTIFACT_DIR
+) -> pd.DataFrame:
+    """
+    :param build_function: reads the metadata table, see masst_registry.read_metadata
+    :return: metadata DataFrame indexed by file_usi from the memory-mapped column arrays
+    """
+    name = "{}_metadata".format(special_masst.prefix)
+    return load_or_build(
+        name,
+        [special_masst.metadata_file],
+        lambda info: read_table_artifact(artifact_dir, name, info),
+        build_function,
+        lambda df: write_table_artifact(df, artifact_dir, name),
+        artifact_dir,
+    )
+
+
+def load_flat_tree(
+    special_masst: SpecialMasst, build_function, artifact_dir=DEFAULT_ARTIFACT_DIR
+):
+    """
+    :param build_function: creates the FlatTree from the JSON tree
+    :return: FlatTree of the tree with memory-mapped arrays
+    """
+    name = "{}_tree".format(special_masst.prefix)
+    return load_or_build(
+        name,
+        [special_masst.tree_file],
+        lambda info: read_tree_artifact(
+            artifact_dir, name, special_masst.tree_node_key
+        ),
+        build_function,
+        lambda flat_tree: write_tree_artifact(flat_tree, artifact_dir, name),
+        artifact_dir,
+        node_key=special_masst.tree_node_key,
+    )
+
+
+def write_tree_artifact(flat_tree: FlatTree, artifact_dir, name):
+    """
+    Writes the TREE_ARRAYS of the FlatTree to {name}.{array}.npy and the node dicts in pre-order to {name}.nodes.json.
+    The nested children are replaced by empty lists, they are restored from the arrays.
+    """
+    for array in TREE_ARRAYS:
+        save_array(
+            Path(artifact_dir, "{}.{}.npy".format(name, array)),
+            getattr(flat_tree, array),
+        )
+    nodes = [
+        dict(node, children=[]) if "children" in node else node
+        for node in flat_tree.nodes
+    ]
+    write_atomic(
+        Path(artifact_dir, "{}.nodes.json".format(name)), json.dumps(nodes).encode()
+    )
+
+
+def read_tree_artifact(artifact_dir, name, node_key) -> FlatTree:
+    """
+    The arrays are memory-mapped read-only, the ID index and count columns are rebuilt from the node dicts
+    """
+    nodes = json.loads(Path(artifact_dir, "{}.nodes.json".format(name)).read_bytes())
+    arrays = [
+        np.load(Path(artifact_dir, "{}.{}.npy".format(name, array)), mmap_mode="r")
+        for array in TREE_ARRAYS
+    ]
+    return FlatTree.from_arrays(nodes, node_key, *arrays)
+
+
+def write_table_artifact(df: pd.DataFrame, artifact_dir, name) -> dict:
+    """
+    Writes the index and each column to {name}.{i}.npy: numbers and booleans as arrays, strings as int32 codes and
+    the distinct strings, see save_strings
+    :return: info values with the column names and kinds
+    """
+    columns = []
+    for position, (column, series) in enumerate(
+        [(df.index.name, df.index.to_series())] + list(df.items())
+    ):
+        file = Path(artifact_dir, "{}.{}.npy".format(name, position))
+        values = series.to_numpy()
+        if values.dtype.kind in "biuf":
+            save_array(file, values)
+            kind = "array"
+        elif values.dtype == object and all(
+            isinstance(value, str) for value in series.dropna()
+        ):
+            codes, strings = pd.factorize(values)
+            save_strings(
+                file.with_suffix(".strings.npy"),
+                file.with_suffix(".offsets.npy"),
+                strings,
+            )
+            save_array(file, codes.astype(np.int32))
+            kind = "strings"
+        else:
+            raise ValueError(
+                "Unsupported column {} of type {}".format(column, values.dtype)
+            )
+        columns.append({"name": column, "kind": kind})
+    return {"columns": columns}
+
+
+def read_table_artifact(artifact_dir, name, info) -> pd.DataFrame:
+    """
+    Numeric and boolean columns keep their copy-on-write memory maps without a copy. String columns are
+    materialized from their codes.
+    """
+    arrays = []
+    for position, column in enumerate(info["columns"]):
+        file = Path(artifact_dir, "{}.{}.npy".format(name, position))
+        # copy-on-write, changes to the DataFrame never reach the file
+        values = np.load(file, mmap_mode="c")
+        if column["kind"] == "strings":
+            # code -1 of missing values selects the appended NaN
+            strings = np.append(
+                load_strings(
+                    file.with_suffix(".strings.npy"), file.with_suffix(".offsets.npy")
+                ),
+                np.nan,
+            )
+            values = strings[values]
+        arrays.append(values)
+    index = pd.Index(arrays[0], name=info["columns"][0]["name"])
+    # copy=False keeps one block per column instead of copying the memory maps into consolidated blocks
+    return pd.DataFrame(
+        {
+            column["name"]: values
+            for column, values in zip(info["columns"][1:], arrays[1:])
+        },
+        index=index,
+        copy=False,
+    )
+
+
+def save_strings(strings_file, offsets_file, strings):
+    """
+    Stores the strings as one UTF-8 byte array and the character offsets of each string, so that one long string
+    does not pad all others to a fixed width
+    """
+    save_array(strings_file, np.frombuffer("".join(strings).encode(), dtype=np.uint8))
+    save_array(
+        offsets_file,
+        np.cumsum([0] + [len(string) for string in strings], dtype=np.int64),
+    )
+
+
+def load_strings(strings_file, offsets_file) -> np.ndarray:
+    """
+    :return: object array of the strings, see save_strings
+    """
+    text = np.load(strings_file, mmap_mode="r").tobytes().decode()
+    offsets = np.load(offsets_file, mmap_mode="r").tolist()
+    strings = np.empty(len(offsets) - 1, dtype=object)
+    strings[:] = [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return strings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the binary artifacts of all SpecialMasst trees and metadata tables and the metadata index"
+    )
+    parser.add_argument(
+        "--force",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="rebuild all artifacts even if their sources did not change",
+        default=False,
+    )
+    args = parser.parse_args()
+
+    try:
+        import masst_registry
+        import metadata_index
+
+        if args.force:
+            for info_file in list(Path(DEFAULT_ARTIFACT_DIR).glob("*.json")) + [
+                Path(metadata_index.DEFAULT_INDEX_DIR, metadata_index.INDEX_INFO_FILE)
+            ]:
+                info_file.unlink(missing_ok=True)
+        masst_registry.preload()
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 import pandas as pd
@@ -8,11 +9,36 @@ from distutils.util import strtobool
 import pyteomics.mgf
 from pathlib import Path
 
+import asyncio
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import wait
 
 import masst_client
+import masst_utils
+import fastmasst_cache
+from concurrency_control import AdaptiveConcurrency
+from query_deduplication import QueryDeduplicator
+from query_deduplication import count_keys
+from failed_query_journal import FailedQueryJournal
+from failed_query_journal import read_journal
+from failed_query_journal import default_journal_file
+from run_manifest import RunManifest
+from run_manifest import hash_inputs
+from run_manifest import default_manifest_file
 from masst_utils import DataBase
+from bundle_to_html import HtmlOutput
+from results_store import ResultsStore
+from results_store import default_results_file
+from results_store import ResultsWriters
+from parquet_dataset import ParquetDataset
+from parquet_dataset import default_dataset_dir
+from results_viewer import build_results_viewer
+from results_viewer import default_viewer_file
+from bundle_to_html import write_shared_index
+from utils import configure_session
+from utils import prepare_paths
+from utils import create_async_session
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -20,6 +46,9 @@ logger = logging.getLogger(__name__)
 # activate pandas tqdm progress_apply
 tqdm.pandas()
 
+# responses kept for duplicate spectra that are streamed without counting them first
+RECENT_RESPONSES = 100
+
 
 def path_safe(file):
     return re.sub("[^-a-zA-Z0-9_.() ]+", "_", file)
@@ -42,8 +71,22 @@ def run_on_usi_list_or_mgf_file(
     analog_mass_above=200,
     database: str | DataBase = None,
     library: str | DataBase = None,
+    library_search: str = "after_matches",
+    prune_tree=False,
+    html_output: str = "single",
+    massts: str = "microbe",
     parallel_queries=10,
     skip_existing=False,
+    engine="threads",
+    post_workers=None,
+    post_processing="threads",
+    adaptive_concurrency=False,
+    max_parallel_queries=None,
+    failed_journal=None,
+    retry_failed=False,
+    deduplicate=True,
+    store_results=False,
+    parquet_outputs=False,
 ):
     """
 
@@ -59,12 +102,80 @@ def run_on_usi_list_or_mgf_file(
     :param analog: search analogs bool
     :param analog_mass_below: analog search window below precursor mz
     :param analog_mass_above: analog search window above precursor mz
+    :param library_search: after_matches searches the library after the datasets for inputs with dataset matches,
+    always searches the library concurrently with the datasets, if_needed also skips the library search for library
+    IDs
+    :param prune_tree: only export matched nodes and their ancestors in the MASST trees, unmatched siblings are
+    collapsed into one stub node per parent
+    :param html_output: single writes self-contained HTML files, shared writes small HTML files that load one shared
+    asset bundle per output directory and an index page {out_file_no_extension}_index.html
+    :param massts: comma separated SpecialMasst prefixes of the exported trees (e.g., microbe,food) or all, the
+    matches are joined with the metadata of all MASSTs in one pass and more than one MASST adds the combined tree
     :param parallel_queries: perform queries in parallel
-    :param skip_existing: skip existing files
+    :param skip_existing: skip queries that completed in the run manifest (or existing files without a manifest)
+    :param engine: threads runs blocking queries in a thread pool of parallel_queries, async runs non-blocking
+    queries on an asyncio event loop with post-processing in a separate pool of post_workers
+    :param post_workers: number of post-processing workers for the async engine or post_processing processes,
+    defaults to number of CPUs
+    :param post_processing: threads runs process_matches in the query threads (threads engine) or in post_workers
+    threads (async engine), processes runs it in post_workers processes with preloaded MASST files so that it scales
+    across all CPUs while parallel_queries only limits the fastMASST requests
+    :param adaptive_concurrency: start with parallel_queries and adapt the number of fastMASST requests in flight
+    to the server latency and errors (AIMD)
+    :param max_parallel_queries: upper limit for adaptive_concurrency, defaults to 4 x parallel_queries
+    :param failed_journal: JSONL journal of failed queries, defaults to {out_file_no_extension}_failed_queries.jsonl
+    :param retry_failed: only replay the queries in the failed query journal
+    :param deduplicate: send only one fastMASST request for identical USIs or normalized spectra and share the
+    results with all compound names
+    :param store_results: write all tables and matched tree nodes to {out_file_no_extension}_results.parquet and a
+    single viewer for all spectra to {out_file_no_extension}_viewer.html
+    :param parquet_outputs: write all tables and the metadata matches of each MASST alongside the TSV files to the
+    Hive partitioned Parquet dataset {out_file_no_extension}_parquet, see pipeline/merge_tsvs.py
     :return: success rate between 0-1 (skipped existing files excluded)
     """
-    if str(in_file).endswith(".mgf"):
-        return run_on_mgf(
+    # fail before the first query on unknown MASSTs
+    masst_utils.select_special_massts(massts)
+    writers = []
+    if store_results:
+        writers.append(
+            ResultsStore(
+                default_results_file(out_file_no_extension),
+                resume=skip_existing or retry_failed,
+            )
+        )
+    if parquet_outputs:
+        writers.append(ParquetDataset(default_dataset_dir(out_file_no_extension)))
+    results_store = ResultsWriters(writers) if writers else None
+    if retry_failed:
+        run_function = retry_failed_queries
+        kwargs = dict(
+            out_filename_no_ext=out_file_no_extension,
+            failed_journal=failed_journal,
+            precursor_mz_tol=precursor_mz_tol,
+            mz_tol=mz_tol,
+            min_cos=min_cos,
+            min_matched_signals=min_matched_signals,
+            analog=analog,
+            analog_mass_below=analog_mass_below,
+            analog_mass_above=analog_mass_above,
+            database=database,
+            library=library,
+            library_search=library_search,
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
+            parallel_queries=parallel_queries,
+            engine=engine,
+            post_workers=post_workers,
+            post_processing=post_processing,
+            adaptive_concurrency=adaptive_concurrency,
+            max_parallel_queries=max_parallel_queries,
+            deduplicate=deduplicate,
+            results_store=results_store,
+        )
+    elif str(in_file).endswith(".mgf"):
+        run_function = run_on_mgf
+        kwargs = dict(
             input_file=in_file,
             out_filename_no_ext=out_file_no_extension,
             precursor_mz_tol=precursor_mz_tol,
@@ -76,11 +187,24 @@ def run_on_usi_list_or_mgf_file(
             analog_mass_above=analog_mass_above,
             database=database,
             library=library,
+            library_search=library_search,
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
             parallel_queries=parallel_queries,
             skip_existing=skip_existing,
+            engine=engine,
+            post_workers=post_workers,
+            post_processing=post_processing,
+            adaptive_concurrency=adaptive_concurrency,
+            max_parallel_queries=max_parallel_queries,
+            failed_journal=failed_journal,
+            deduplicate=deduplicate,
+            results_store=results_store,
         )
     else:
-        return run_on_usi_and_id_list(
+        run_function = run_on_usi_and_id_list
+        kwargs = dict(
             input_file=in_file,
             out_filename_no_ext=out_file_no_extension,
             usi_or_lib_id=usi_or_lib_id,
@@ -95,9 +219,34 @@ def run_on_usi_list_or_mgf_file(
             analog_mass_above=analog_mass_above,
             database=database,
             library=library,
+            library_search=library_search,
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
             parallel_queries=parallel_queries,
             skip_existing=skip_existing,
+            engine=engine,
+            post_workers=post_workers,
+            post_processing=post_processing,
+            adaptive_concurrency=adaptive_concurrency,
+            max_parallel_queries=max_parallel_queries,
+            failed_journal=failed_journal,
+            deduplicate=deduplicate,
+            results_store=results_store,
+        )
+    try:
+        success_rate = run_function(**kwargs)
+    finally:
+        if results_store is not None:
+            results_store.close()
+    if store_results:
+        build_results_viewer(
+            default_results_file(out_file_no_extension),
+            default_viewer_file(out_file_no_extension),
         )
+    if HtmlOutput(html_output) == HtmlOutput.shared:
+        write_shared_index(out_file_no_extension)
+    return success_rate
 
 
 def run_on_usi_and_id_list(
@@ -115,8 +264,20 @@ def run_on_usi_and_id_list(
     analog_mass_above=200,
     database: str = None,
     library: str = None,
+    library_search: str = "after_matches",
+    prune_tree=False,
+    html_output: str = "single",
+    massts: str = "microbe",
     parallel_queries=100,
     skip_existing=False,
+    engine="threads",
+    post_workers=None,
+    post_processing="threads",
+    adaptive_concurrency=False,
+    max_parallel_queries=None,
+    failed_journal=None,
+    deduplicate=True,
+    results_store: ResultsStore = None,
 ):
     jobs_df = pd.read_csv(input_file, sep=sep)
     jobs_df.rename(
@@ -127,15 +288,37 @@ def run_on_usi_and_id_list(
     jobs_df = jobs_df.astype({"Compound": "string"})
     jobs_df["Compound"] = jobs_df["Compound"].apply(path_safe)
 
+    params = dict(
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        min_matched_signals=min_matched_signals,
+        analog=analog,
+        analog_mass_below=analog_mass_below,
+        analog_mass_above=analog_mass_above,
+        database=database,
+        library=library,
+        library_search=library_search,
+        prune_tree=prune_tree,
+        html_output=html_output,
+        massts=massts,
+    )
+    manifest = RunManifest(default_manifest_file(out_filename_no_ext), params)
+
     if skip_existing:
         all_len = len(jobs_df)
-        jobs_df["file_path"] = [
-            "{}_matches.tsv".format(
-                masst_client.common_base_file_name(compound_name, out_filename_no_ext)
+        jobs_df["finished"] = [
+            is_finished(
+                manifest,
+                out_filename_no_ext,
+                compound_name,
+                {"usi_or_lib_id": compound_id},
+                results_store,
+            )
+            for compound_id, compound_name in zip(
+                jobs_df["input_id"], jobs_df["Compound"]
             )
-            for compound_name in jobs_df["Compound"]
         ]
-        jobs_df["finished"] = [Path(file).is_file() for file in jobs_df["file_path"]]
         jobs_df = jobs_df[~jobs_df["finished"]]
         logger.info(
             "Running fast microbe masst on input n={} spectra (total with already finished was {} spectra)".format(
@@ -147,28 +330,31 @@ def run_on_usi_and_id_list(
             "Running fast microbe masst on input n={} spectra".format(len(jobs_df))
         )
 
-    with ThreadPoolExecutor(parallel_queries) as executor:
-        futures = [
-            executor.submit(
-                masst_client.query_usi_or_id,
-                out_filename_no_ext,
-                compound_id,
-                name,
-                precursor_mz_tol=precursor_mz_tol,
-                mz_tol=mz_tol,
-                min_cos=min_cos,
-                min_matched_signals=min_matched_signals,
-                analog=analog,
-                analog_mass_below=analog_mass_below,
-                analog_mass_above=analog_mass_above,
-                database=database,
-                library=library,
-            )
-            for compound_id, name in zip(jobs_df["input_id"], jobs_df["Compound"])
-        ]
-
-        wait(futures)
-        jobs_df["success"] = [f.result() for f in futures]
+    journal = create_failed_query_journal(failed_journal, out_filename_no_ext)
+    jobs = [
+        ((out_filename_no_ext, compound_id, name), params)
+        for compound_id, name in zip(jobs_df["input_id"], jobs_df["Compound"])
+    ]
+    jobs_df["success"] = run_queries(
+        jobs,
+        masst_client.query_usi_or_id,
+        masst_client.query_usi_or_id_async,
+        out_filename_no_ext,
+        parallel_queries=parallel_queries,
+        engine=engine,
+        post_workers=post_workers,
+        post_processing=post_processing,
+        adaptive_concurrency=adaptive_concurrency,
+        max_parallel_queries=max_parallel_queries,
+        journal=journal,
+        manifest=manifest,
+        results_store=results_store,
+        query_key_counts=(
+            count_query_keys(jobs, masst_client.usi_query_keys) if deduplicate else None
+        ),
+    )
+    journal.close()
+    manifest.close()
 
     # return success rate
     total_jobs = len(jobs_df)
@@ -189,134 +375,520 @@ def run_on_mgf(
     analog_mass_above=200,
     database: str = None,
     library: str = None,
+    library_search: str = "after_matches",
+    prune_tree=False,
+    html_output: str = "single",
+    massts: str = "microbe",
     parallel_queries=100,
     skip_existing=False,
+    engine="threads",
+    post_workers=None,
+    post_processing="threads",
+    adaptive_concurrency=False,
+    max_parallel_queries=None,
+    failed_journal=None,
+    deduplicate=True,
+    results_store: ResultsStore = None,
 ):
-    ids, precursor_mzs, precursor_charges, lib_ids = [], [], [], []
-    mzs, intensities = [], []
+    journal = create_failed_query_journal(failed_journal, out_filename_no_ext)
+    params = dict(
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        min_matched_signals=min_matched_signals,
+        analog=analog,
+        analog_mass_below=analog_mass_below,
+        analog_mass_above=analog_mass_above,
+        database=database,
+        library=library,
+        library_search=library_search,
+        prune_tree=prune_tree,
+        html_output=html_output,
+        massts=massts,
+    )
+    manifest = RunManifest(default_manifest_file(out_filename_no_ext), params)
+    counter = {"spectra": 0, "skipped": 0}
+
+    def create_jobs(counter=None):
+        # spectra are parsed lazily and submitted while parsing continues
+        return (
+            (
+                (
+                    out_filename_no_ext,
+                    name,
+                    prec_mz,
+                    prec_charge,
+                    mz_array,
+                    intensity_array,
+                ),
+                dict(params, lib_id=lib_id),
+            )
+            for name, lib_id, prec_mz, prec_charge, mz_array, intensity_array in iter_mgf_spectra(
+                input_file,
+                out_filename_no_ext,
+                min_matched_signals,
+                skip_existing,
+                counter,
+                manifest,
+                results_store,
+            )
+        )
 
+    jobs = create_jobs(counter)
+    logger.info(
+        "Running fast microbe masst on input spectra from {}".format(input_file)
+    )
+    success = run_queries(
+        jobs,
+        masst_client.query_spectrum,
+        masst_client.query_spectrum_async,
+        out_filename_no_ext,
+        parallel_queries=parallel_queries,
+        engine=engine,
+        post_workers=post_workers,
+        post_processing=post_processing,
+        adaptive_concurrency=adaptive_concurrency,
+        max_parallel_queries=max_parallel_queries,
+        journal=journal,
+        manifest=manifest,
+        results_store=results_store,
+        # spectra are streamed, duplicates share in-flight and recent responses without counting them first
+        deduplicate=deduplicate,
+    )
+    journal.close()
+    manifest.close()
+    logger.info(
+        "Finished fast microbe masst on input n={} spectra (total with already finished was {} spectra)".format(
+            len(success), counter["spectra"]
+        )
+    )
+
+    # return success rate
+    total_jobs = len(success)
+    return 1 if total_jobs == 0 else sum(success) / float(total_jobs)
+
+
+def iter_mgf_spectra(
+    input_file,
+    out_filename_no_ext,
+    min_matched_signals=3,
+    skip_existing=False,
+    counter: dict = None,
+    manifest: RunManifest = None,
+    results_store: ResultsStore = None,
+):
+    """
+    Parses the mgf lazily and filters spectra on the fly
+    :param counter: optional dict that counts all spectra and skipped existing spectra
+    :param manifest: run manifest to skip completed spectra, falls back to existing files
+    :param results_store: completed spectra without rows in the results store are run again, see is_finished
+    :return: generator of (compound_name, lib_id, precursor_mz, precursor_charge, mzs, intensities)
+    """
     with pyteomics.mgf.MGF(input_file) as f_in:
         for spectrum_dict in tqdm(f_in):
             abundances = spectrum_dict["intensity array"]
-            if len(abundances) >= min_matched_signals:
-                # GNPS library mgf has SPECTRUMID for IDs
-                specid = spectrum_dict["params"].get("spectrumid", None)
-                lib_ids.append(specid)
-                specid = "_{}".format(specid) if specid else ""
-                # scan number and optional specid
-                ids.append(spectrum_dict["params"].get("scans", "") + specid)
-                precursor_mzs.append(float(spectrum_dict["params"]["pepmass"][0]))
-                if "charge" in spectrum_dict["params"]:
-                    precursor_charges.append(int(spectrum_dict["params"]["charge"][0]))
-                else:
-                    precursor_charges.append(1)
-
-                mzs.append(spectrum_dict["m/z array"])
-                intensities.append(abundances)
-
-    jobs_df = pd.DataFrame(
-        {
-            "Compound": ids,
-            "lib_id": lib_ids,
-            "precursor_mz": precursor_mzs,
-            "precursor_charge": precursor_charges,
-            "mzs": mzs,
-            "intensities": intensities,
-        }
+            if len(abundances) < min_matched_signals:
+                continue
+            # GNPS library mgf has SPECTRUMID for IDs
+            lib_id = spectrum_dict["params"].get("spectrumid", None)
+            specid = "_{}".format(lib_id) if lib_id else ""
+            # scan number and optional specid
+            compound_name = spectrum_dict["params"].get("scans", "") + specid
+            if counter is not None:
+                counter["spectra"] += 1
+
+            if "charge" in spectrum_dict["params"]:
+                precursor_charge = int(spectrum_dict["params"]["charge"][0])
+            else:
+                precursor_charge = 1
+            precursor_mz = float(spectrum_dict["params"]["pepmass"][0])
+            mzs = spectrum_dict["m/z array"]
+
+            if skip_existing and is_finished(
+                manifest,
+                out_filename_no_ext,
+                compound_name,
+                masst_client.spectrum_inputs(
+                    precursor_mz, precursor_charge, mzs, abundances, lib_id
+                ),
+                results_store,
+            ):
+                if counter is not None:
+                    counter["skipped"] += 1
+                continue
+
+            yield (
+                compound_name,
+                lib_id,
+                precursor_mz,
+                precursor_charge,
+                mzs,
+                abundances,
+            )
+
+
+def is_finished(
+    manifest: RunManifest,
+    out_filename_no_ext,
+    compound_name,
+    inputs,
+    results_store: ResultsStore = None,
+):
+    """
+    A query is finished if the run manifest lists it as completed with the same inputs and parameters. Runs without
+    a manifest fall back to checking for the matches file.
+    :param results_store: completed queries whose rows were not written to the results store before a crash are
+    not finished
+    :return: True if the query can be skipped
+    """
+    if manifest is not None and manifest.has_entries():
+        if not manifest.is_completed(compound_name, hash_inputs(inputs)):
+            return False
+        return (
+            results_store is None
+            or "results_store" not in manifest.artifacts(compound_name)
+            or results_store.has_compound(compound_name)
+        )
+    return Path(
+        "{}_matches.tsv".format(
+            masst_client.common_base_file_name(compound_name, out_filename_no_ext)
+        )
+    ).is_file()
+
+
+def retry_failed_queries(
+    out_filename_no_ext,
+    failed_journal=None,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    min_matched_signals=3,
+    analog=False,
+    analog_mass_below=150,
+    analog_mass_above=200,
+    database: str = None,
+    library: str = None,
+    library_search: str = "after_matches",
+    prune_tree=False,
+    html_output: str = "single",
+    massts: str = "microbe",
+    parallel_queries=100,
+    engine="threads",
+    post_workers=None,
+    post_processing="threads",
+    adaptive_concurrency=False,
+    max_parallel_queries=None,
+    deduplicate=True,
+    results_store: ResultsStore = None,
+):
+    """
+    Replays only the queries in the failed query journal of a previous run. Queries that fail again replace the
+    journal when the replay finished, an interrupted replay keeps the journal.
+    :return: success rate between 0-1
+    """
+    journal_file = failed_journal or default_journal_file(out_filename_no_ext)
+    if not Path(journal_file).is_file():
+        logger.info("No failed queries to retry in %s", journal_file)
+        return 1
+    entries = read_journal(journal_file)
+    logger.info(
+        "Retrying n={} failed queries from {}".format(len(entries), journal_file)
     )
 
-    if skip_existing:
-        all_len = len(jobs_df)
-        jobs_df["file_path"] = [
-            "{}_matches.tsv".format(
-                masst_client.common_base_file_name(compound_name, out_filename_no_ext)
+    params = dict(
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        min_matched_signals=min_matched_signals,
+        analog=analog,
+        analog_mass_below=analog_mass_below,
+        analog_mass_above=analog_mass_above,
+        database=database,
+        library=library,
+        library_search=library_search,
+        prune_tree=prune_tree,
+        html_output=html_output,
+        massts=massts,
+    )
+    usi_jobs = [
+        (
+            (
+                out_filename_no_ext,
+                entry["inputs"]["usi_or_lib_id"],
+                entry["compound_name"],
+            ),
+            params,
+        )
+        for entry in entries
+        if entry["query_type"] == "usi"
+    ]
+    spectrum_jobs = [
+        (
+            (
+                out_filename_no_ext,
+                entry["compound_name"],
+                entry["inputs"]["precursor_mz"],
+                entry["inputs"]["precursor_charge"],
+                entry["inputs"]["mzs"],
+                entry["inputs"]["intensities"],
+            ),
+            dict(params, lib_id=entry["inputs"]["lib_id"]),
+        )
+        for entry in entries
+        if entry["query_type"] == "spectrum"
+    ]
+
+    journal = create_failed_query_journal(journal_file, out_filename_no_ext)
+    manifest = RunManifest(default_manifest_file(out_filename_no_ext), params)
+    success = []
+    for jobs, query_function, async_query_function, key_function in [
+        (
+            usi_jobs,
+            masst_client.query_usi_or_id,
+            masst_client.query_usi_or_id_async,
+            masst_client.usi_query_keys,
+        ),
+        (
+            spectrum_jobs,
+            masst_client.query_spectrum,
+            masst_client.query_spectrum_async,
+            masst_client.spectrum_query_keys,
+        ),
+    ]:
+        if len(jobs) > 0:
+            success += run_queries(
+                jobs,
+                query_function,
+                async_query_function,
+                out_filename_no_ext,
+                parallel_queries=parallel_queries,
+                engine=engine,
+                post_workers=post_workers,
+                post_processing=post_processing,
+                adaptive_concurrency=adaptive_concurrency,
+                max_parallel_queries=max_parallel_queries,
+                journal=journal,
+                manifest=manifest,
+                results_store=results_store,
+                query_key_counts=(
+                    count_query_keys(jobs, key_function) if deduplicate else None
+                ),
             )
-            for compound_name in ids
-        ]
-        jobs_df["finished"] = [Path(file).is_file() for file in jobs_df["file_path"]]
-        jobs_df = jobs_df[~jobs_df["finished"]]
+    journal.close()
+    manifest.close()
+    return 1 if len(success) == 0 else sum(success) / float(len(success))
+
+
+def count_query_keys(jobs, key_function) -> dict:
+    """
+    :param jobs: (args, kwargs) of the query function
+    :param key_function: returns the request keys for the same arguments as the query function
+    :return: dict of request key and number of queries
+    """
+    counts = count_keys(
+        key for args, kwargs in jobs for key in key_function(*args, **kwargs)
+    )
+    duplicates = sum(count - 1 for count in counts.values())
+    if duplicates > 0:
         logger.info(
-            "Running fast microbe masst on input n={} spectra (total with already finished was {} spectra)".format(
-                len(jobs_df), all_len
+            "Found {} duplicate fastMASST requests in {} unique requests".format(
+                duplicates, len(counts)
             )
         )
+    return counts
+
+
+def create_failed_query_journal(failed_journal, out_filename_no_ext):
+    """
+    :return: the journal for this run, replaces the journal of the previous run when it is closed
+    """
+    journal_file = failed_journal or default_journal_file(out_filename_no_ext)
+    return FailedQueryJournal(journal_file)
+
+
+def run_queries(
+    jobs,
+    query_function,
+    async_query_function,
+    out_filename_no_ext,
+    parallel_queries=100,
+    engine="threads",
+    post_workers=None,
+    post_processing="threads",
+    adaptive_concurrency=False,
+    max_parallel_queries=None,
+    journal: FailedQueryJournal = None,
+    manifest: RunManifest = None,
+    results_store: ResultsStore = None,
+    query_key_counts: dict = None,
+    deduplicate=False,
+):
+    """
+    Runs all query jobs with the selected engine
+    :param jobs: list or generator of (args, kwargs) for the query functions
+    :param query_function: blocking query function for the thread engine
+    :param async_query_function: async query function for the async engine
+    :param out_filename_no_ext: output prefix for the concurrency report
+    :param parallel_queries: number of queries in flight - the initial number if adaptive_concurrency
+    :param adaptive_concurrency: adapt the number of fastMASST requests in flight to latency and errors
+    :param max_parallel_queries: upper limit for adaptive_concurrency, defaults to 4 x parallel_queries
+    :param journal: records queries that failed after all retries
+    :param manifest: records started, completed, and failed queries to resume the run
+    :param results_store: collects the tables and matched tree nodes of all queries
+    :param query_key_counts: number of queries per request key, duplicate requests share one fastMASST request
+    :param deduplicate: without query_key_counts, duplicate requests share in-flight and recent fastMASST responses
+    :param post_processing: threads or processes, see masst_client.create_post_executor
+    :return: list of query success in job order
+    """
+    extra_kwargs = {
+        key: value
+        for key, value in dict(
+            journal=journal, manifest=manifest, results_store=results_store
+        ).items()
+        if value is not None
+    }
+    if isinstance(jobs, list):
+        jobs = [(args, dict(kwargs, **extra_kwargs)) for args, kwargs in jobs]
     else:
-        logger.info(
-            "Running fast microbe masst on input n={} spectra".format(len(jobs_df))
+        # keep generators lazy
+        jobs = ((args, dict(kwargs, **extra_kwargs)) for args, kwargs in jobs)
+
+    controller = None
+    if adaptive_concurrency:
+        if max_parallel_queries is None:
+            max_parallel_queries = parallel_queries * 4
+        controller = AdaptiveConcurrency(
+            initial=parallel_queries, maximum=max_parallel_queries
         )
+        masst_utils.set_concurrency_controller(controller)
+        # the controller limits requests in flight, workers only need to exceed the upper limit
+        parallel_queries = max_parallel_queries
 
-    total_jobs = len(jobs_df)
-    if total_jobs <= 1:
-        jobs_df["success"] = [
-            masst_client.query_spectrum(
-                out_filename_no_ext,
-                name,
-                prec_mz,
-                prec_charge,
-                mz_array,
-                intensity_array,
-                precursor_mz_tol=precursor_mz_tol,
-                mz_tol=mz_tol,
-                min_cos=min_cos,
-                min_matched_signals=min_matched_signals,
-                analog=analog,
-                analog_mass_below=analog_mass_below,
-                analog_mass_above=analog_mass_above,
-                database=database,
-                library=library,
-                lib_id=lib_id,
-            )
-            for name, lib_id, prec_mz, prec_charge, mz_array, intensity_array in zip(
-                jobs_df["Compound"],
-                jobs_df["lib_id"],
-                jobs_df["precursor_mz"],
-                jobs_df["precursor_charge"],
-                jobs_df["mzs"],
-                jobs_df["intensities"],
+    deduplicator = None
+    if query_key_counts is not None:
+        deduplicator = QueryDeduplicator(query_key_counts)
+    elif deduplicate:
+        deduplicator = QueryDeduplicator(max_entries=RECENT_RESPONSES)
+    if deduplicator is not None:
+        masst_utils.set_deduplicator(deduplicator)
+
+    # pooled keep-alive connections for the concurrent dataset and library search of each parallel query
+    configure_session(parallel_queries * 2)
+    masst_client.configure_library_searches(parallel_queries)
+    post_executor = masst_client.create_post_executor(post_processing, post_workers)
+    try:
+        if engine == "async":
+            return run_queries_async(
+                async_query_function,
+                jobs,
+                parallel_queries,
+                post_workers,
+                post_executor,
             )
+        if post_executor is not None:
+            jobs = with_post_executor(jobs, post_executor)
+        if isinstance(jobs, list) and len(jobs) <= 1:
+            return [query_function(*args, **kwargs) for args, kwargs in jobs]
+        else:
+            return run_queries_threaded(query_function, jobs, parallel_queries)
+    finally:
+        if post_executor is not None:
+            post_executor.shutdown()
+        if deduplicator is not None:
+            masst_utils.set_deduplicator(None)
+            logger.info(deduplicator.report())
+        if controller is not None:
+            masst_utils.set_concurrency_controller(None)
+            logger.info(controller.report())
+            try:
+                concurrency_file = "{}_concurrency.tsv".format(out_filename_no_ext)
+                prepare_paths(file=concurrency_file)
+                controller.export_history(concurrency_file)
+            except Exception as e:
+                logger.exception(e)
+
+
+def run_queries_threaded(query_function, jobs, parallel_queries=100):
+    """
+    Runs blocking queries in a thread pool
+    :param query_function: masst_client.query_usi_or_id or query_spectrum
+    :param jobs: list or generator of (args, kwargs) for the query function
+    :param parallel_queries: number of threads
+    :return: list of query success in job order
+    """
+    # bounded submission: jobs may be a lazy generator that is consumed as workers become free
+    slots = threading.BoundedSemaphore(parallel_queries * 2)
+    futures = []
+    with ThreadPoolExecutor(parallel_queries) as executor:
+        for args, kwargs in jobs:
+            slots.acquire()
+            future = executor.submit(query_function, *args, **kwargs)
+            future.add_done_callback(lambda f: slots.release())
+            futures.append(future)
+        wait(futures)
+        return [f.result() for f in futures]
+
+
+def with_post_executor(jobs, post_executor):
+    """
+    :return: the jobs with the post_executor kwarg, generators stay lazy
+    """
+    if isinstance(jobs, list):
+        return [
+            (args, dict(kwargs, post_executor=post_executor)) for args, kwargs in jobs
         ]
-    else:
-        with ThreadPoolExecutor(parallel_queries) as executor:
-            futures = [
-                executor.submit(
-                    masst_client.query_spectrum,
-                    out_filename_no_ext,
-                    name,
-                    prec_mz,
-                    prec_charge,
-                    mz_array,
-                    intensity_array,
-                    precursor_mz_tol=precursor_mz_tol,
-                    mz_tol=mz_tol,
-                    min_cos=min_cos,
-                    min_matched_signals=min_matched_signals,
-                    analog=analog,
-                    analog_mass_below=analog_mass_below,
-                    analog_mass_above=analog_mass_above,
-                    database=database,
-                    library=library,
-                    lib_id=lib_id,
-                )
-                for name, lib_id, prec_mz, prec_charge, mz_array, intensity_array in zip(
-                    jobs_df["Compound"],
-                    jobs_df["lib_id"],
-                    jobs_df["precursor_mz"],
-                    jobs_df["precursor_charge"],
-                    jobs_df["mzs"],
-                    jobs_df["intensities"],
-                )
-            ]
+    return ((args, dict(kwargs, post_executor=post_executor)) for args, kwargs in jobs)
 
-            wait(futures)
-            jobs_df["success"] = [f.result() for f in futures]
 
-    # return success rate
-    total_jobs = len(jobs_df)
-    return (
-        1 if total_jobs == 0 else len(jobs_df[jobs_df["success"]]) / float(total_jobs)
+def run_queries_async(
+    query_function, jobs, parallel_queries=100, post_workers=None, post_executor=None
+):
+    """
+    Runs queries on a single asyncio event loop. Non-blocking HTTP requests are limited to parallel_queries in
+    flight and the CPU bound process_matches runs in a separate pool of post_workers threads.
+    :param query_function: masst_client.query_usi_or_id_async or query_spectrum_async
+    :param jobs: list or generator of (args, kwargs) for the query function
+    :param parallel_queries: maximum number of fastMASST requests in flight
+    :param post_workers: number of post-processing workers, defaults to number of CPUs
+    :param post_executor: post-processing pool instead of the post_workers threads, e.g., worker processes
+    :return: list of query success in job order
+    """
+    return asyncio.run(
+        _run_queries_async(
+            query_function, jobs, parallel_queries, post_workers, post_executor
+        )
     )
 
 
+async def _run_queries_async(
+    query_function, jobs, parallel_queries, post_workers, post_executor=None
+):
+    semaphore = asyncio.Semaphore(parallel_queries)
+    session = create_async_session(parallel_queries)
+    try:
+        # the documented default of one post-processing thread per CPU, ThreadPoolExecutor would use up to CPUs + 4
+        with post_executor or ThreadPoolExecutor(
+            post_workers or os.cpu_count()
+        ) as executor:
+            # bounded submission: jobs may be a lazy generator that is consumed as queries finish
+            tasks = []
+            pending = set()
+            for args, kwargs in jobs:
+                if len(pending) >= parallel_queries * 2:
+                    _, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                task = asyncio.ensure_future(
+                    query_function(session, semaphore, executor, *args, **kwargs)
+                )
+                pending.add(task)
+                tasks.append(task)
+            return await asyncio.gather(*tasks)
+    finally:
+        if session is not None:
+            await session.close()
+
+
 def create_params_label(
     analog,
     analog_mass_above,
@@ -427,13 +999,159 @@ if __name__ == "__main__":
     parser.add_argument(
         "--skip_existing",
         type=lambda x: bool(strtobool(str(x.strip()))),
-        help="skip existing already processed entries",
+        help="skip entries that completed in the run manifest {out_file}_manifest.jsonl (or with existing output files)",
         default=True,
     )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        help="retries of transient fastMASST errors with jittered exponential backoff",
+        default="3",
+    )
+    parser.add_argument(
+        "--failed_journal",
+        type=str,
+        help="JSONL journal of failed queries (default: {out_file}_failed_queries.jsonl)",
+        default=None,
+    )
+    parser.add_argument(
+        "--retry_failed",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="only replay the queries in the failed query journal of a previous run",
+        default=False,
+    )
+    parser.add_argument(
+        "--adaptive_concurrency",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="start with parallel_queries and adapt the number of queries in flight to fastMASST latency, errors "
+        "and Retry-After responses",
+        default=False,
+    )
+    parser.add_argument(
+        "--max_parallel_queries",
+        type=int,
+        help="upper limit for adaptive_concurrency (default: 4 x parallel_queries)",
+        default=None,
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=["threads", "async"],
+        help="threads: blocking queries in parallel_queries threads; async: non-blocking queries on one event loop "
+        "with parallel_queries requests in flight and post-processing in post_workers threads",
+        default="threads",
+    )
+    parser.add_argument(
+        "--post_workers",
+        type=int,
+        help="number of post-processing workers for the async engine or --post_processing processes (default: "
+        "number of CPUs)",
+        default=None,
+    )
+    parser.add_argument(
+        "--post_processing",
+        type=str,
+        choices=[mode.value for mode in masst_client.PostProcessing],
+        help="threads: process the matches in the query threads (threads engine) or post_workers threads (async "
+        "engine); processes: fetch in parallel_queries threads or the event loop and process the matches in "
+        "post_workers processes to use all CPUs",
+        default="threads",
+    )
+    parser.add_argument(
+        "--library_search",
+        type=str,
+        choices=[search.value for search in masst_client.LibrarySearch],
+        help="after_matches: search the library after the datasets, only for inputs with dataset matches; always: "
+        "search the library concurrently with the datasets, one more request per input for lower latency; "
+        "if_needed: like after_matches and skip the library search for library IDs (e.g., SPECTRUMID in mgf)",
+        default="after_matches",
+    )
+    parser.add_argument(
+        "--prune_tree",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="only export matched nodes and their ancestors in the MASST trees and collapse unmatched siblings into "
+        "one stub node",
+        default=False,
+    )
+    parser.add_argument(
+        "--html_output",
+        type=str,
+        choices=[mode.value for mode in HtmlOutput],
+        help="single: self-contained HTML files, shared: small HTML files that load one shared asset bundle per output "
+        "directory and an index page {out_file}_index.html",
+        default="single",
+    )
+    parser.add_argument(
+        "--massts",
+        type=str,
+        help="comma separated MASSTs to export trees for ({}) or all, more than one adds the combined tree".format(
+            ",".join(
+                special_masst.prefix for special_masst in masst_utils.SPECIAL_MASSTS
+            )
+        ),
+        default="microbe",
+    )
+    parser.add_argument(
+        "--store_results",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="write all tables and matched tree nodes to {out_file}_results.parquet and one viewer for all spectra to "
+        "{out_file}_viewer.html, combine with --html_output none to skip the per-spectrum trees",
+        default=False,
+    )
+    parser.add_argument(
+        "--parquet_outputs",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="also write all tables and the metadata matches of each MASST to the Hive partitioned Parquet dataset "
+        "{out_file}_parquet (table=.../masst=...), see pipeline/merge_tsvs.py --parquet_dataset",
+        default=False,
+    )
+    parser.add_argument(
+        "--deduplicate",
+        type=lambda x: bool(strtobool(str(x.strip()))),
+        help="query identical USIs and identical normalized spectra only once and share the results",
+        default=True,
+    )
+    # fastMASST response cache
+    parser.add_argument(
+        "--cache",
+        type=str,
+        choices=[mode.value for mode in fastmasst_cache.CacheMode],
+        help="persistent fastMASST response cache: off, on, refresh (bypass cached responses but store new ones), "
+        "or prune (remove expired and least recently used entries, then exit)",
+        default="off",
+    )
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        help="SQLite file of the fastMASST response cache",
+        default="fastmasst_cache.sqlite",
+    )
+    parser.add_argument(
+        "--cache_ttl_days",
+        type=float,
+        help="cached responses expire after this number of days",
+        default="7",
+    )
+    parser.add_argument(
+        "--cache_max_size_mb",
+        type=float,
+        help="least recently used responses are evicted above this cache size",
+        default="2048",
+    )
 
     args = parser.parse_args()
 
     try:
+        fastmasst_cache.configure_cache(
+            mode=args.cache,
+            cache_file=args.cache_file,
+            ttl_days=args.cache_ttl_days,
+            max_size_mb=args.cache_max_size_mb,
+        )
+        if args.cache == fastmasst_cache.CacheMode.prune.value:
+            sys.exit(0)
+        masst_utils.configure_retries(max_retries=args.max_retries)
+
         success_rate = run_on_usi_list_or_mgf_file(
             in_file=args.in_file,
             out_file_no_extension=args.out_file,
@@ -451,8 +1169,22 @@ if __name__ == "__main__":
             analog_mass_above=args.analog_mass_above,
             database=args.database,
             library=args.library,
+            library_search=args.library_search,
+            prune_tree=args.prune_tree,
+            html_output=args.html_output,
+            massts=args.massts,
             parallel_queries=args.parallel_queries,
             skip_existing=args.skip_existing,
+            engine=args.engine,
+            post_workers=args.post_workers,
+            post_processing=args.post_processing,
+            adaptive_concurrency=args.adaptive_concurrency,
+            max_parallel_queries=args.max_parallel_queries,
+            failed_journal=args.failed_journal,
+            retry_failed=args.retry_failed,
+            deduplicate=args.deduplicate,
+            store_results=args.store_results,
+            parquet_outputs=args.parquet_outputs,
         )
         logger.info(
             "Batch microbe MASST success rate (fastMASST query success) was %.3f",
@@ -1,20 +1,41 @@
 import sys
+import asyncio
 import logging
 from tqdm import tqdm
 import re
 import argparse
+import threading
+from enum import Enum
+from functools import partial
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 from distutils.util import strtobool
 
 import masst_utils
 from masst_utils import DataBase
+from failed_query_journal import FailedQueryJournal
+from run_manifest import RunManifest
+from run_manifest import hash_inputs
+from results_store import ResultsStore
+from results_store import MATCHES_TABLE
+from results_store import LIBRARY_TABLE
+from results_store import DATASETS_TABLE
+from results_store import ResultsRecorder
+from results_store import replay_results
+import masst_registry
 from utils import prepare_paths
-from masst_tree import create_enriched_masst_tree
-from masst_tree import create_combined_masst_tree
+from masst_tree import create_enriched_masst_trees
+from bundle_to_html import HtmlOutput
 import masst_utils as masst
 import usi_utils
 
 MATCH_COLUMNS = ["Delta Mass", "USI", "Cosine", "Matching Peaks", "Status"]
 
+# manifest artifacts of queries without matches
+EMPTY_ARTIFACTS = {"matches": "written"}
+NOT_QUERYABLE_ARTIFACTS = {"matches": "not_queryable"}
+
 LIB_COLUMNS = [
     "USI",
     "GNPSLibraryAccession",
@@ -28,6 +49,22 @@ LIB_COLUMNS = [
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# concurrent library searches of the blocking query functions, see configure_library_searches
+_library_search_executor = None
+_library_search_lock = threading.Lock()
+
+
+class LibrarySearch(Enum):
+    after_matches = "after_matches"  # search the library after the datasets, only for inputs with dataset matches
+    always = "always"  # search datasets and library concurrently
+    if_needed = "if_needed"  # like after_matches and skip the library search for known library IDs
+
+
+class PostProcessing(Enum):
+    threads = "threads"  # process_matches in the query threads or a thread pool of the async engine
+    processes = "processes"  # process_matches in worker processes, see create_post_executor
+
+
 # activate pandas tqdm progress_apply
 tqdm.pandas()
 
@@ -43,7 +80,20 @@ def process_matches(
     input_label,
     params_label,
     usi=None,
+    prune_tree=False,
+    html_output=HtmlOutput.single,
+    massts=masst.MICROBE_MASST.prefix,
+    results_store: ResultsStore = None,
 ):
+    """
+    Exports the match tables and the enriched MASST trees
+    :param prune_tree: only export matched nodes and their ancestors in the MASST trees
+    :param html_output: single for self-contained HTML files, shared for HTML shims that load shared assets, none to
+    skip the JSON and HTML trees
+    :param massts: comma separated SpecialMasst prefixes or all, more than one MASST adds the combined tree
+    :param results_store: adds all tables and the matched tree nodes to the results store of the batch run
+    :return: dict of output artifacts and their state (written or empty)
+    """
     common_file = common_base_file_name(compound_name, file_name)
 
     # extract results
@@ -54,11 +104,14 @@ def process_matches(
         analog,
         limit_to_best_match_in_file=True,
         add_dataset_titles=False,
+        columns=masst.MATCH_RESULT_COLUMNS,
     )
     # always export match table even with 0 matches to mark that it was successful
     masst_file = "{}_matches.tsv".format(common_file)
     prepare_paths(file=masst_file)
     matches_df[MATCH_COLUMNS].to_csv(masst_file, index=False, sep="\t")
+    # state of each output for the run manifest
+    artifacts = {"matches": "written"}
 
     lib_matches_df = masst.extract_matches_from_masst_results(
         library_matches, precursor_mz_tol, min_matched_signals, analog, False
@@ -67,6 +120,9 @@ def process_matches(
         lib_matches_df[LIB_COLUMNS].to_csv(
             "{}_library.tsv".format(common_file), index=False, sep="\t"
         )
+        artifacts["library"] = "written"
+    else:
+        artifacts["library"] = "empty"
 
     if "grouped_by_dataset" not in matches:
         logger.debug("Missing datasets")
@@ -74,52 +130,115 @@ def process_matches(
     datasets_df = masst.extract_datasets_from_masst_results(matches, matches_df)
     if len(datasets_df) > 0:
         datasets_df.to_csv("{}_datasets.tsv".format(common_file), index=False, sep="\t")
+        artifacts["datasets"] = "written"
+    else:
+        artifacts["datasets"] = "empty"
+
+    if results_store is not None:
+        results_store.add(MATCHES_TABLE, compound_name, matches_df[MATCH_COLUMNS])
+        if len(lib_matches_df) > 0:
+            results_store.add(LIBRARY_TABLE, compound_name, lib_matches_df[LIB_COLUMNS])
+        results_store.add(DATASETS_TABLE, compound_name, datasets_df)
 
     # add library matches to table
     lib_match_json = lib_matches_df.to_json(orient="records")
 
-    # microbeMASST
-    logger.debug("Exporting microbeMASST %s", compound_name)
-    create_enriched_masst_tree(
-        matches_df,
-        masst.MICROBE_MASST,
-        common_file=common_file,
-        lib_match_json=lib_match_json,
-        input_str=input_label,
-        parameter_str=params_label,
-        usi=usi,
-        format_out_json=False,
-        compress_out_html=True,
+    # all SpecialMassts and the combined tree from one join of the matches with the metadata
+    special_massts = masst.select_special_massts(massts)
+    logger.debug(
+        "Exporting %s %s",
+        ", ".join(special_masst.prefix for special_masst in special_massts),
+        compound_name,
     )
+    artifacts.update(
+        create_enriched_masst_trees(
+            matches_df,
+            special_massts,
+            common_file=common_file,
+            lib_match_json=lib_match_json,
+            input_str=input_label,
+            parameter_str=params_label,
+            usi=usi,
+            format_out_json=False,
+            compress_out_html=True,
+            prune_tree=prune_tree,
+            html_output=html_output,
+            results_store=results_store,
+            compound_name=compound_name,
+        )
+    )
+    if results_store is not None:
+        # the spectrum row is added last and marks that all rows of the compound are complete
+        results_store.add_spectrum(compound_name, input_label, params_label, usi)
+        # a resumed run checks that the rows reached the store, see masst_batch_client.is_finished
+        artifacts["results_store"] = "written"
+    return artifacts
+
+
+def run_process_matches(executor, args, results_store: ResultsStore = None, **kwargs):
+    """
+    Runs process_matches in this thread or waits for the post-processing pool
+    :param executor: None, a ThreadPoolExecutor, or a ProcessPoolExecutor, see create_post_executor
+    :param args: positional arguments of process_matches
+    :return: dict of output artifacts, see process_matches
+    """
+    if executor is None:
+        return process_matches(*args, results_store=results_store, **kwargs)
+    function = post_processing_function(executor, args, results_store, kwargs)
+    return finish_post_processing(executor, executor.submit(function).result(), results_store)
+
+
+async def run_process_matches_async(executor, args, results_store: ResultsStore = None, **kwargs):
+    """
+    Async version of run_process_matches, the event loop keeps running queries
+    """
+    function = post_processing_function(executor, args, results_store, kwargs)
+    result = await asyncio.get_running_loop().run_in_executor(executor, function)
+    return finish_post_processing(executor, result, results_store)
+
 
-    ## TODO: Decide to keep or remove two functions below:
-    # # microbiomeMASST
-    # logger.debug("Exporting microbiomeMASST %s", compound_name)
-    # create_enriched_masst_tree(
-    #     matches_df,
-    #     masst.MICROBIOME_MASST,
-    #     common_file=common_file,
-    #     lib_match_json=lib_match_json,
-    #     input_str=input_label,
-    #     parameter_str=params_label,
-    #     usi=usi,
-    #     format_out_json=False,
-    #     compress_out_html=True,
-    # )
-
-    # # combined from all
-    # logger.debug("Exporting combined tree %s", compound_name)
-    # create_combined_masst_tree(
-    #     matches_df,
-    #     common_file=common_file,
-    #     lib_match_json=lib_match_json,
-    #     input_str=input_label,
-    #     parameter_str=params_label,
-    #     usi=usi,
-    #     format_out_json=False,
-    #     compress_out_html=True,
-    # )
-    # return matches_df
+def post_processing_function(executor, args, results_store, kwargs):
+    if isinstance(executor, ProcessPoolExecutor):
+        # the results store stays in this process, the worker records its rows
+        return partial(process_matches_in_worker, args, results_store is not None, kwargs)
+    return partial(process_matches, *args, results_store=results_store, **kwargs)
+
+
+def finish_post_processing(executor, result, results_store):
+    if isinstance(executor, ProcessPoolExecutor):
+        artifacts, records = result
+        if records:
+            replay_results(records, results_store)
+        return artifacts
+    return result
+
+
+def process_matches_in_worker(args, record_results, kwargs):
+    """
+    process_matches in a post-processing worker process
+    :param record_results: record the rows for the results store of the parent process
+    :return: (dict of output artifacts, recorded results store rows or None)
+    """
+    recorder = ResultsRecorder() if record_results else None
+    artifacts = process_matches(*args, results_store=recorder, **kwargs)
+    return artifacts, None if recorder is None else recorder.records
+
+
+def create_post_executor(post_processing="threads", post_workers=None):
+    """
+    :param post_processing: threads keeps process_matches in the query threads (thread engine) or a thread pool
+    (async engine), processes runs it in a pool of worker processes that scales across all CPUs
+    :param post_workers: number of post-processing workers, defaults to number of CPUs
+    :return: ProcessPoolExecutor with preloaded SpecialMasst files or None for threads
+    """
+    if PostProcessing(post_processing) == PostProcessing.threads:
+        return None
+    # spawn: the batch client already runs threads and an event loop that must not be forked
+    return ProcessPoolExecutor(
+        post_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=masst_registry.preload,
+    )
 
 
 def common_base_file_name(compound_name, file_name):
@@ -142,85 +261,208 @@ def query_usi_or_id(
     analog_mass_above=200,
     database: str | DataBase = None,
     library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+    journal: FailedQueryJournal = None,
+    manifest: RunManifest = None,
+    results_store: ResultsStore = None,
+    prune_tree: bool = False,
+    html_output: str | HtmlOutput = HtmlOutput.single,
+    massts: str = masst.MICROBE_MASST.prefix,
+    post_executor=None,
 ):
     """
     NOTE: database and library are the fasst database, if None, we fall back on defaults provided by the system, otherwise we can set a string
 
+    :param library_search: after_matches searches the library after the datasets for inputs with dataset matches,
+    always searches the library concurrently with the datasets, if_needed also skips the library search for library
+    IDs
+    :param prune_tree: only export matched nodes and their ancestors in the MASST trees
+    :param html_output: single for self-contained HTML files, shared for HTML shims that load shared assets
+    :param massts: comma separated SpecialMasst prefixes of the exported trees or all, see process_matches
+    :param post_executor: runs process_matches in a post-processing pool, see run_process_matches
     :return: True if fastmasst query was successful otherwise False
     """
     # might raise exception for service
+    inputs = {"usi_or_lib_id": usi_or_lib_id}
+    started = start_manifest(manifest, compound_name, inputs)
     try:
         logger.debug("Query fastMASST id:%s  of %s", usi_or_lib_id, compound_name)
 
-        if database is None:
-            database = masst.DataBase.metabolomicspanrepo_index_latest
-
-        matches = masst.fast_masst(
+        params, library_params = usi_search_params(
             usi_or_lib_id,
-            precursor_mz_tol=precursor_mz_tol,
-            mz_tol=mz_tol,
-            min_cos=min_cos,
-            analog=analog,
-            analog_mass_below=analog_mass_below,
-            analog_mass_above=analog_mass_above,
-            database=database,
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
+            analog,
+            analog_mass_below,
+            analog_mass_above,
+            database,
+            library,
+            library_search,
         )
+        matches, library_matches = search_masst(params, library_params, library_search)
 
-        if not matches or "results" not in matches:
-            logger.debug(
-                "Empty fastMASST response for compound %s with id %s",
-                compound_name,
+        if check_empty_results(file_name, compound_name, matches):
+            complete_manifest(manifest, compound_name, inputs, started, EMPTY_ARTIFACTS)
+            return True
+
+        artifacts = run_process_matches(
+            post_executor,
+            usi_process_args(
+                file_name,
                 usi_or_lib_id,
-            )
-            return False
+                compound_name,
+                matches,
+                library_matches,
+                precursor_mz_tol,
+                mz_tol,
+                min_cos,
+                min_matched_signals,
+                analog,
+                analog_mass_below,
+                analog_mass_above,
+            ),
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
+            results_store=results_store,
+        )
+        complete_manifest(manifest, compound_name, inputs, started, artifacts)
+        return True
+    except Exception as e:
+        fail_manifest(manifest, compound_name, inputs, started, e)
+        record_failed_query(journal, "usi", compound_name, inputs, e)
+        return False
 
-        if len(matches["results"]) == 0:
-            export_empty_masst_results(compound_name, file_name)
-            # succeeded with 0 matches
-            # currently fastMASST returns empty response without results dictionary
-            return True
 
-        if library is None:
-            library = masst.DataBase.gnpslibrary
+async def query_usi_or_id_async(
+    session,
+    semaphore,
+    executor,
+    file_name,
+    usi_or_lib_id,
+    compound_name,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    min_matched_signals=3,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    database: str | DataBase = None,
+    library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+    journal: FailedQueryJournal = None,
+    manifest: RunManifest = None,
+    results_store: ResultsStore = None,
+    prune_tree: bool = False,
+    html_output: str | HtmlOutput = HtmlOutput.single,
+    massts: str = masst.MICROBE_MASST.prefix,
+):
+    """
+    Async version of query_usi_or_id for the asyncio batch engine.
+
+    :param session: aiohttp session, see utils.create_async_session
+    :param semaphore: limits the number of fastMASST requests in flight
+    :param executor: runs process_matches outside the event loop, a thread or process pool
+    :return: True if fastmasst query was successful otherwise False
+    """
+    inputs = {"usi_or_lib_id": usi_or_lib_id}
+    started = start_manifest(manifest, compound_name, inputs)
+    try:
+        logger.debug("Query fastMASST id:%s  of %s", usi_or_lib_id, compound_name)
 
-        library_matches = masst.fast_masst(
+        params, library_params = usi_search_params(
             usi_or_lib_id,
-            precursor_mz_tol=precursor_mz_tol,
-            mz_tol=mz_tol,
-            min_cos=min_cos,
-            analog=False,
-            database=library,
-        )
-
-        params_label = create_params_label(
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
             analog,
-            analog_mass_above,
             analog_mass_below,
-            min_cos,
-            min_matched_signals,
-            mz_tol,
-            precursor_mz_tol,
+            analog_mass_above,
+            database,
+            library,
+            library_search,
         )
-        input_label = "ID: {};  Descriptor: {}".format(usi_or_lib_id, compound_name)
+        matches, library_matches = await search_masst_async(
+            session, semaphore, params, library_params, library_search
+        )
+
+        if check_empty_results(file_name, compound_name, matches):
+            complete_manifest(manifest, compound_name, inputs, started, EMPTY_ARTIFACTS)
+            return True
 
-        process_matches(
+        args = usi_process_args(
             file_name,
+            usi_or_lib_id,
             compound_name,
             matches,
             library_matches,
             precursor_mz_tol,
+            mz_tol,
+            min_cos,
             min_matched_signals,
             analog,
-            input_label,
-            params_label,
-            usi_utils.ensure_usi(usi_or_lib_id),
+            analog_mass_below,
+            analog_mass_above,
+        )
+        artifacts = await run_process_matches_async(
+            executor,
+            args,
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
+            results_store=results_store,
         )
+        complete_manifest(manifest, compound_name, inputs, started, artifacts)
         return True
     except Exception as e:
-        # logger.exception(e)
+        fail_manifest(manifest, compound_name, inputs, started, e)
+        record_failed_query(journal, "usi", compound_name, inputs, e)
         return False
 
 
+def usi_process_args(
+    file_name,
+    usi_or_lib_id,
+    compound_name,
+    matches,
+    library_matches,
+    precursor_mz_tol,
+    mz_tol,
+    min_cos,
+    min_matched_signals,
+    analog,
+    analog_mass_below,
+    analog_mass_above,
+):
+    """
+    :return: the positional arguments of process_matches for a USI or library ID query
+    """
+    params_label = create_params_label(
+        analog,
+        analog_mass_above,
+        analog_mass_below,
+        min_cos,
+        min_matched_signals,
+        mz_tol,
+        precursor_mz_tol,
+    )
+    input_label = "ID: {};  Descriptor: {}".format(usi_or_lib_id, compound_name)
+    return (
+        file_name,
+        compound_name,
+        matches,
+        library_matches,
+        precursor_mz_tol,
+        min_matched_signals,
+        analog,
+        input_label,
+        params_label,
+        usi_utils.ensure_usi(usi_or_lib_id),
+    )
+
+
 def query_spectrum(
     file_name,
     compound_name,
@@ -238,86 +480,582 @@ def query_spectrum(
     lib_id=None,
     database: str | DataBase = None,
     library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+    journal: FailedQueryJournal = None,
+    manifest: RunManifest = None,
+    results_store: ResultsStore = None,
+    prune_tree: bool = False,
+    html_output: str | HtmlOutput = HtmlOutput.single,
+    massts: str = masst.MICROBE_MASST.prefix,
+    post_executor=None,
 ):
     """
     NOTE: database and library are the fasst database, if None, we fall back on defaults provided by the system, otherwise we can set a string
 
+    :param library_search: after_matches searches the library after the datasets for spectra with dataset matches,
+    always searches the library concurrently with the datasets, if_needed also skips the library search for spectra
+    with a library ID
+    :param prune_tree: only export matched nodes and their ancestors in the MASST trees
+    :param html_output: single for self-contained HTML files, shared for HTML shims that load shared assets
+    :param massts: comma separated SpecialMasst prefixes of the exported trees or all, see process_matches
+    :param post_executor: runs process_matches in a post-processing pool, see run_process_matches
     :return: True if fast masst query was successful otherwise False
     """
     # might raise exception for service
+    inputs = spectrum_inputs(precursor_mz, precursor_charge, mzs, intensities, lib_id)
+    started = start_manifest(manifest, compound_name, inputs)
     try:
-        if database is None:
-            database = masst.DataBase.metabolomicspanrepo_index_latest
-
-        matches, filtered_dps = masst.fast_masst_spectrum(
-            mzs=mzs,
-            intensities=intensities,
-            precursor_mz=precursor_mz,
-            precursor_charge=precursor_charge,
-            precursor_mz_tol=precursor_mz_tol,
-            mz_tol=mz_tol,
-            min_cos=min_cos,
-            analog=analog,
-            analog_mass_below=analog_mass_below,
-            analog_mass_above=analog_mass_above,
-            database=database,
+        params, library_params, filtered_dps = spectrum_search_params(
+            mzs,
+            intensities,
+            precursor_mz,
+            precursor_charge,
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
+            analog,
+            analog_mass_below,
+            analog_mass_above,
+            lib_id,
+            database,
+            library,
+            library_search,
         )
-        if not matches or "results" not in matches:
-            # export empty masst results file to signal that service was successful
-            logger.debug("Empty fastMASST response for spectrum %s", compound_name)
+        if params is None:
+            skip_not_queryable(manifest, compound_name, inputs, started)
             return False
+        matches, library_matches = search_masst(params, library_params, library_search)
 
-        if len(matches["results"]) == 0:
-            export_empty_masst_results(compound_name, file_name)
+        if check_empty_results(file_name, compound_name, matches):
+            complete_manifest(manifest, compound_name, inputs, started, EMPTY_ARTIFACTS)
             return True
 
-        if library is None:
-            library = masst.DataBase.gnpslibrary
-
-        library_matches, _ = masst.fast_masst_spectrum(
-            mzs=mzs,
-            intensities=intensities,
-            precursor_mz=precursor_mz,
-            precursor_charge=precursor_charge,
-            precursor_mz_tol=precursor_mz_tol,
-            mz_tol=mz_tol,
-            min_cos=min_cos,
-            analog=False,
-            database=library,
+        artifacts = run_process_matches(
+            post_executor,
+            spectrum_process_args(
+                file_name,
+                compound_name,
+                precursor_mz,
+                filtered_dps,
+                matches,
+                library_matches,
+                precursor_mz_tol,
+                mz_tol,
+                min_cos,
+                min_matched_signals,
+                analog,
+                analog_mass_below,
+                analog_mass_above,
+                lib_id,
+            ),
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
+            results_store=results_store,
         )
+        complete_manifest(manifest, compound_name, inputs, started, artifacts)
+        return True
+    except Exception as e:
+        fail_manifest(manifest, compound_name, inputs, started, e)
+        record_failed_query(journal, "spectrum", compound_name, inputs, e)
+        return False
+
+
+async def query_spectrum_async(
+    session,
+    semaphore,
+    executor,
+    file_name,
+    compound_name,
+    precursor_mz,
+    precursor_charge,
+    mzs,
+    intensities,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    min_matched_signals=3,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    lib_id=None,
+    database: str | DataBase = None,
+    library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+    journal: FailedQueryJournal = None,
+    manifest: RunManifest = None,
+    results_store: ResultsStore = None,
+    prune_tree: bool = False,
+    html_output: str | HtmlOutput = HtmlOutput.single,
+    massts: str = masst.MICROBE_MASST.prefix,
+):
+    """
+    Async version of query_spectrum for the asyncio batch engine.
 
-        params_label = create_params_label(
+    :param session: aiohttp session, see utils.create_async_session
+    :param semaphore: limits the number of fastMASST requests in flight
+    :param executor: runs process_matches outside the event loop, a thread or process pool
+    :return: True if fast masst query was successful otherwise False
+    """
+    inputs = spectrum_inputs(precursor_mz, precursor_charge, mzs, intensities, lib_id)
+    started = start_manifest(manifest, compound_name, inputs)
+    try:
+        params, library_params, filtered_dps = spectrum_search_params(
+            mzs,
+            intensities,
+            precursor_mz,
+            precursor_charge,
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
             analog,
-            analog_mass_above,
             analog_mass_below,
-            min_cos,
-            min_matched_signals,
-            mz_tol,
-            precursor_mz_tol,
+            analog_mass_above,
+            lib_id,
+            database,
+            library,
+            library_search,
         )
-        input_label = "Descriptor: {};  Precursor m/z: {};  Data points:{}".format(
-            compound_name, round(precursor_mz, 5), len(filtered_dps)
+        if params is None:
+            skip_not_queryable(manifest, compound_name, inputs, started)
+            return False
+        matches, library_matches = await search_masst_async(
+            session, semaphore, params, library_params, library_search
         )
 
-        usi = usi_utils.ensure_usi(lib_id)
+        if check_empty_results(file_name, compound_name, matches):
+            complete_manifest(manifest, compound_name, inputs, started, EMPTY_ARTIFACTS)
+            return True
 
-        process_matches(
+        args = spectrum_process_args(
             file_name,
             compound_name,
+            precursor_mz,
+            filtered_dps,
             matches,
             library_matches,
             precursor_mz_tol,
+            mz_tol,
+            min_cos,
             min_matched_signals,
             analog,
-            input_label,
-            params_label,
-            usi,
+            analog_mass_below,
+            analog_mass_above,
+            lib_id,
+        )
+        artifacts = await run_process_matches_async(
+            executor,
+            args,
+            prune_tree=prune_tree,
+            html_output=html_output,
+            massts=massts,
+            results_store=results_store,
         )
+        complete_manifest(manifest, compound_name, inputs, started, artifacts)
         return True
     except Exception as e:
+        fail_manifest(manifest, compound_name, inputs, started, e)
+        record_failed_query(journal, "spectrum", compound_name, inputs, e)
         return False
 
 
+def spectrum_process_args(
+    file_name,
+    compound_name,
+    precursor_mz,
+    filtered_dps,
+    matches,
+    library_matches,
+    precursor_mz_tol,
+    mz_tol,
+    min_cos,
+    min_matched_signals,
+    analog,
+    analog_mass_below,
+    analog_mass_above,
+    lib_id,
+):
+    """
+    :return: the positional arguments of process_matches for a spectrum query
+    """
+    params_label = create_params_label(
+        analog,
+        analog_mass_above,
+        analog_mass_below,
+        min_cos,
+        min_matched_signals,
+        mz_tol,
+        precursor_mz_tol,
+    )
+    input_label = "Descriptor: {};  Precursor m/z: {};  Data points:{}".format(
+        compound_name, round(precursor_mz, 5), len(filtered_dps)
+    )
+    return (
+        file_name,
+        compound_name,
+        matches,
+        library_matches,
+        precursor_mz_tol,
+        min_matched_signals,
+        analog,
+        input_label,
+        params_label,
+        usi_utils.ensure_usi(lib_id),
+    )
+
+
+def usi_search_params(
+    usi_or_lib_id,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    database: str | DataBase = None,
+    library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+):
+    """
+    :return: (dataset request params, library request params or None if the library search is skipped)
+    """
+    if database is None:
+        database = masst.DataBase.metabolomicspanrepo_index_latest
+    if library is None:
+        library = masst.DataBase.gnpslibrary
+
+    params = masst.create_usi_params(
+        usi_or_lib_id,
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        analog=analog,
+        analog_mass_below=analog_mass_below,
+        analog_mass_above=analog_mass_above,
+        database=database,
+    )
+    if LibrarySearch(library_search) == LibrarySearch.if_needed and is_library_usi(
+        usi_or_lib_id
+    ):
+        return params, None
+
+    library_params = masst.create_usi_params(
+        usi_or_lib_id,
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        analog=False,
+        database=library,
+    )
+    return params, library_params
+
+
+def spectrum_search_params(
+    mzs,
+    intensities,
+    precursor_mz,
+    precursor_charge,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    lib_id=None,
+    database: str | DataBase = None,
+    library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+):
+    """
+    :return: (dataset request params or None if there are too few signals, library request params or None if the
+    library search is skipped, filtered data points)
+    """
+    if database is None:
+        database = masst.DataBase.metabolomicspanrepo_index_latest
+    if library is None:
+        library = masst.DataBase.gnpslibrary
+
+    params, filtered_dps = masst.create_spectrum_params(
+        mzs=mzs,
+        intensities=intensities,
+        precursor_mz=precursor_mz,
+        precursor_charge=precursor_charge,
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        analog=analog,
+        analog_mass_below=analog_mass_below,
+        analog_mass_above=analog_mass_above,
+        database=database,
+    )
+    if params is None or (LibrarySearch(library_search) == LibrarySearch.if_needed and lib_id):
+        return params, None, filtered_dps
+
+    library_params, _ = masst.create_spectrum_params(
+        mzs=mzs,
+        intensities=intensities,
+        precursor_mz=precursor_mz,
+        precursor_charge=precursor_charge,
+        precursor_mz_tol=precursor_mz_tol,
+        mz_tol=mz_tol,
+        min_cos=min_cos,
+        analog=False,
+        database=library,
+    )
+    return params, library_params, filtered_dps
+
+
+def search_masst(params, library_params, library_search=LibrarySearch.after_matches):
+    """
+    Searches the datasets and the library. The library is searched concurrently if library_search is always,
+    otherwise only after dataset matches were found.
+    :param params: dataset request params, None returns no matches
+    :param library_params: library request params, None skips the library search
+    :return: (dataset matches, library matches)
+    """
+    if params is None:
+        return None, None
+    if library_params is None:
+        return masst.fast_masst_params(params), no_library_matches()
+    if LibrarySearch(library_search) != LibrarySearch.always:
+        try:
+            matches = masst.fast_masst_params(params)
+        except Exception as e:
+            masst.skip_request(library_params)
+            raise e
+        if not has_matches(matches):
+            # the library request that was counted for deduplication is not sent
+            masst.skip_request(library_params)
+            return matches, no_library_matches()
+        return matches, masst.fast_masst_params(library_params)
+
+    library_future = library_search_executor().submit(
+        masst.fast_masst_params, library_params
+    )
+    matches = masst.fast_masst_params(params)
+    return matches, library_future.result()
+
+
+async def search_masst_async(
+    session, semaphore, params, library_params, library_search=LibrarySearch.after_matches
+):
+    """
+    Async version of search_masst
+    :param session: aiohttp session, see utils.create_async_session
+    :param semaphore: limits the number of fastMASST requests in flight
+    :return: (dataset matches, library matches)
+    """
+
+    async def search(request_params):
+        async with semaphore:
+            return await masst.fast_masst_params_async(request_params, session)
+
+    if params is None:
+        return None, None
+    if library_params is None:
+        return await search(params), no_library_matches()
+    if LibrarySearch(library_search) != LibrarySearch.always:
+        try:
+            matches = await search(params)
+        except Exception as e:
+            masst.skip_request(library_params)
+            raise e
+        if not has_matches(matches):
+            masst.skip_request(library_params)
+            return matches, no_library_matches()
+        return matches, await search(library_params)
+
+    matches, library_matches = await asyncio.gather(
+        search(params), search(library_params)
+    )
+    return matches, library_matches
+
+
+def configure_library_searches(max_workers=10):
+    """
+    Concurrent library searches of the blocking search_masst run in a separate thread pool
+    :param max_workers: should match the number of parallel queries
+    """
+    global _library_search_executor
+    with _library_search_lock:
+        old_executor = _library_search_executor
+        _library_search_executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="library_search"
+        )
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def library_search_executor() -> ThreadPoolExecutor:
+    global _library_search_executor
+    with _library_search_lock:
+        if _library_search_executor is None:
+            _library_search_executor = ThreadPoolExecutor(
+                max_workers=10, thread_name_prefix="library_search"
+            )
+        return _library_search_executor
+
+
+def has_matches(matches) -> bool:
+    return bool(matches) and len(matches.get("results", [])) > 0
+
+
+def no_library_matches() -> dict:
+    # process_matches handles this like a library search without matches
+    return {"results": []}
+
+
+def is_library_usi(usi_or_lib_id) -> bool:
+    usi = usi_utils.ensure_usi(usi_or_lib_id)
+    return usi is not None and ":GNPS-LIBRARY:" in usi
+
+
+def skip_not_queryable(manifest, compound_name, inputs, started):
+    """
+    Spectra with less than the minimum number of signals are never sent to fastMASST. They are completed in the
+    manifest without a failed query journal entry as a retry would fail again.
+    """
+    logger.debug(
+        "Skipping spectrum %s with less than the minimum number of signals",
+        compound_name,
+    )
+    complete_manifest(manifest, compound_name, inputs, started, NOT_QUERYABLE_ARTIFACTS)
+
+
+def check_empty_results(file_name, compound_name, matches):
+    """
+    Handles empty fastMASST responses and responses without matches.
+    :return: True if the query succeeded without matches, False if there are matches to process
+    :raises EmptyResponseError: if the response is empty
+    """
+    if not matches or "results" not in matches:
+        logger.debug("Empty fastMASST response for %s", compound_name)
+        raise masst.EmptyResponseError("Empty fastMASST response")
+
+    if len(matches["results"]) == 0:
+        # succeeded with 0 matches
+        # currently fastMASST returns empty response without results dictionary
+        export_empty_masst_results(compound_name, file_name)
+        return True
+    return False
+
+
+def start_manifest(manifest, compound_name, inputs):
+    if manifest is not None:
+        return manifest.start(compound_name, hash_inputs(inputs))
+    return None
+
+
+def complete_manifest(manifest, compound_name, inputs, started, artifacts):
+    if manifest is not None:
+        manifest.complete(compound_name, hash_inputs(inputs), started, artifacts)
+
+
+def fail_manifest(manifest, compound_name, inputs, started, error):
+    if manifest is not None:
+        manifest.fail(compound_name, hash_inputs(inputs), started, error)
+
+
+def record_failed_query(journal, query_type, compound_name, inputs, error):
+    if journal is not None:
+        journal.record(query_type, compound_name, inputs, error)
+
+
+def usi_query_keys(
+    file_name,
+    usi_or_lib_id,
+    compound_name,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    min_matched_signals=3,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    database: str | DataBase = None,
+    library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+    **kwargs,
+):
+    """
+    Same arguments as query_usi_or_id
+    :return: canonical keys of the dataset and library requests of this query, skipped library requests are
+    released by search_masst
+    """
+    return [
+        masst.query_key(params)
+        for params in usi_search_params(
+            usi_or_lib_id,
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
+            analog,
+            analog_mass_below,
+            analog_mass_above,
+            database,
+            library,
+            library_search,
+        )
+    ]
+
+
+def spectrum_query_keys(
+    file_name,
+    compound_name,
+    precursor_mz,
+    precursor_charge,
+    mzs,
+    intensities,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    min_matched_signals=3,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    lib_id=None,
+    database: str | DataBase = None,
+    library: str | DataBase = None,
+    library_search: str | LibrarySearch = LibrarySearch.after_matches,
+    **kwargs,
+):
+    """
+    Same arguments as query_spectrum. Spectra are normalized like in fast_masst_spectrum.
+    :return: canonical keys of the dataset and library requests of this query, skipped library requests are
+    released by search_masst
+    """
+    params, library_params, _ = spectrum_search_params(
+        mzs,
+        intensities,
+        precursor_mz,
+        precursor_charge,
+        precursor_mz_tol,
+        mz_tol,
+        min_cos,
+        analog,
+        analog_mass_below,
+        analog_mass_above,
+        lib_id,
+        database,
+        library,
+        library_search,
+    )
+    return [masst.query_key(params), masst.query_key(library_params)]
+
+
+def spectrum_inputs(precursor_mz, precursor_charge, mzs, intensities, lib_id=None):
+    """
+    :return: JSON serializable inputs of a spectrum query to replay it from the failed query journal
+    """
+    return {
+        "precursor_mz": float(precursor_mz),
+        "precursor_charge": int(precursor_charge),
+        "mzs": [float(mz) for mz in mzs],
+        "intensities": [float(intensity) for intensity in intensities],
+        "lib_id": lib_id,
+    }
+
+
 def export_empty_masst_results(compound_name, file_name):
     try:
         path = "{}_matches.tsv".format(common_base_file_name(compound_name, file_name))
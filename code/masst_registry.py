@@ -0,0 +1,153 @@
+import json
+import threading
+import logging
+import pandas as pd
+
+from pathlib import Path
+from masst_utils import SpecialMasst
+from masst_utils import SPECIAL_MASSTS
+from flat_tree import FlatTree
+import metadata_index
+import masst_artifacts
+from metadata_index import MetadataIndex
+from metadata_index import DEFAULT_INDEX_DIR
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# process wide caches of the parsed SpecialMasst files, keyed by file path
+_metadata = {}
+_trees = {}
+_flat_trees = {}
+_metadata_indices = {}
+_lock = threading.Lock()
+_file_locks = {}
+
+
+def get_metadata(special_masst: SpecialMasst) -> pd.DataFrame:
+    """
+    The metadata table is read once per process from its binary artifact (rebuilt if the table changed) and shared by
+    all queries - do not modify it.
+    :return: metadata DataFrame indexed by file_usi
+    """
+    metadata_file = str(special_masst.metadata_file)
+    return _load_once(
+        _metadata,
+        metadata_file,
+        lambda: masst_artifacts.load_metadata(
+            special_masst, lambda: read_metadata(metadata_file)
+        ),
+    )
+
+
+def get_tree_template(special_masst: SpecialMasst) -> dict:
+    """
+    The tree is parsed once per process and shared by all queries - use copy_tree before modifying it.
+    :return: the root node of the tree
+    """
+    tree_file = str(special_masst.tree_file)
+    return _load_once(_trees, tree_file, lambda: read_tree(tree_file))
+
+
+def get_flat_tree(special_masst: SpecialMasst) -> FlatTree:
+    """
+    The array representation of the tree is loaded once per process from its artifact (rebuilt if the tree changed)
+    and shared by all queries.
+    :return: FlatTree of the tree template
+    """
+    key = (str(special_masst.tree_file), special_masst.tree_node_key)
+    return _load_once(
+        _flat_trees,
+        key,
+        lambda: masst_artifacts.load_flat_tree(
+            special_masst,
+            lambda: FlatTree(
+                get_tree_template(special_masst), special_masst.tree_node_key
+            ),
+        ),
+    )
+
+
+def get_metadata_index(index_dir=DEFAULT_INDEX_DIR) -> MetadataIndex:
+    """
+    The file_usi index of all SpecialMasst metadata tables is memory-mapped (or built if it is missing or outdated)
+    once per process, see metadata_index.
+    :return: MetadataIndex of the SpecialMassts with metadata
+    """
+    return _load_once(
+        _metadata_indices,
+        str(index_dir),
+        lambda: metadata_index.get_metadata_index(index_dir),
+    )
+
+
+def preload(special_massts=None):
+    """
+    Loads the metadata, tree, and flat tree of all SpecialMassts with existing files and the metadata index, e.g., as
+    the initializer of post-processing worker processes
+    :param special_massts: defaults to SPECIAL_MASSTS
+    """
+    for special_masst in special_massts or SPECIAL_MASSTS:
+        if Path(special_masst.metadata_file).is_file():
+            get_metadata(special_masst)
+        else:
+            logger.debug("Not preloading missing %s", special_masst.metadata_file)
+        if Path(special_masst.tree_file).is_file():
+            get_flat_tree(special_masst)
+        else:
+            logger.debug("Not preloading missing %s", special_masst.tree_file)
+    get_metadata_index()
+
+
+def copy_tree(node) -> dict:
+    """
+    Copies the node dicts and children lists, values are shared. Tree enrichment only sets values, so this is enough
+    to keep the template unchanged and much faster than copy.deepcopy or parsing the file again.
+    :return: copy of the tree
+    """
+    node_copy = dict(node)
+    children = node.get("children")
+    if children is not None:
+        node_copy["children"] = [copy_tree(child) for child in children]
+    return node_copy
+
+
+def read_metadata(metadata_file) -> pd.DataFrame:
+    if str(metadata_file).endswith(".tsv"):
+        metadata_df = pd.read_csv(metadata_file, sep="\t")
+    else:
+        metadata_df = pd.read_csv(metadata_file)
+    return metadata_df.set_index("file_usi")
+
+
+def read_tree(tree_file) -> dict:
+    with open(tree_file) as json_file:
+        return json.load(json_file)
+
+
+def clear():
+    """
+    Drops all loaded files, e.g., after the metadata files were updated
+    """
+    with _lock:
+        _metadata.clear()
+        _trees.clear()
+        _flat_trees.clear()
+        _metadata_indices.clear()
+        _file_locks.clear()
+
+
+def _load_once(cache: dict, file, load_function):
+    value = cache.get(file)
+    if value is not None:
+        return value
+    # one lock per file so that different MASSTs load in parallel and each file is only parsed once
+    with _lock:
+        file_lock = _file_locks.setdefault(file, threading.Lock())
+    with file_lock:
+        value = cache.get(file)
+        if value is None:
+            logger.debug("Loading %s", file)
+            value = load_function()
+            cache[file] = value
+    return value
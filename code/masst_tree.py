@@ -1,17 +1,26 @@
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
 from masst_utils import SpecialMasst
 from masst_utils import SPECIAL_MASSTS
 from utils import prepare_paths
 import bundle_to_html
+from bundle_to_html import HtmlOutput
+from results_store import ResultsStore
+from results_store import NODES_TABLE
+from results_store import COUNTS_TABLE
 import json_ontology_extender
+import masst_registry
 import logging
 import json
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# file prefix of the tree of all SpecialMassts
+COMBINED_PREFIX = "combined"
+
 #root_path="/workspaces/microbe_masst" 
 
 def create_enriched_masst_tree(
@@ -25,41 +34,40 @@ def create_enriched_masst_tree(
     in_html=f"code/collapsible_tree_v3.html",
     format_out_json=False,
     compress_out_html=True,
+    prune_tree=False,
+    html_output=HtmlOutput.single,
+    results_store: ResultsStore = None,
+    compound_name=None,
 ):
+    """
+    :param prune_tree: only export matched nodes and their ancestors, unmatched siblings are collapsed into one stub
+    node per parent
+    :param html_output: single for a self-contained HTML file, shared for an HTML shim that loads the shared assets of
+    the output directory, none to skip the JSON and HTML tree
+    :param results_store: adds the metadata matches and matched tree nodes of compound_name to the results store
+    """
     if (matches_df is None) or (len(matches_df) <= 0):
         return False
 
     try:
-        out_html = "{}_{}.html".format(common_file, special_masst.prefix)
-        out_json_tree = "{}_{}.json".format(common_file, special_masst.prefix)
         out_counts_file = "{}_counts_{}.tsv".format(common_file, special_masst.prefix)
-        replace_dict = {
-            "PLACEHOLDER_JSON_DATA": out_json_tree,
-            "LIBRARY_JSON_DATA_PLACEHOLDER": lib_match_json,
-            "INPUT_LABEL_PLACEHOLDER": input_str,
-            "USI_LABEL_PLACEHOLDER": usi if usi else "",
-            "PARAMS_PLACEHOLDER": parameter_str,
-        }
-
-        prepare_paths(files=[out_counts_file, out_html, out_json_tree])
-
+        prepare_paths(file=out_counts_file)
         # exports the counts file for all matches
         results_df = export_metadata_matches(special_masst, matches_df, out_counts_file)
-        if len(results_df) <= 0:
-            return None
-
-        results_df = group_matches(special_masst, results_df)
-        # adds them to the json ontology
-        json_ontology_extender.add_data_to_ontology_file(
-            special_masst=special_masst,
-            output=out_json_tree,
-            meta_matched_df=results_df,
-            format_out_json=format_out_json,
-        )
-        # bundles the final html
-        return bundle_to_html.build_dist_html(
-            in_html, out_html, replace_dict, compress_out_html
+        tree = export_masst_tree(
+            results_df,
+            special_masst,
+            common_file,
+            masst_replace_dict(lib_match_json, input_str, parameter_str, usi),
+            in_html,
+            format_out_json,
+            compress_out_html,
+            prune_tree,
+            html_output,
+            results_store,
+            compound_name,
         )
+        return None if tree is None else True
     except Exception as e:
         # exit with error
         logger.exception(e)
@@ -67,6 +75,151 @@ def create_enriched_masst_tree(
     return None
 
 
+def create_enriched_masst_trees(
+    matches_df,
+    special_massts: list,
+    common_file,
+    lib_match_json,
+    input_str,
+    parameter_str,
+    usi: str = None,
+    in_html=f"code/collapsible_tree_v3.html",
+    format_out_json=False,
+    compress_out_html=True,
+    prune_tree=False,
+    html_output=HtmlOutput.single,
+    results_store: ResultsStore = None,
+    compound_name=None,
+) -> dict:
+    """
+    Enriches the trees of several SpecialMassts from one set of matches: the matches are joined with the metadata
+    of all special_massts in one pass, see join_metadata_matches. With more than one SpecialMasst, the combined tree
+    is created from the enriched trees in memory. Parameters as in create_enriched_masst_tree.
+    :return: dict of SpecialMasst prefix (and combined) and written or empty
+    """
+    artifacts = {special_masst.prefix: "empty" for special_masst in special_massts}
+    if len(special_massts) > 1:
+        artifacts[COMBINED_PREFIX] = "empty"
+    if (matches_df is None) or (len(matches_df) <= 0):
+        return artifacts
+
+    replace_dict = masst_replace_dict(lib_match_json, input_str, parameter_str, usi)
+    tree_roots = []
+    for special_masst, results_df, match_records in join_metadata_matches(
+        special_massts, matches_df
+    ):
+        try:
+            out_counts_file = "{}_counts_{}.tsv".format(common_file, special_masst.prefix)
+            prepare_paths(file=out_counts_file)
+            if len(results_df) > 0:
+                results_df.to_csv(out_counts_file, index=False, sep="\t")
+            tree = export_masst_tree(
+                results_df,
+                special_masst,
+                common_file,
+                replace_dict,
+                in_html,
+                format_out_json,
+                compress_out_html,
+                prune_tree,
+                html_output,
+                results_store,
+                compound_name,
+                match_records,
+            )
+        except Exception as e:
+            logger.exception(e)
+            continue
+        if tree is not None:
+            artifacts[special_masst.prefix] = "written"
+            if isinstance(tree, dict):
+                tree_roots.append((special_masst, tree))
+
+    if len(special_massts) > 1:
+        try:
+            if export_combined_tree(
+                tree_roots,
+                common_file,
+                replace_dict,
+                in_html,
+                format_out_json,
+                compress_out_html,
+                html_output,
+            ):
+                artifacts[COMBINED_PREFIX] = "written"
+        except Exception as e:
+            logger.exception(e)
+    return artifacts
+
+
+def masst_replace_dict(lib_match_json, input_str, parameter_str, usi: str = None) -> dict:
+    """
+    :return: placeholders of collapsible_tree_v3.html, the tree data is set per tree
+    """
+    return {
+        "PLACEHOLDER_JSON_DATA": None,
+        "LIBRARY_JSON_DATA_PLACEHOLDER": lib_match_json,
+        "INPUT_LABEL_PLACEHOLDER": input_str,
+        "USI_LABEL_PLACEHOLDER": usi if usi else "",
+        "PARAMS_PLACEHOLDER": parameter_str,
+    }
+
+
+def export_masst_tree(
+    results_df,
+    special_masst: SpecialMasst,
+    common_file,
+    replace_dict,
+    in_html,
+    format_out_json,
+    compress_out_html,
+    prune_tree,
+    html_output,
+    results_store: ResultsStore,
+    compound_name,
+    match_records=None,
+):
+    """
+    Exports the JSON and HTML tree of the metadata matches
+    :param results_df: matches joined with the metadata, see export_metadata_matches
+    :param replace_dict: see masst_replace_dict
+    :param match_records: JSON record of each row of results_df, see group_matches
+    :return: the enriched tree, True if only the results store was updated (html_output none), or None without
+    metadata matches
+    """
+    if len(results_df) <= 0:
+        return None
+
+    if results_store is not None:
+        results_store.add(COUNTS_TABLE, compound_name, results_df, masst=special_masst.prefix)
+    results_df = group_matches(special_masst, results_df, match_records)
+    if results_store is not None:
+        results_store.add(
+            NODES_TABLE,
+            compound_name,
+            matched_node_counts(special_masst, results_df),
+            masst=special_masst.prefix,
+        )
+    if HtmlOutput(html_output) == HtmlOutput.none:
+        return True
+
+    out_html = "{}_{}.html".format(common_file, special_masst.prefix)
+    out_json_tree = "{}_{}.json".format(common_file, special_masst.prefix)
+    prepare_paths(files=[out_html, out_json_tree])
+    # adds them to the json ontology
+    tree = json_ontology_extender.enrich_ontology(special_masst, results_df, prune_tree)
+    json_text = json_ontology_extender.write_json_tree(tree, out_json_tree, format_out_json)
+    # bundles the final html, the tree data is passed on instead of reading the file again
+    bundle_to_html.build_output_html(
+        in_html,
+        out_html,
+        dict(replace_dict, PLACEHOLDER_JSON_DATA=json_text),
+        compress_out_html,
+        html_output,
+    )
+    return tree
+
+
 def create_combined_masst_tree(
     matches_df,
     common_file,
@@ -77,83 +230,128 @@ def create_combined_masst_tree(
     in_html=f"code/collapsible_tree_v3.html",
     format_out_json=False,
     compress_out_html=True,
+    html_output=HtmlOutput.single,
 ):
+    """
+    Combines the exported JSON trees of all SpecialMassts, see create_enriched_masst_trees to create all trees and the
+    combined tree without reading the files
+    """
     if (matches_df is None) or (len(matches_df) <= 0):
         return False
+    if HtmlOutput(html_output) == HtmlOutput.none:
+        return False
 
     tree_roots = []
     for special_masst in SPECIAL_MASSTS:
         try:
             out_json_tree = "{}_{}.json".format(common_file, special_masst.prefix)
             with open(out_json_tree) as json_file:
-                # load all trees, add masst_type to identify, rename root
-                treeRoot = json.load(json_file)
-                json_ontology_extender.set_field_in_all_nodes(
-                    treeRoot, "masst_type", special_masst.root
-                )
-                treeRoot["name"] = special_masst.root
-                tree_roots.append(treeRoot)
+                tree_roots.append((special_masst, json.load(json_file)))
         except:
             pass
 
+    try:
+        return export_combined_tree(
+            tree_roots,
+            common_file,
+            masst_replace_dict(lib_match_json, input_str, parameter_str, usi),
+            in_html,
+            format_out_json,
+            compress_out_html,
+            html_output,
+        )
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+    # default return None
+    return None
+
+
+def export_combined_tree(
+    tree_roots,
+    common_file,
+    replace_dict,
+    in_html,
+    format_out_json,
+    compress_out_html,
+    html_output,
+):
+    """
+    :param tree_roots: list of (SpecialMasst, enriched tree), the trees are modified
+    :return: True if exported, False for less than two trees or html_output none
+    """
     # skip if no or only one tree was detected
-    if len(tree_roots) <= 1:
+    if len(tree_roots) <= 1 or HtmlOutput(html_output) == HtmlOutput.none:
         return False
 
-    combined_root = {"name": "root", "children": tree_roots}
+    for special_masst, treeRoot in tree_roots:
+        # add masst_type to identify, rename root
+        json_ontology_extender.set_field_in_all_nodes(treeRoot, "masst_type", special_masst.root)
+        treeRoot["name"] = special_masst.root
+    combined_root = {"name": "root", "children": [treeRoot for _, treeRoot in tree_roots]}
 
     # add values to root
     json_ontology_extender.calc_root_stats(combined_root)
     json_ontology_extender.add_pie_data_to_node_and_children(combined_root, False)
 
-    try:
-        combined_prefix = "combined"
-        out_json_tree = "{}_{}.json".format(common_file, combined_prefix)
-        prepare_paths(files=[out_json_tree])
-
-        with open(out_json_tree, "w") as file:
-            if format_out_json:
-                out_tree = json.dumps(
-                    combined_root, indent=2, cls=json_ontology_extender.NpEncoder
-                )
-            else:
-                out_tree = json.dumps(
-                    combined_root, cls=json_ontology_extender.NpEncoder
-                )
-            print(out_tree, file=file)
-
-        out_html = "{}_{}.html".format(common_file, combined_prefix)
-        replace_dict = {
-            "PLACEHOLDER_JSON_DATA": out_json_tree,
-            "LIBRARY_JSON_DATA_PLACEHOLDER": lib_match_json,
-            "INPUT_LABEL_PLACEHOLDER": input_str,
-            "USI_LABEL_PLACEHOLDER": usi if usi else "",
-            "PARAMS_PLACEHOLDER": parameter_str,
-        }
+    out_json_tree = "{}_{}.json".format(common_file, COMBINED_PREFIX)
+    out_html = "{}_{}.html".format(common_file, COMBINED_PREFIX)
+    prepare_paths(files=[out_json_tree, out_html])
+    json_text = json_ontology_extender.write_json_tree(combined_root, out_json_tree, format_out_json)
+
+    # bundles the final html
+    return bundle_to_html.build_output_html(
+        in_html,
+        out_html,
+        dict(replace_dict, PLACEHOLDER_JSON_DATA=json_text),
+        compress_out_html,
+        html_output,
+    )
+
 
-        # bundles the final html
-        return bundle_to_html.build_dist_html(
-            in_html, out_html, replace_dict, compress_out_html
+def join_metadata_matches(special_massts: list, matches_df: pd.DataFrame):
+    """
+    Joins the matches with the metadata of all special_massts in one lookup in the file_usi index of all metadata
+    tables, see metadata_index
+    :return: generator of (SpecialMasst, matches joined with its metadata, JSON record of each row) for all
+    SpecialMassts with metadata, same as export_metadata_matches
+    """
+    index = masst_registry.get_metadata_index()
+    matches_df = matches_df.reset_index(drop=True)
+    # integer lookups of the match hashes in the order of the matches
+    match_rows, masst_codes, rows = index.lookup(matches_df["file_usi"])
+    # file_usi first as after reset_index of the file_usi index
+    matches_df = matches_df[
+        ["file_usi"] + [col for col in matches_df.columns if col != "file_usi"]
+    ]
+    # the matches JSON of the tree nodes is encoded once for all SpecialMassts
+    match_records = match_json_records(matches_df)
+    for special_masst in special_massts:
+        code = index.masst_code(special_masst)
+        if code is None:
+            continue
+        selected = masst_codes == code
+        masst_match_rows = match_rows[selected]
+        metadata_df = masst_registry.get_metadata(special_masst)
+        results_df = pd.concat(
+            [
+                matches_df.iloc[masst_match_rows].reset_index(drop=True),
+                metadata_df.iloc[rows[selected]].reset_index(drop=True),
+            ],
+            axis=1,
         )
-    except Exception as e:
-        # exit with error
-        logger.exception(e)
-    # default return None
-    return None
+        yield special_masst, results_df, match_records[masst_match_rows]
 
 
 def export_metadata_matches(
     special_masst: SpecialMasst, matches_df: pd.DataFrame, out_tsv_file
 ) -> pd.DataFrame:
-    metadata_file = special_masst.metadata_file
-    if str(metadata_file).endswith(".tsv"):
-        metadata_df = pd.read_csv(metadata_file, sep="\t")
-    else:
-        metadata_df = pd.read_csv(metadata_file)
+    # metadata is loaded once per process and indexed by file_usi
+    metadata_df = masst_registry.get_metadata(special_masst)
 
     # join on the file usi
     results_df = pd.concat(
-        [matches_df.set_index("file_usi"), metadata_df.set_index("file_usi")],
+        [matches_df.set_index("file_usi"), metadata_df],
         axis=1,
         join="inner",
     ).reset_index()
@@ -164,10 +362,53 @@ def export_metadata_matches(
     return results_df
 
 
-def group_matches(special_masst: SpecialMasst, results_df) -> pd.DataFrame:
-    grouped = results_df.groupby(special_masst.metadata_key)
-    results_df = grouped.agg(matched_size=(special_masst.metadata_key, "size"))
-    results_df["matches_json"] = grouped[["USI", "Cosine", "Matching Peaks"]].apply(
-        lambda x: x.to_json(orient="records")
+def matched_node_counts(special_masst: SpecialMasst, grouped_df) -> pd.DataFrame:
+    """
+    :param grouped_df: matches grouped by the metadata key, see group_matches
+    :return: node_index (pre-order), node_id, matched_size (summed up over the subtree), and matches_json of all tree
+    nodes with matches
+    """
+    data_key = special_masst.metadata_key
+    flat_tree = masst_registry.get_flat_tree(special_masst)
+    counts = flat_tree.aggregate(
+        json_ontology_extender.index_rows(grouped_df.astype({data_key: str}), data_key)
+    )
+    indices = np.flatnonzero(counts.matched_sizes > 0)
+    return pd.DataFrame(
+        {
+            "node_index": indices,
+            "node_id": [flat_tree.nodes[i].get(special_masst.tree_node_key) for i in indices],
+            "matched_size": counts.matched_sizes[indices],
+            "matches_json": [
+                dict(counts.overlays.get(i, ())).get("matches_json") for i in indices
+            ],
+        }
     )
+
+
+def group_matches(special_masst: SpecialMasst, results_df, match_records=None) -> pd.DataFrame:
+    """
+    :param match_records: JSON record of each row of results_df, see match_json_records. Shared by all SpecialMassts of
+    the same matches
+    :return: matched_size and matches_json by the metadata key
+    """
+    if match_records is None:
+        match_records = match_json_records(results_df)
+    key = special_masst.metadata_key
+    grouped = pd.DataFrame(
+        {key: results_df[key].to_numpy(), "record": match_records}
+    ).groupby(key)
+    results_df = grouped.agg(matched_size=("record", "size"))
+    # same as to_json(orient="records") of each group
+    results_df["matches_json"] = grouped["record"].agg(lambda records: "[" + ",".join(records) + "]")
     return results_df.reset_index()
+
+
+def match_json_records(matches_df) -> np.ndarray:
+    """
+    :return: JSON record of the USI, Cosine, and Matching Peaks of each match
+    """
+    if len(matches_df) == 0:
+        return np.array([], dtype=object)
+    lines = matches_df[["USI", "Cosine", "Matching Peaks"]].to_json(orient="records", lines=True)
+    return np.array(lines.rstrip("\n").split("\n"), dtype=object)
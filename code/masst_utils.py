@@ -1,17 +1,53 @@
 import requests
 import logging
-from datetime import timedelta
-import requests_cache
+import asyncio
+import random
+import time
 from enum import Enum, auto
 import json
 import pandas as pd
 from dataclasses import dataclass
 import usi_utils
+import fastmasst_cache
+import concurrency_control
+from utils import get_session
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# requests_cache.install_cache("fastmasst_cache", expire_after=timedelta(days=2))
+try:
+    # optional, only used by the async batch engine
+    import aiohttp
+
+    _AIOHTTP_TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+except ImportError:
+    _AIOHTTP_TRANSIENT_ERRORS = ()
+
+try:
+    # optional, faster decoding of large fastMASST responses
+    import orjson
+except ImportError:
+    orjson = None
+
+# scalar columns of a fastMASST match that are used downstream, the index bookkeeping and peak arrays are skipped
+MATCH_RESULT_COLUMNS = [
+    "Delta Mass",
+    "USI",
+    "Charge",
+    "Cosine",
+    "Matching Peaks",
+    "Dataset",
+    "Status",
+]
+# columns that are always removed from the matches
+UNUSED_RESULT_COLUMNS = [
+    "Unit Delta Mass",
+    "Query Scan",
+    "Query Filename",
+    "Index UnitPM",
+    "Index IdxInUnitPM",
+    "Filtered Input Spectrum Path",
+]
 
 
 @dataclass
@@ -75,7 +111,35 @@ MICROBIOME_MASST = SpecialMasst(
 )
 
 URL = "https://fasst.gnps2.org/search"
+# limits fastMASST requests in flight if set, see set_concurrency_controller
+_concurrency_controller = None
+# shares responses of duplicate queries if set, see set_deduplicator
+_deduplicator = None
+# retries of transient errors, see configure_retries
+TRANSIENT_STATUS_CODES = [408, 425, 429, 500, 502, 503, 504]
+_max_retries = 3
+_retry_base_delay = 2.0
+_retry_max_delay = 60.0
 SPECIAL_MASSTS = [FOOD_MASST, MICROBE_MASST, PLANT_MASST, TISSUE_MASST, PERSONALCAREPRODUCT_MASST, MICROBIOME_MASST]
+ALL_MASSTS = "all"
+
+
+def select_special_massts(massts: str = MICROBE_MASST.prefix) -> list:
+    """
+    :param massts: comma separated SpecialMasst prefixes or all
+    :return: list of SpecialMasst in the order of SPECIAL_MASSTS
+    """
+    if massts == ALL_MASSTS:
+        return list(SPECIAL_MASSTS)
+    prefixes = {prefix.strip() for prefix in str(massts).split(",") if prefix.strip()}
+    unknown = prefixes - {special_masst.prefix for special_masst in SPECIAL_MASSTS}
+    if unknown:
+        raise ValueError("Unknown MASSTs {}".format(", ".join(sorted(unknown))))
+    return [special_masst for special_masst in SPECIAL_MASSTS if special_masst.prefix in prefixes]
+
+
+class EmptyResponseError(Exception):
+    """fastMASST sometimes answers without results, this usually succeeds on a later try"""
 
 
 class DataBase(Enum):
@@ -100,26 +164,17 @@ def fast_masst(
     analog_mass_above=200,
     database=DataBase.metabolomicspanrepo_index_latest,
 ):
-    if str(usi_or_lib_id).startswith("CCMS"):
-        # handle library ID
-        usi_or_lib_id = "mzspec:GNPS:GNPS-LIBRARY:accession:{}".format(usi_or_lib_id)
-
     try:
-        # trying to get database name, check if string or enum
-        if isinstance(database, DataBase):
-            database = database.name
-
-        params = {
-            "usi": usi_or_lib_id,
-            "library": str(database),
-            "analog": "Yes" if analog else "No",
-            "delta_mass_below": analog_mass_below,
-            "delta_mass_above": analog_mass_above,
-            "pm_tolerance": precursor_mz_tol,
-            "fragment_tolerance": mz_tol,
-            "cosine_threshold": min_cos,
-        }
-
+        params = create_usi_params(
+            usi_or_lib_id,
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
+            analog,
+            analog_mass_below,
+            analog_mass_above,
+            database,
+        )
         return _fast_masst(params)
     # except requests.exceptions.Timeout:
     except Exception as e:
@@ -127,6 +182,38 @@ def fast_masst(
         raise e
 
 
+def create_usi_params(
+    usi_or_lib_id,
+    precursor_mz_tol=0.05,
+    mz_tol=0.02,
+    min_cos=0.7,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    database=DataBase.metabolomicspanrepo_index_latest,
+) -> dict:
+    """
+    :return: dict of the fastMASST request parameters for a USI or GNPS library ID
+    """
+    # handle library ID
+    usi_or_lib_id = usi_utils.ensure_usi(usi_or_lib_id) or usi_or_lib_id
+
+    # trying to get database name, check if string or enum
+    if isinstance(database, DataBase):
+        database = database.name
+
+    return {
+        "usi": usi_or_lib_id,
+        "library": str(database),
+        "analog": "Yes" if analog else "No",
+        "delta_mass_below": analog_mass_below,
+        "delta_mass_above": analog_mass_above,
+        "pm_tolerance": precursor_mz_tol,
+        "fragment_tolerance": mz_tol,
+        "cosine_threshold": min_cos,
+    }
+
+
 def fast_masst_spectrum(
     mzs,
     intensities,
@@ -156,6 +243,43 @@ def fast_masst_spectrum(
     :param database:
     :return: (MASST results as json, filtered data points as array of array [[x,y],[...]]
     """
+    params, dps = create_spectrum_params(
+        mzs,
+        intensities,
+        precursor_mz,
+        precursor_charge,
+        precursor_mz_tol,
+        mz_tol,
+        min_cos,
+        analog,
+        analog_mass_below,
+        analog_mass_above,
+        database,
+        min_signals,
+    )
+    if params is None:
+        return None, dps
+    return _fast_masst(params), dps
+
+
+def create_spectrum_params(
+    mzs,
+    intensities,
+    precursor_mz,
+    precursor_charge=1,
+    precursor_mz_tol=0.05,
+    mz_tol=0.05,
+    min_cos=0.7,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    database=DataBase.metabolomicspanrepo_index_latest,
+    min_signals=3,
+):
+    """
+    :return: (dict of the fastMASST request parameters or None if less than min_signals, filtered data points as
+    array of array [[x,y],[...]]
+    """
     # relative intensity and precision
     dps = [[round(mz, 5), intensity] for mz, intensity in zip(mzs, intensities)]
     spec_dict = {
@@ -164,7 +288,7 @@ def fast_masst_spectrum(
         "precursor_mz": precursor_mz,
         "precursor_charge": abs(precursor_charge),
     }
-    return fast_masst_spectrum_dict(
+    return create_spectrum_dict_params(
         spec_dict,
         precursor_mz_tol,
         mz_tol,
@@ -205,40 +329,73 @@ def fast_masst_spectrum_dict(
     :return: (MASST results as json, filtered data points as array of array [[x,y],[...]]
     """
     try:
-        max_intensity = max([v[1] for v in spec_dict["peaks"]])
-        dps = [
-            [round(dp[0], 5), round(dp[1] / max_intensity * 100.0, 1)]
-            for dp in spec_dict["peaks"]
-        ]
-        dps = [dp for dp in dps if dp[1] >= 0.1]
-
-        spec_dict["peaks"] = dps
-        spec_dict["n_peaks"] = len(dps)
-        if spec_dict["n_peaks"] < min_signals:
+        params, dps = create_spectrum_dict_params(
+            spec_dict,
+            precursor_mz_tol,
+            mz_tol,
+            min_cos,
+            analog,
+            analog_mass_below,
+            analog_mass_above,
+            database,
+            min_signals,
+        )
+        if params is None:
             return None, dps
-
-        spec_json = json.dumps(spec_dict)
-
-        # trying to get database name, check if string or enum
-        if isinstance(database, DataBase):
-            database = database.name
-
-        params = {
-            "library": str(database),
-            "analog": "Yes" if analog else "No",
-            "delta_mass_below": analog_mass_below,
-            "delta_mass_above": analog_mass_above,
-            "pm_tolerance": precursor_mz_tol,
-            "fragment_tolerance": mz_tol,
-            "cosine_threshold": min_cos,
-            "query_spectrum": spec_json,
-        }
         return _fast_masst(params), dps
     except Exception as e:
         # logging.exception("Failed fastMASST on spectrum.")
         raise e
 
 
+def create_spectrum_dict_params(
+    spec_dict: dict,
+    precursor_mz_tol=0.05,
+    mz_tol=0.05,
+    min_cos=0.7,
+    analog=False,
+    analog_mass_below=130,
+    analog_mass_above=200,
+    database=DataBase.metabolomicspanrepo_index_latest,
+    min_signals=3,
+):
+    """
+    Normalizes the spectrum to relative intensities and creates the request parameters.
+    :param spec_dict: dictionary with GNPS json like spectrum, see fast_masst_spectrum_dict
+    :return: (dict of the fastMASST request parameters or None if less than min_signals, filtered data points as
+    array of array [[x,y],[...]]
+    """
+    max_intensity = max([v[1] for v in spec_dict["peaks"]])
+    dps = [
+        [round(dp[0], 5), round(dp[1] / max_intensity * 100.0, 1)]
+        for dp in spec_dict["peaks"]
+    ]
+    dps = [dp for dp in dps if dp[1] >= 0.1]
+
+    spec_dict["peaks"] = dps
+    spec_dict["n_peaks"] = len(dps)
+    if spec_dict["n_peaks"] < min_signals:
+        return None, dps
+
+    spec_json = json.dumps(spec_dict)
+
+    # trying to get database name, check if string or enum
+    if isinstance(database, DataBase):
+        database = database.name
+
+    params = {
+        "library": str(database),
+        "analog": "Yes" if analog else "No",
+        "delta_mass_below": analog_mass_below,
+        "delta_mass_above": analog_mass_above,
+        "pm_tolerance": precursor_mz_tol,
+        "fragment_tolerance": mz_tol,
+        "cosine_threshold": min_cos,
+        "query_spectrum": spec_json,
+    }
+    return params, dps
+
+
 def _fast_masst(params):
     """
 
@@ -246,11 +403,281 @@ def _fast_masst(params):
     :return: dict with the masst results. [results] contains the individual matches, [grouped_by_dataset] contains
     all datasets and their titles
     """
-    search_api_response = requests.post(URL, data=params, timeout=300)
-    logging.debug("fastMASST response={}".format(search_api_response.status_code))
-    search_api_response.raise_for_status()
-    search_api_response_json = search_api_response.json()
-    return search_api_response_json
+    # duplicate queries share one request, see set_deduplicator
+    deduplicator = _deduplicator
+    if deduplicator is not None:
+        key = fastmasst_cache.cache_key(params)
+        if deduplicator.tracks(key):
+            fetched = {}
+
+            def fetch():
+                content, fetched["json"] = _fetch_fast_masst(params)
+                return content
+
+            content = deduplicator.fetch(key, fetch)
+            return fetched["json"] if "json" in fetched else decode_response(content)
+    return _fetch_fast_masst(params)[1]
+
+
+def _fetch_fast_masst(params) -> tuple[bytes, dict]:
+    """
+    Cached fastMASST request with retries
+    :return: (response content, dict with the masst results)
+    """
+    # persistent response cache, see fastmasst_cache.configure_cache
+    cache_key, cached_content = fastmasst_cache.lookup(params)
+    if cached_content is not None:
+        return cached_content, decode_response(cached_content)
+
+    attempt = 0
+    while True:
+        try:
+            content = _post_fast_masst(params)
+            search_api_response_json = decode_response(content)
+            # empty responses are transient and retried like connection errors
+            check_results(search_api_response_json)
+            break
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise e
+            attempt += 1
+            logger.debug("Retry %d of fastMASST in %.1f s after %r", attempt, delay, e)
+            time.sleep(delay)
+
+    # only complete responses reach the cache - empty responses raise EmptyResponseError
+    fastmasst_cache.store(cache_key, content)
+    return content, search_api_response_json
+
+
+def check_results(search_api_response_json):
+    """
+    :raises EmptyResponseError: if the fastMASST response has no results
+    """
+    if not search_api_response_json or "results" not in search_api_response_json:
+        raise EmptyResponseError("Empty fastMASST response")
+
+
+def decode_response(content) -> dict:
+    """
+    :param content: fastMASST response content
+    :return: dict with the masst results, parsed with orjson if available
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # e.g., NaN values that only the json module accepts
+            pass
+    return json.loads(content)
+
+
+def _post_fast_masst(params) -> bytes:
+    """
+    A single fastMASST request
+    :return: the response content
+    """
+    # optional adaptive limit of requests in flight, see set_concurrency_controller
+    controller = _concurrency_controller
+    start = controller.acquire() if controller is not None else None
+    try:
+        search_api_response = get_session().post(URL, data=params, timeout=300)
+        logging.debug("fastMASST response={}".format(search_api_response.status_code))
+        search_api_response.raise_for_status()
+        content = search_api_response.content
+    except Exception as e:
+        if controller is not None:
+            _release_on_error(controller, start, e)
+        raise e
+    if controller is not None:
+        controller.release(start)
+    return content
+
+
+def fast_masst_params(params):
+    """
+    :param params: dict of the query input and parameters, e.g., from create_usi_params or create_spectrum_params
+    :return: dict with the masst results, see _fast_masst
+    """
+    return _fast_masst(params)
+
+
+async def fast_masst_params_async(params, session=None):
+    """
+    Non-blocking version of _fast_masst for the asyncio batch engine.
+    :param params: dict of the query input and parameters
+    :param session: aiohttp session from utils.create_async_session. None falls back to the blocking shared session
+    in a worker thread
+    :return: dict with the masst results, see _fast_masst
+    """
+    if session is None:
+        return await asyncio.to_thread(_fast_masst, params)
+
+    deduplicator = _deduplicator
+    if deduplicator is not None:
+        key = fastmasst_cache.cache_key(params)
+        if deduplicator.tracks(key):
+            fetched = {}
+
+            async def fetch():
+                content, fetched["json"] = await _fetch_fast_masst_async(params, session)
+                return content
+
+            content = await deduplicator.fetch_async(key, fetch)
+            return fetched["json"] if "json" in fetched else decode_response(content)
+    return (await _fetch_fast_masst_async(params, session))[1]
+
+
+async def _fetch_fast_masst_async(params, session) -> tuple[bytes, dict]:
+    cache_key, cached_content = fastmasst_cache.lookup(params)
+    if cached_content is not None:
+        return cached_content, decode_response(cached_content)
+
+    attempt = 0
+    while True:
+        try:
+            content = await _post_fast_masst_async(params, session)
+            search_api_response_json = decode_response(content)
+            # empty responses are transient and retried like connection errors
+            check_results(search_api_response_json)
+            break
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise e
+            attempt += 1
+            logger.debug("Retry %d of fastMASST in %.1f s after %r", attempt, delay, e)
+            await asyncio.sleep(delay)
+
+    fastmasst_cache.store(cache_key, content)
+    return content, search_api_response_json
+
+
+async def _post_fast_masst_async(params, session) -> bytes:
+    controller = _concurrency_controller
+    start = await controller.acquire_async() if controller is not None else None
+    try:
+        # form data needs string values
+        form = {key: str(value) for key, value in params.items()}
+        async with session.post(URL, data=form) as search_api_response:
+            logging.debug("fastMASST response={}".format(search_api_response.status))
+            search_api_response.raise_for_status()
+            content = await search_api_response.read()
+    except Exception as e:
+        if controller is not None:
+            _release_on_error(controller, start, e)
+        raise e
+    if controller is not None:
+        controller.release(start)
+    return content
+
+
+def configure_retries(max_retries=3, base_delay=2.0, max_delay=60.0):
+    """
+    Transient fastMASST errors are retried with jittered exponential backoff
+    :param max_retries: maximum number of retries per request, 0 to deactivate
+    :param base_delay: the delay in seconds is drawn from [0, base_delay * 2^attempt]
+    :param max_delay: upper limit of the delay in seconds
+    """
+    global _max_retries, _retry_base_delay, _retry_max_delay
+    _max_retries = max(0, int(max_retries))
+    _retry_base_delay = float(base_delay)
+    _retry_max_delay = float(max_delay)
+
+
+def error_class(error: Exception) -> str:
+    """
+    :return: transient for errors that may succeed on retry (connection errors, timeouts, truncated responses,
+    overload status codes), otherwise permanent
+    """
+    if isinstance(error, EmptyResponseError):
+        return "transient"
+    status = _error_status(error)
+    if status is not None:
+        return "transient" if status in TRANSIENT_STATUS_CODES else "permanent"
+    transient_types = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        asyncio.TimeoutError,
+        json.JSONDecodeError,
+        ConnectionError,
+    ) + _AIOHTTP_TRANSIENT_ERRORS
+    if isinstance(error, transient_types):
+        return "transient"
+    return "permanent"
+
+
+def retry_delay(error: Exception, attempt: int) -> float | None:
+    """
+    :param error: the error of the last attempt
+    :param attempt: number of retries so far
+    :return: seconds to wait before the next retry or None to give up
+    """
+    if attempt >= _max_retries or error_class(error) != "transient":
+        return None
+    delay = random.uniform(0, min(_retry_max_delay, _retry_base_delay * 2**attempt))
+    retry_after = concurrency_control.retry_after_seconds(_error_headers(error))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, _retry_max_delay))
+    return delay
+
+
+def set_concurrency_controller(controller):
+    """
+    All fastMASST requests of this process acquire a slot from the controller and report their latency and errors
+    :param controller: concurrency_control.AdaptiveConcurrency or None to deactivate
+    """
+    global _concurrency_controller
+    _concurrency_controller = controller
+
+
+def set_deduplicator(deduplicator):
+    """
+    Queries with the same canonical request key share one fastMASST request
+    :param deduplicator: query_deduplication.QueryDeduplicator or None to deactivate
+    """
+    global _deduplicator
+    _deduplicator = deduplicator
+
+
+def skip_request(params):
+    """
+    Releases the expected duplicate of a request that is not sent, see set_deduplicator
+    :param params: fastMASST request parameters or None
+    """
+    deduplicator = _deduplicator
+    key = query_key(params)
+    if deduplicator is not None and key is not None:
+        deduplicator.release(key)
+
+
+def query_key(params) -> str | None:
+    """
+    :param params: fastMASST request parameters or None
+    :return: canonical request key, see fastmasst_cache.cache_key
+    """
+    return None if params is None else fastmasst_cache.cache_key(params)
+
+
+def _release_on_error(controller, start, error):
+    controller.release(
+        start,
+        error,
+        _error_status(error),
+        concurrency_control.retry_after_seconds(_error_headers(error)),
+    )
+
+
+def _error_status(error):
+    # requests.HTTPError has a response, aiohttp.ClientResponseError has status and headers
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) or getattr(error, "status", None)
+
+
+def _error_headers(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "headers", None) or getattr(error, "headers", None)
 
 
 def filter_matches(df, precursor_mz_tol, min_matched_signals, analog):
@@ -275,51 +702,64 @@ def extract_matches_from_masst_results(
     analog,
     limit_to_best_match_in_file: bool = False,
     add_dataset_titles=False,
+    columns: list = None,
 ) -> pd.DataFrame:
     """
     :param results_dict: masst results
     :param add_dataset_titles: add dataset titles to each row
+    :param columns: only create these columns (if in the results), e.g., MATCH_RESULT_COLUMNS. None keeps all
+    columns but the UNUSED_RESULT_COLUMNS
     :return: DataFrame of the individual matches
     """
-    masst_df = pd.DataFrame(results_dict["results"])
-    try:
-        masst_df.drop(
-            columns=[
-                "Unit Delta Mass",
-                "Query Scan",
-                "Query Filename",
-                "Index UnitPM",
-                "Index IdxInUnitPM",
-                "Filtered Input Spectrum Path",
-            ],
-            inplace=True,
-            axis=1,
-        )
-    except Exception as e:
-        # fastMASST response is sometimes empty
-        return masst_df
+    if columns is not None:
+        masst_df = matches_to_frame(results_dict["results"], columns)
+        if len(masst_df) == 0:
+            # fastMASST response is sometimes empty
+            return masst_df
+    else:
+        masst_df = pd.DataFrame(results_dict["results"])
+        try:
+            masst_df.drop(
+                columns=UNUSED_RESULT_COLUMNS,
+                inplace=True,
+                axis=1,
+            )
+        except Exception as e:
+            # fastMASST response is sometimes empty
+            return masst_df
 
     masst_df = filter_matches(masst_df, precursor_mz_tol, min_matched_signals, analog)
     if add_dataset_titles:
         datasets = results_dict["grouped_by_dataset"]
         dataset_info_dict = dict([(e["Dataset"], e["title"]) for e in datasets])
         # might not be in the df
-        masst_df.drop(columns=["mzs", "intensities"], inplace=True, axis=1)
+        masst_df.drop(columns=["mzs", "intensities"], inplace=True, axis=1, errors="ignore")
 
         for match in masst_df:
             match["dataset_title"] = dataset_info_dict.get(match["Dataset"], None)
 
     if limit_to_best_match_in_file:
         # create a usi column that only points to the dataset:file (not scan)
-        masst_df["file_usi"] = [
-            usi_utils.ensure_simple_file_usi(usi) for usi in masst_df["USI"]
-        ]
+        masst_df["file_usi"] = usi_utils.ensure_simple_file_usis(masst_df["USI"])
         masst_df = masst_df.sort_values(
             by=["Cosine", "Matching Peaks"], ascending=[False, False]
         ).drop_duplicates("file_usi")
     return masst_df
 
 
+def matches_to_frame(results: list, columns: list) -> pd.DataFrame:
+    """
+    Creates only the selected columns of the match dicts, one value list per column instead of a frame of all fields
+    :param results: match dicts of the fastMASST response
+    :param columns: columns in the order of the response, missing columns are skipped
+    :return: DataFrame with the inferred numeric dtypes
+    """
+    if not results:
+        return pd.DataFrame()
+    present = [col for col in results[0] if col in columns]
+    return pd.DataFrame({col: [match.get(col) for match in results] for col in present})
+
+
 def extract_datasets_from_masst_results(
     results_dict, matches_df: pd.DataFrame
 ) -> pd.DataFrame:
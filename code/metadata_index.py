@@ -0,0 +1,246 @@
+import sys
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from masst_utils import SpecialMasst
+from masst_utils import SPECIAL_MASSTS
+from masst_artifacts import read_info
+from masst_artifacts import write_info
+from masst_artifacts import save_array
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# increase when the file layout or the hash function changes, older indices are rebuilt
+INDEX_VERSION = 2
+DEFAULT_INDEX_DIR = "data/metadata_index"
+INDEX_INFO_FILE = "metadata_index.json"
+INDEX_ARRAYS = ["keys", "offsets", "massts", "rows"]
+# fixed siphash key of pandas.util.hash_array so that hashes are stable across processes
+HASH_KEY = "0123456789123456"
+
+
+class MetadataIndex:
+    """
+    Maps each file_usi of the metadata tables to all its (SpecialMasst, metadata row) assignments. The distinct
+    file_usis are stored as sorted 64-bit hashes (keys), the assignments of keys[i] are entries
+    offsets[i]:offsets[i + 1] of massts (position in prefixes) and rows (row in the metadata table of the MASST). A
+    join with the matches is a binary search of the match hashes, all arrays can be memory-mapped.
+    """
+
+    def __init__(self, keys, offsets, massts, rows, prefixes: list):
+        self.keys = keys
+        self.offsets = offsets
+        self.massts = massts
+        self.rows = rows
+        self.prefixes = list(prefixes)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def masst_code(self, special_masst: SpecialMasst):
+        """
+        :return: position of the SpecialMasst in the index or None if its metadata was missing
+        """
+        try:
+            return self.prefixes.index(special_masst.prefix)
+        except ValueError:
+            return None
+
+    def lookup(self, file_usis):
+        """
+        :param file_usis: file USIs of the matches
+        :return: (position in file_usis, masst code, metadata row) arrays of all assignments in the order of
+        file_usis and then in the order of the metadata tables
+        """
+        hashes = hash_file_usis(file_usis)
+        if len(self.keys) == 0 or len(hashes) == 0:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        positions = np.searchsorted(self.keys, hashes)
+        positions[positions == len(self.keys)] = 0
+        found = np.flatnonzero(self.keys[positions] == hashes)
+        positions = positions[found]
+        starts = self.offsets[positions]
+        counts = self.offsets[positions + 1] - starts
+        match_positions = np.repeat(found, counts)
+        # entries starts[i] + 0..counts[i]
+        entries = np.arange(counts.sum()) + np.repeat(
+            starts - (np.cumsum(counts) - counts), counts
+        )
+        return (
+            match_positions,
+            np.asarray(self.massts[entries]),
+            np.asarray(self.rows[entries]),
+        )
+
+
+def hash_file_usis(file_usis) -> np.ndarray:
+    """
+    :return: uint64 hash of each file USI
+    """
+    values = np.asarray(file_usis, dtype=object)
+    return pd.util.hash_array(values, categorize=False, hash_key=HASH_KEY)
+
+
+def build_metadata_index(special_massts=None) -> MetadataIndex:
+    """
+    Reads the file_usi column of all metadata tables, SpecialMassts without a metadata file are skipped.
+    :param special_massts: defaults to SPECIAL_MASSTS
+    :return: MetadataIndex in memory
+    """
+    prefixes = []
+    tables = []
+    for special_masst in special_massts or SPECIAL_MASSTS:
+        if not Path(special_masst.metadata_file).is_file():
+            logger.warning(
+                "Skipping %s, missing %s",
+                special_masst.prefix,
+                special_masst.metadata_file,
+            )
+            continue
+        prefixes.append(special_masst.prefix)
+        tables.append(read_file_usis(special_masst.metadata_file))
+    return create_metadata_index(prefixes, tables)
+
+
+def create_metadata_index(prefixes: list, tables: list) -> MetadataIndex:
+    """
+    :param prefixes: SpecialMasst prefix of each table
+    :param tables: file_usi column of each metadata table
+    :return: MetadataIndex in memory
+    """
+    file_usis = []
+    massts = []
+    rows = []
+    for code, usis in enumerate(tables):
+        usis = np.asarray(usis, dtype=object)
+        # rows without file_usi never match but keep their row number
+        valid = np.flatnonzero(pd.notna(usis))
+        file_usis.append(usis[valid])
+        massts.append(np.full(len(valid), code, dtype=np.int16))
+        rows.append(valid.astype(np.int64))
+    if not file_usis:
+        return MetadataIndex(
+            np.array([], dtype=np.uint64),
+            np.zeros(1, dtype=np.int64),
+            np.array([], dtype=np.int16),
+            np.array([], dtype=np.int64),
+            prefixes,
+        )
+    file_usis = np.concatenate(file_usis)
+    hashes = hash_file_usis(file_usis)
+    # stable to keep the assignments of a file in the order of the metadata tables
+    order = np.argsort(hashes, kind="stable")
+    keys, starts = np.unique(hashes[order], return_index=True)
+    if len(keys) != len(pd.unique(file_usis)):
+        raise ValueError("Hash collision of file USIs in the metadata index")
+    return MetadataIndex(
+        keys,
+        np.append(starts, len(order)).astype(np.int64),
+        np.concatenate(massts)[order],
+        np.concatenate(rows)[order],
+        prefixes,
+    )
+
+
+def read_file_usis(metadata_file) -> np.ndarray:
+    """
+    :return: file_usi column of the metadata table, rows as in masst_registry.read_metadata
+    """
+    sep = "\t" if str(metadata_file).endswith(".tsv") else ","
+    return pd.read_csv(metadata_file, sep=sep, usecols=["file_usi"])[
+        "file_usi"
+    ].to_numpy(dtype=object)
+
+
+def metadata_files(special_massts=None) -> list:
+    """
+    :return: the existing metadata files, the sources of the index
+    """
+    return [
+        special_masst.metadata_file
+        for special_masst in special_massts or SPECIAL_MASSTS
+        if Path(special_masst.metadata_file).is_file()
+    ]
+
+
+def write_metadata_index(
+    index: MetadataIndex, index_dir=DEFAULT_INDEX_DIR, special_massts=None
+):
+    """
+    Writes the arrays as .npy files and the version and source fingerprints to metadata_index.json. Every file is
+    written to a temporary file and moved, the info file last, so that readers never see a partial index.
+    """
+    for name in INDEX_ARRAYS:
+        save_array(Path(index_dir, "{}.npy".format(name)), getattr(index, name))
+    write_info(
+        Path(index_dir, INDEX_INFO_FILE),
+        INDEX_VERSION,
+        metadata_files(special_massts),
+        hash_key=HASH_KEY,
+        prefixes=index.prefixes,
+        files=len(index),
+    )
+    logger.info("Wrote metadata index of %d files to %s", len(index), index_dir)
+
+
+def load_metadata_index(
+    index_dir=DEFAULT_INDEX_DIR, special_massts=None, mmap_mode="r"
+):
+    """
+    :return: the memory-mapped MetadataIndex or None if it is missing, has another version, or the content of the
+    metadata files changed since it was built
+    """
+    info = read_info(
+        Path(index_dir, INDEX_INFO_FILE), INDEX_VERSION, metadata_files(special_massts)
+    )
+    if info is None or info.get("hash_key") != HASH_KEY:
+        return None
+    arrays = [
+        np.load(Path(index_dir, "{}.npy".format(name)), mmap_mode=mmap_mode)
+        for name in INDEX_ARRAYS
+    ]
+    return MetadataIndex(*arrays, info["prefixes"])
+
+
+def get_metadata_index(
+    index_dir=DEFAULT_INDEX_DIR, special_massts=None
+) -> MetadataIndex:
+    """
+    :return: the prebuilt index if it is up to date, otherwise the index is rebuilt and written to index_dir
+    """
+    index = load_metadata_index(index_dir, special_massts)
+    if index is None:
+        index = build_metadata_index(special_massts)
+        try:
+            write_metadata_index(index, index_dir, special_massts)
+        except OSError as e:
+            logger.warning("Cannot write metadata index %s: %s", index_dir, e)
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the file_usi index of all SpecialMasst metadata tables"
+    )
+    parser.add_argument(
+        "--index_dir",
+        type=str,
+        help="output directory of the index",
+        default=DEFAULT_INDEX_DIR,
+    )
+    args = parser.parse_args()
+
+    try:
+        write_metadata_index(build_metadata_index(), args.index_dir)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
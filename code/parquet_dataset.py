@@ -0,0 +1,329 @@
+import os
+import threading
+import logging
+from pathlib import Path
+import pandas as pd
+
+from results_store import SPECTRUM_TABLE
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+    pq = None
+    ds = None
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def default_dataset_dir(out_filename_no_ext):
+    return "{}_parquet".format(out_filename_no_ext)
+
+
+class ParquetDataset:
+    """
+    Hive partitioned Parquet dataset of the per-spectrum tables of a batch run:
+    {dataset_dir}/table={table}/part-{n}.parquet and {dataset_dir}/table={table}/masst={prefix}/part-{n}.parquet for
+    tables of a SpecialMasst. Each row has the compound name. The rows of a spectrum are held back until its spectrum
+    row is added, which process_matches does last, so that files only contain complete spectra. Once the complete
+    spectra reach row_group_size rows, every partition writes them to a new part file. Files are written as
+    .part-{n}.parquet, which dataset readers skip, and renamed right after the flush, so that a crash keeps all
+    earlier flushes. A resumed run adds new part files.
+    """
+
+    def __init__(self, dataset_dir, row_group_size=50000):
+        """
+        :param row_group_size: rows of complete spectra are buffered and written in part files of this size
+        """
+        if pa is None:
+            raise ImportError("The Parquet dataset needs pyarrow")
+        self.dataset_dir = Path(dataset_dir)
+        self.row_group_size = row_group_size
+        # compounds with rows in the part files of previous runs
+        self.stored_compounds = read_compounds(self.dataset_dir)
+        # partition directory: _Partition
+        self._partitions = {}
+        # compound name: list of (partition directory, DataFrame) until the spectrum row is added
+        self._pending = {}
+        self._buffered_rows = 0
+        self._lock = threading.Lock()
+
+    def add(self, table, compound_name, df: pd.DataFrame, masst=None):
+        """
+        :param table: table name, e.g., matches or counts
+        :param df: rows of this compound, columns that do not fit the partition schema are widened, see to_arrow
+        :param masst: SpecialMasst prefix of tables that depend on the MASST
+        """
+        if df is None or len(df) == 0:
+            return
+        df = df.copy()
+        df.insert(0, "compound", compound_name)
+        partition_dir = self.dataset_dir / "table={}".format(table)
+        if masst is not None:
+            partition_dir = partition_dir / "masst={}".format(masst)
+        with self._lock:
+            self._pending.setdefault(compound_name, []).append((partition_dir, df))
+
+    def add_spectrum(self, compound_name, input_label, params_label, usi=None):
+        """
+        Adds the spectrum row, the last row of a compound, and buffers all rows of the compound for writing
+        """
+        self.add(
+            SPECTRUM_TABLE,
+            compound_name,
+            pd.DataFrame(
+                {
+                    "input_label": [input_label],
+                    "params_label": [params_label],
+                    "USI": [usi],
+                }
+            ),
+        )
+        with self._lock:
+            pending = self._pending.pop(compound_name, [])
+            if compound_name in self.stored_compounds:
+                # already written by a previous run
+                return
+            for partition_dir, df in pending:
+                partition = self._partitions.get(partition_dir)
+                if partition is None:
+                    partition = _Partition(partition_dir, infer_schema(df))
+                    self._partitions[partition_dir] = partition
+                partition.add(df)
+                self._buffered_rows += len(df)
+            if self._buffered_rows >= self.row_group_size:
+                self._flush()
+
+    def has_compound(self, compound_name) -> bool:
+        """
+        :return: True if the rows of the compound were written by a previous run
+        """
+        return compound_name in self.stored_compounds
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._partitions = {}
+            if self._pending:
+                logger.warning(
+                    "Skipping rows of %d spectra without a spectrum row",
+                    len(self._pending),
+                )
+                self._pending = {}
+        logger.info("Wrote Parquet dataset %s", self.dataset_dir)
+
+    def _flush(self):
+        written = [partition.write() for partition in self._partitions.values()]
+        for tmp_file, file in written:
+            if tmp_file is not None:
+                os.replace(tmp_file, file)
+        self._buffered_rows = 0
+
+
+class _Partition:
+    def __init__(self, partition_dir: Path, schema):
+        self.partition_dir = partition_dir
+        self.schema = schema
+        self._tables = []
+        partition_dir.mkdir(parents=True, exist_ok=True)
+
+    def add(self, df: pd.DataFrame):
+        table = to_arrow(df, self.schema)
+        if not table.schema.equals(self.schema):
+            # widened or additional columns
+            self.schema = table.schema
+            self._tables = [conform(buffered, self.schema) for buffered in self._tables]
+        self._tables.append(table)
+
+    def write(self) -> tuple[Path | None, Path | None]:
+        """
+        Writes the buffered rows to a hidden file
+        :return: (hidden file, file to rename it to) or (None, None) without buffered rows
+        """
+        if not self._tables:
+            return None, None
+        n = 0
+        while (self.partition_dir / "part-{}.parquet".format(n)).exists():
+            n += 1
+        file = self.partition_dir / "part-{}.parquet".format(n)
+        # overwrites the unfinished file of a crashed flush
+        tmp_file = self.partition_dir / ".part-{}.parquet".format(n)
+        pq.write_table(pa.concat_tables(self._tables), str(tmp_file))
+        self._tables = []
+        return tmp_file, file
+
+
+def infer_schema(df: pd.DataFrame):
+    """
+    Integer and float columns stay numeric, all other columns are strings so that later spectra with other types
+    or only missing values still fit the schema
+    """
+    fields = []
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append((str(col), arrow_type))
+    return pa.schema(fields)
+
+
+def to_arrow(df: pd.DataFrame, schema):
+    """
+    :return: table with the fields of the schema, missing columns are null. Columns that do not fit the schema are
+    widened from integer to float to string and additional columns are appended, no values are dropped
+    """
+    fields = []
+    arrays = []
+    for field in schema:
+        if field.name in df.columns:
+            array = _to_array(df[field.name], field.type)
+        else:
+            array = pa.nulls(len(df), type=field.type)
+        fields.append(pa.field(field.name, array.type))
+        arrays.append(array)
+    for field in infer_schema(
+        df[[col for col in df.columns if col not in schema.names]]
+    ):
+        array = _to_array(df[field.name], field.type)
+        fields.append(pa.field(field.name, array.type))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def _to_array(values: pd.Series, arrow_type):
+    for candidate in [arrow_type] + _wider_types(arrow_type):
+        if pa.types.is_string(candidate):
+            return pa.array(
+                [None if pd.isna(value) else str(value) for value in values],
+                type=candidate,
+            )
+        try:
+            return pa.array(values, type=candidate, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # e.g., fractional values in a column that was integer in the first spectrum
+            logger.debug("Column %s does not fit %s", values.name, candidate)
+
+
+def _wider_types(arrow_type) -> list:
+    if pa.types.is_integer(arrow_type):
+        return [pa.float64(), pa.string()]
+    if pa.types.is_string(arrow_type):
+        return []
+    return [pa.string()]
+
+
+def widen_type(type_a, type_b):
+    """
+    :return: type that holds the values of both types - integer, float, string
+    """
+    if type_a.equals(type_b) or pa.types.is_null(type_b):
+        return type_a
+    if pa.types.is_null(type_a):
+        return type_b
+    numeric = (pa.types.is_integer, pa.types.is_floating)
+    if any(is_a(type_a) for is_a in numeric) and any(is_b(type_b) for is_b in numeric):
+        return pa.float64()
+    return pa.string()
+
+
+def widen_schema(schema, other):
+    """
+    :return: schema with the widened fields of both schemas and the additional fields of other
+    """
+    fields = []
+    for field in schema:
+        if field.name in other.names:
+            field = pa.field(
+                field.name, widen_type(field.type, other.field(field.name).type)
+            )
+        fields.append(field)
+    fields += [field for field in other if field.name not in schema.names]
+    return pa.schema(fields)
+
+
+def conform(table, schema):
+    """
+    :return: table cast to a widened schema, missing columns are null
+    """
+    arrays = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(len(table), type=field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def open_dataset(directory):
+    """
+    :param directory: directory of a table or partition
+    :return: pyarrow dataset with the widened schema of all part files
+    """
+    dataset = ds.dataset(str(directory), format="parquet", partitioning="hive")
+    schema = dataset.schema
+    for fragment in dataset.get_fragments():
+        schema = widen_schema(schema, fragment.physical_schema)
+    if schema.equals(dataset.schema):
+        return dataset
+    return ds.dataset(
+        str(directory), format="parquet", partitioning="hive", schema=schema
+    )
+
+
+def read_compounds(dataset_dir) -> set:
+    """
+    :return: names of the compounds with a spectrum row in the dataset
+    """
+    spectrum_dir = Path(dataset_dir, "table={}".format(SPECTRUM_TABLE))
+    if ds is None or not spectrum_dir.is_dir():
+        return set()
+    dataset = open_dataset(spectrum_dir)
+    if "compound" not in dataset.schema.names:
+        return set()
+    return set(dataset.to_table(columns=["compound"])["compound"].to_pylist())
+
+
+def read_dataset(
+    dataset_dir, table, masst=None, columns=None, filter=None
+) -> pd.DataFrame:
+    """
+    Reads one table in a single scan. Partitions are selected by their directory and filters on other columns are
+    pushed down to the row groups.
+    :param masst: SpecialMasst prefix, all MASSTs of the table if None (their columns might differ)
+    :param filter: pyarrow.dataset expression, e.g., ds.field("compound") == "name"
+    :return: DataFrame of the table with a masst column for MASST tables
+    """
+    if ds is None:
+        raise ImportError("The Parquet dataset needs pyarrow")
+    table_dir = Path(dataset_dir, "table={}".format(table))
+    if masst is not None:
+        table_dir = table_dir / "masst={}".format(masst)
+    if not table_dir.is_dir():
+        return pd.DataFrame()
+    dataset = open_dataset(table_dir)
+    result = dataset.to_table(columns=columns, filter=filter).to_pandas()
+    if masst is not None and "masst" not in result.columns:
+        result["masst"] = masst
+    return result
+
+
+def list_massts(dataset_dir, table):
+    """
+    :return: the MASST prefixes with a partition of this table
+    """
+    table_dir = Path(dataset_dir, "table={}".format(table))
+    if not table_dir.is_dir():
+        return []
+    return sorted(
+        path.name.split("=", 1)[1]
+        for path in table_dir.iterdir()
+        if path.is_dir() and path.name.startswith("masst=")
+    )
@@ -21,14 +21,48 @@ class NpEncoder(json.JSONEncoder):
             return super(NpEncoder, self).default(obj)
 
 
-def update_group_size(node, metadata_df, node_key="NCBI", data_key="Taxa_NCBI"):
-    group_size = (metadata_df[data_key].values == node[node_key]).sum()
-    # apply to all children
-    if "children" in node:
-        for child in node["children"]:
-            group_size += update_group_size(child, metadata_df, node_key, data_key)
-    node["group_size"] = group_size
-    return group_size
+def update_group_size(node, metadata_df, node_key="NCBI", data_key="Taxa_NCBI", id_counts=None):
+    """
+    Sets the group_size of each node to the number of metadata rows of the node and its subtree. The rows are counted
+    once per ID and summed up in one post-order pass instead of scanning the metadata for each node.
+    :param id_counts: dict of ID and number of metadata rows, see count_ids
+    :return: group_size of node
+    """
+    if id_counts is None:
+        id_counts = count_ids(metadata_df, data_key)
+    # iterative post-order: all children are set before their parent
+    stack = [(node, False)]
+    while stack:
+        current, leaving = stack.pop()
+        children = current.get("children", [])
+        if leaving:
+            current["group_size"] = id_counts.get(current[node_key], 0) + sum(
+                child["group_size"] for child in children
+            )
+        else:
+            stack.append((current, True))
+            stack.extend((child, False) for child in children)
+    return node["group_size"]
+
+
+def count_ids(metadata_df, data_key="Taxa_NCBI") -> dict:
+    """
+    :return: dict of ID and number of metadata rows
+    """
+    return metadata_df[data_key].value_counts(sort=False).to_dict()
+
+
+def get_id_set(node, node_key="NCBI") -> set:
+    """
+    :return: IDs of all nodes in the tree
+    """
+    ids = set()
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        ids.add(current[node_key])
+        stack.extend(current.get("children", []))
+    return ids
 
 
 def get_all_ids(ncbi_ids, node, node_key="NCBI"):
@@ -53,9 +87,10 @@ def update_metadata_on_tree(
             # ensure that the grouping columns are strings as we usually match string ids
             df[data_key] = df[data_key].astype(str)
 
-            update_group_size(treeRoot, df, node_key, data_key)
-            ids = get_all_ids(list(), treeRoot, node_key)
-            not_in_tree_df = df[~df[data_key].isin(ids)]
+            id_counts = count_ids(df, data_key)
+            update_group_size(treeRoot, df, node_key, data_key, id_counts)
+            not_in_tree_ids = set(id_counts).difference(get_id_set(treeRoot, node_key))
+            not_in_tree_df = df[df[data_key].isin(not_in_tree_ids)]
             not_in_tree_df.to_csv("../data/not_in_tree.csv", index=False)
 
         with open(in_ontology, "w") as file:
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import logging
+from collections import Counter
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class QueryDeduplicator:
+    """
+    Shares fastMASST responses between queries with the same canonical request key, e.g., the same consensus spectrum
+    exported under several feature IDs or a library ID that is listed multiple times. With expected counts, only keys
+    that were counted more than once before the run are tracked and their responses are kept until all expected
+    queries consumed them. Without expected counts, e.g., for spectra streamed from an MGF, all keys are tracked and
+    the most recent responses are kept. The first query of a key sends the request and concurrent queries of the
+    same key wait for it. At most max_entries responses are kept - evicted keys are simply requested again.
+    """
+
+    def __init__(self, expected_counts: dict = None, max_entries=1000):
+        """
+        :param expected_counts: dict of request key and the number of expected queries, None tracks all keys
+        :param max_entries: maximum number of responses kept in memory
+        """
+        self.remaining = (
+            None
+            if expected_counts is None
+            else {key: count for key, count in expected_counts.items() if count > 1}
+        )
+        self.max_entries = max_entries
+        self.requests = 0
+        self.saved = 0
+        self._responses = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def tracks(self, key) -> bool:
+        return self.remaining is None or key in self.remaining
+
+    def fetch(self, key, fetch_function):
+        """
+        :param key: canonical request key
+        :param fetch_function: function without arguments that sends the request and returns the response content
+        :return: the response content
+        """
+        future, owner = self._claim(key)
+        if not owner:
+            return future.result()
+        try:
+            content = fetch_function()
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise e
+        self._finish(key, future, content=content)
+        return content
+
+    async def fetch_async(self, key, fetch_coroutine_function):
+        """
+        Non-blocking version of fetch for the asyncio batch engine
+        :param fetch_coroutine_function: async function without arguments that returns the response content
+        :return: the response content
+        """
+        future, owner = self._claim(key)
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            content = await fetch_coroutine_function()
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise e
+        self._finish(key, future, content=content)
+        return content
+
+    def release(self, key):
+        """
+        Consumes an expected query of the key that does not send its request, e.g., a skipped library search, so that
+        its response is not kept for it
+        """
+        with self._lock:
+            self._consume(key)
+            if not self._expects(key):
+                self._responses.pop(key, None)
+
+    def report(self) -> str:
+        return (
+            "Deduplication saved {} of {} fastMASST queries of duplicate inputs".format(
+                self.saved, self.requests + self.saved
+            )
+        )
+
+    def _claim(self, key) -> tuple[Future, bool]:
+        """
+        :return: (future of the response, True if the caller needs to send the request)
+        """
+        with self._lock:
+            self._consume(key)
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                self.saved += 1
+                future = Future()
+                future.set_result(self._responses[key])
+                if not self._expects(key):
+                    del self._responses[key]
+                return future, False
+            if key in self._in_flight:
+                self.saved += 1
+                return self._in_flight[key], False
+            self.requests += 1
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _finish(self, key, future: Future, content=None, error: Exception = None):
+        with self._lock:
+            del self._in_flight[key]
+            if error is None and self._expects(key):
+                self._responses[key] = content
+                if len(self._responses) > self.max_entries:
+                    self._responses.popitem(last=False)
+        # waiting queries of the same key share the result or error
+        if error is None:
+            future.set_result(content)
+        else:
+            future.set_exception(error)
+
+    def _consume(self, key):
+        if self.remaining is None:
+            return
+        remaining = self.remaining.get(key)
+        if remaining is not None:
+            self.remaining[key] = remaining - 1
+
+    def _expects(self, key) -> bool:
+        """
+        :return: True if later queries of the key may reuse its response
+        """
+        return self.remaining is None or self.remaining.get(key, 0) > 0
+
+
+def count_keys(keys) -> dict:
+    """
+    :param keys: iterable of request keys, None is ignored
+    :return: dict of key and number of occurrences
+    """
+    return Counter(key for key in keys if key is not None)
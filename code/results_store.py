@@ -0,0 +1,314 @@
+import os
+import shutil
+import threading
+import logging
+from pathlib import Path
+import pandas as pd
+
+from utils import prepare_paths
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pc = None
+    pq = None
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# table column of the store
+SPECTRUM_TABLE = "spectrum"
+MATCHES_TABLE = "matches"
+LIBRARY_TABLE = "library"
+DATASETS_TABLE = "datasets"
+NODES_TABLE = "nodes"
+# metadata matches of each SpecialMasst, only written to the Parquet dataset, see parquet_dataset
+COUNTS_TABLE = "counts"
+STORE_TABLES = [
+    SPECTRUM_TABLE,
+    MATCHES_TABLE,
+    LIBRARY_TABLE,
+    DATASETS_TABLE,
+    NODES_TABLE,
+]
+
+# all tables share one schema, columns that do not belong to a table are null
+STRING_COLUMNS = [
+    "table",
+    "compound",
+    "masst",
+    "input_label",
+    "params_label",
+    "USI",
+    "Status",
+    "GNPSLibraryAccession",
+    "CompoundName",
+    "Adduct",
+    "Charge",
+    "Dataset",
+    "node_id",
+    "matches_json",
+]
+FLOAT_COLUMNS = ["Delta Mass", "Cosine"]
+INT_COLUMNS = ["Matching Peaks", "Frequency", "node_index", "matched_size"]
+
+
+def default_results_file(out_filename_no_ext):
+    return "{}_results.parquet".format(out_filename_no_ext)
+
+
+def results_schema():
+    return pa.schema(
+        [(col, pa.string()) for col in STRING_COLUMNS]
+        + [(col, pa.float64()) for col in FLOAT_COLUMNS]
+        + [(col, pa.int64()) for col in INT_COLUMNS]
+    )
+
+
+class ResultsStore:
+    """
+    One Parquet file with the matches, library matches, dataset matches, and matched tree nodes of all spectra of a
+    batch run. Rows are tagged with the table and compound name (and the MASST prefix for tree nodes). The rows of a
+    spectrum are held back until its spectrum row is added, which process_matches does last. Complete spectra are
+    buffered and each row group is written to its own file in {results_file}.parts, so that a crash keeps all
+    written row groups. On close, or when a crashed run is resumed, the parts are merged into results_file, see
+    results_viewer for a single HTML viewer of all spectra.
+    """
+
+    def __init__(self, results_file, resume=False, row_group_size=100000):
+        """
+        :param resume: keep the rows of an existing results file and of the parts of a crashed run, e.g., when
+        skipping finished spectra. Otherwise, both are replaced
+        :param row_group_size: rows are buffered and written in row groups of this size
+        """
+        if pa is None:
+            raise ImportError("The results store needs pyarrow")
+        self.results_file = str(results_file)
+        self.parts_dir = Path(self.results_file + ".parts")
+        self.row_group_size = row_group_size
+        self.schema = results_schema()
+        self._tables = []
+        self._buffered_rows = 0
+        # compound name: list of tables until the spectrum row is added
+        self._pending = {}
+        self._lock = threading.Lock()
+        prepare_paths(file=self.results_file)
+        if resume:
+            if self._part_files():
+                logger.info(
+                    "Recovering the results of a previous run in %s", self.parts_dir
+                )
+                self._merge()
+        else:
+            Path(self.results_file).unlink(missing_ok=True)
+            shutil.rmtree(self.parts_dir, ignore_errors=True)
+        # compounds with rows in the results file
+        self.stored_compounds = read_compounds(self.results_file)
+        if self.stored_compounds:
+            logger.info(
+                "Keeping {} spectra of {}".format(
+                    len(self.stored_compounds), self.results_file
+                )
+            )
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+
+    def add_spectrum(self, compound_name, input_label, params_label, usi=None):
+        """
+        Adds the spectrum row, the last row of a compound, and buffers all rows of the compound for writing
+        """
+        self.add(
+            SPECTRUM_TABLE,
+            compound_name,
+            pd.DataFrame(
+                {
+                    "input_label": [input_label],
+                    "params_label": [params_label],
+                    "USI": [usi],
+                }
+            ),
+        )
+        with self._lock:
+            pending = self._pending.pop(compound_name, [])
+            if compound_name in self.stored_compounds:
+                # already written by a previous run
+                return
+            for table in pending:
+                self._tables.append(table)
+                self._buffered_rows += len(table)
+            if self._buffered_rows >= self.row_group_size:
+                self._flush()
+
+    def add(self, table, compound_name, df: pd.DataFrame, masst=None):
+        """
+        :param table: one of the *_TABLE names, tables that are not in STORE_TABLES are skipped
+        :param df: rows of this compound, columns that are not in the schema are dropped
+        :param masst: SpecialMasst prefix of tree nodes
+        """
+        if df is None or len(df) == 0 or table not in STORE_TABLES:
+            return
+        arrays = []
+        for field in self.schema:
+            if field.name == "table":
+                values = [table] * len(df)
+            elif field.name == "compound":
+                values = [compound_name] * len(df)
+            elif field.name == "masst":
+                values = [masst] * len(df)
+            elif field.name in df.columns:
+                values = _column_values(df[field.name], field.type)
+            else:
+                values = [None] * len(df)
+            arrays.append(pa.array(values, type=field.type, from_pandas=True))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        with self._lock:
+            self._pending.setdefault(compound_name, []).append(table)
+
+    def has_compound(self, compound_name) -> bool:
+        """
+        :return: True if the rows of the compound were written by a previous run
+        """
+        return compound_name in self.stored_compounds
+
+    def close(self):
+        """
+        Writes the remaining rows and merges all parts into results_file
+        """
+        with self._lock:
+            if not self.parts_dir.is_dir():
+                # already closed
+                return
+            if self._pending:
+                logger.warning(
+                    "Skipping rows of %d spectra without a spectrum row",
+                    len(self._pending),
+                )
+                self._pending = {}
+            self._flush()
+            self._merge()
+        logger.info("Wrote results store %s", self.results_file)
+
+    def _flush(self):
+        if not self._tables:
+            return
+        n = len(self._part_files())
+        # written completely before it is visible as a part
+        tmp_file = self.parts_dir / ".part-{}.parquet".format(n)
+        pq.write_table(pa.concat_tables(self._tables), str(tmp_file))
+        os.replace(tmp_file, self.parts_dir / "part-{}.parquet".format(n))
+        self._tables = []
+        self._buffered_rows = 0
+
+    def _merge(self):
+        """
+        Writes the rows of results_file and all parts to {results_file}.tmp, moves it to results_file, and removes
+        the parts. Parts of compounds that are already in results_file were merged before a crash and are skipped.
+        """
+        previous_file = Path(self.results_file)
+        merged_compounds = read_compounds(self.results_file)
+        tmp_file = self.results_file + ".tmp"
+        writer = pq.ParquetWriter(tmp_file, self.schema)
+        if previous_file.is_file():
+            previous = pq.ParquetFile(self.results_file)
+            for i in range(previous.num_row_groups):
+                writer.write_table(previous.read_row_group(i).cast(self.schema))
+        for part_file in self._part_files():
+            part = pq.read_table(str(part_file)).cast(self.schema)
+            if merged_compounds:
+                merged = pc.is_in(
+                    part["compound"], value_set=pa.array(list(merged_compounds))
+                )
+                part = part.filter(pc.invert(merged))
+            writer.write_table(part)
+        writer.close()
+        os.replace(tmp_file, self.results_file)
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+    def _part_files(self) -> list:
+        if not self.parts_dir.is_dir():
+            return []
+        return sorted(
+            self.parts_dir.glob("part-*.parquet"),
+            key=lambda file: int(file.stem.split("-", 1)[1]),
+        )
+
+
+class ResultsWriters:
+    """
+    Passes all rows to several writers with the same interface, e.g., a ResultsStore and a ParquetDataset
+    """
+
+    def __init__(self, writers):
+        self.writers = list(writers)
+
+    def add_spectrum(self, compound_name, input_label, params_label, usi=None):
+        for writer in self.writers:
+            writer.add_spectrum(compound_name, input_label, params_label, usi)
+
+    def add(self, table, compound_name, df: pd.DataFrame, masst=None):
+        for writer in self.writers:
+            writer.add(table, compound_name, df, masst=masst)
+
+    def has_compound(self, compound_name) -> bool:
+        return all(writer.has_compound(compound_name) for writer in self.writers)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class ResultsRecorder:
+    """
+    Records the rows of a post-processing worker process, replay_results adds them to the writer of the parent
+    """
+
+    def __init__(self):
+        # (method name, args, kwargs)
+        self.records = []
+
+    def add_spectrum(self, compound_name, input_label, params_label, usi=None):
+        self.records.append(
+            ("add_spectrum", (compound_name, input_label, params_label, usi), {})
+        )
+
+    def add(self, table, compound_name, df: pd.DataFrame, masst=None):
+        self.records.append(("add", (table, compound_name, df), {"masst": masst}))
+
+
+def replay_results(records, results_store):
+    """
+    :param records: ResultsRecorder.records
+    :param results_store: ResultsStore or ResultsWriters
+    """
+    for method, args, kwargs in records:
+        getattr(results_store, method)(*args, **kwargs)
+
+
+def read_compounds(results_file) -> set:
+    """
+    :return: names of the compounds with a spectrum row in the results file
+    """
+    if pq is None or not Path(results_file).is_file():
+        return set()
+    spectrum_df = read_results(results_file, SPECTRUM_TABLE, columns=["compound"])
+    return set(spectrum_df["compound"])
+
+
+def read_results(results_file, table=None, columns=None) -> pd.DataFrame:
+    """
+    :param table: only read rows of this table
+    :param columns: only read these columns
+    :return: DataFrame of the results store
+    """
+    if pq is None:
+        raise ImportError("The results store needs pyarrow")
+    filters = None if table is None else [("table", "=", table)]
+    return pq.read_table(results_file, columns=columns, filters=filters).to_pandas()
+
+
+def _column_values(series: pd.Series, arrow_type):
+    if pa.types.is_string(arrow_type):
+        return [None if pd.isna(value) else str(value) for value in series]
+    return pd.to_numeric(series, errors="coerce")
@@ -0,0 +1,266 @@
+import sys
+import json
+import argparse
+import logging
+from pathlib import Path
+
+import bundle_to_html
+from json_ontology_extender import NpEncoder
+import masst_registry
+from masst_utils import SPECIAL_MASSTS
+from results_store import read_results
+from results_store import SPECTRUM_TABLE
+from results_store import LIBRARY_TABLE
+from results_store import NODES_TABLE
+from utils import prepare_paths
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# placeholders of collapsible_tree_v3.html, see masst_tree.create_enriched_masst_tree
+PLACEHOLDERS = [
+    "PLACEHOLDER_JSON_DATA",
+    "LIBRARY_JSON_DATA_PLACEHOLDER",
+    "INPUT_LABEL_PLACEHOLDER",
+    "USI_LABEL_PLACEHOLDER",
+    "PARAMS_PLACEHOLDER",
+]
+LIBRARY_COLUMNS = [
+    "USI",
+    "GNPSLibraryAccession",
+    "Cosine",
+    "Matching Peaks",
+    "CompoundName",
+    "Adduct",
+    "Charge",
+]
+
+
+def default_viewer_file(out_filename_no_ext):
+    return "{}_viewer.html".format(out_filename_no_ext)
+
+
+def build_results_viewer(
+    results_file, out_html, in_html="code/collapsible_tree_v3.html"
+):
+    """
+    Creates one HTML file that lists all spectra of the results store and renders the MASST trees of the selected
+    spectrum with the same viewer as the per-spectrum HTML files. The trees are only enriched when a spectrum is
+    selected: the HTML contains each MASST tree once with its group sizes and the matched nodes of each spectrum.
+    The viewer loads the shared assets from its directory, see bundle_to_html.get_shared_template.
+    :param results_file: the Parquet results store of a batch run
+    :param out_html: the viewer HTML
+    :return: out_html
+    """
+    spectra_df = read_results(
+        results_file,
+        SPECTRUM_TABLE,
+        columns=["compound", "input_label", "params_label", "USI"],
+    )
+    library_df = read_results(
+        results_file, LIBRARY_TABLE, columns=["compound"] + LIBRARY_COLUMNS
+    )
+    nodes_df = read_results(
+        results_file,
+        NODES_TABLE,
+        columns=["compound", "masst", "node_index", "matched_size", "matches_json"],
+    )
+
+    spectra = {
+        compound: {
+            "input_label": input_label or "",
+            "params_label": params_label or "",
+            "usi": usi or "",
+            "library": [],
+            "trees": {},
+        }
+        for compound, input_label, params_label, usi in zip(
+            spectra_df["compound"],
+            spectra_df["input_label"],
+            spectra_df["params_label"],
+            spectra_df["USI"],
+        )
+    }
+    for compound, records in library_df.groupby("compound"):
+        if compound in spectra:
+            spectra[compound]["library"] = json.loads(
+                records[LIBRARY_COLUMNS].to_json(orient="records")
+            )
+    for (compound, masst), nodes in nodes_df.groupby(["compound", "masst"]):
+        if compound in spectra:
+            # node index, matched_size, and matches of the matched nodes in pre-order
+            spectra[compound]["trees"][masst] = [
+                [int(index), int(matched_size), matches_json]
+                for index, matched_size, matches_json in zip(
+                    nodes["node_index"], nodes["matched_size"], nodes["matches_json"]
+                )
+            ]
+
+    # each tree once with the group sizes and without matches
+    trees = {}
+    for special_masst in SPECIAL_MASSTS:
+        if special_masst.prefix in set(nodes_df["masst"]):
+            flat_tree = masst_registry.get_flat_tree(special_masst)
+            trees[special_masst.prefix] = flat_tree.to_nested(flat_tree.aggregate({}))
+
+    prepare_paths(file=out_html)
+    template = bundle_to_html.get_shared_template(
+        in_html, PLACEHOLDERS, Path(out_html).parent
+    )
+    data = {
+        "html_start": template.html_start,
+        "html_end": template.html_end,
+        "trees": trees,
+        "spectra": spectra,
+    }
+    # the data must not close the script element
+    data_json = json.dumps(data, cls=NpEncoder).replace("</", "<\\/")
+    Path(out_html).write_text(
+        VIEWER_HTML.replace("VIEWER_TITLE_PLACEHOLDER", Path(out_html).stem).replace(
+            "VIEWER_DATA_PLACEHOLDER", data_json
+        ),
+        encoding="utf-8",
+    )
+    logger.info("Wrote viewer of %d spectra to %s", len(spectra), out_html)
+    return out_html
+
+
+VIEWER_HTML = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>VIEWER_TITLE_PLACEHOLDER</title>
+<style>
+body { margin: 0; display: flex; height: 100vh; font-family: sans-serif; }
+#list { width: 24em; overflow: auto; border-right: 1px solid #ccc; }
+#list input { width: 95%; margin: 4px; }
+#list div { padding: 2px 6px; white-space: nowrap; }
+#list a { cursor: pointer; margin-left: 0.5em; color: #095b85; }
+#list a.selected { font-weight: bold; }
+#viewer { flex: 1; border: none; }
+</style>
+</head>
+<body>
+<div id="list"><input id="filter" placeholder="Filter" type="text"/></div>
+<iframe id="viewer"></iframe>
+<script>
+var data = VIEWER_DATA_PLACEHOLDER;
+var treeJson = {};
+Object.keys(data.trees).forEach(function (masst) {
+    treeJson[masst] = JSON.stringify(data.trees[masst]);
+});
+
+function addPieData(node) {
+    node.occurrence_fraction = node.group_size == 0 ? 0 : node.matched_size / node.group_size;
+    node.pie_data = [0, 1].map(function (index) {
+        return {
+            "occurrence_fraction": index == 0 ? node.occurrence_fraction : 1.0 - node.occurrence_fraction,
+            "index": index,
+            "group_size": node.group_size,
+            "matched_size": node.matched_size
+        };
+    });
+}
+
+// copies the tree and adds the matched nodes of a spectrum, same as FlatTree.to_nested
+function enrichTree(masst, matchedNodes) {
+    var root = JSON.parse(treeJson[masst]);
+    var matched = {};
+    matchedNodes.forEach(function (row) {
+        matched[row[0]] = row;
+    });
+    var index = 0;
+    var stack = [root];
+    while (stack.length > 0) {
+        var node = stack.pop();
+        var row = matched[index++];
+        node.matched_size = row ? row[1] : 0;
+        if (row && row[2]) node.matches = JSON.parse(row[2]);
+        addPieData(node);
+        var children = node.children || [];
+        for (var i = children.length - 1; i >= 0; i--) stack.push(children[i]);
+    }
+    // the root sums up its children
+    root.group_size = 0;
+    root.matched_size = 0;
+    (root.children || []).forEach(function (child) {
+        root.group_size += child.group_size;
+        root.matched_size += child.matched_size;
+    });
+    addPieData(root);
+    return root;
+}
+
+function showTree(compound, masst) {
+    var spectrum = data.spectra[compound];
+    var masstData = {
+        "PLACEHOLDER_JSON_DATA": enrichTree(masst, spectrum.trees[masst]),
+        "LIBRARY_JSON_DATA_PLACEHOLDER": spectrum.library,
+        "INPUT_LABEL_PLACEHOLDER": spectrum.input_label,
+        "USI_LABEL_PLACEHOLDER": spectrum.usi,
+        "PARAMS_PLACEHOLDER": spectrum.params_label
+    };
+    var script = "var MASST_DATA=" + JSON.stringify(masstData).replace(/</g, "\\\\u003c") + ";";
+    document.getElementById("viewer").srcdoc = data.html_start + "<script>" + script + "<\\/script>" + data.html_end;
+}
+
+var list = document.getElementById("list");
+var rows = Object.keys(data.spectra).sort().map(function (compound) {
+    var row = document.createElement("div");
+    row.appendChild(document.createTextNode(compound));
+    Object.keys(data.spectra[compound].trees).forEach(function (masst) {
+        var link = document.createElement("a");
+        link.textContent = masst;
+        link.onclick = function () {
+            list.querySelectorAll("a.selected").forEach(function (other) { other.className = ""; });
+            link.className = "selected";
+            showTree(compound, masst);
+        };
+        row.appendChild(link);
+    });
+    list.appendChild(row);
+    return row;
+});
+document.getElementById("filter").oninput = function () {
+    var text = this.value.toLowerCase();
+    rows.forEach(function (row) {
+        row.style.display = row.firstChild.textContent.toLowerCase().indexOf(text) >= 0 ? "" : "none";
+    });
+};
+</script>
+</body>
+</html>
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create a single HTML viewer for all spectra of a results store"
+    )
+    parser.add_argument(
+        "--results_file",
+        type=str,
+        help="the Parquet results store of a batch run, {out_file}_results.parquet",
+    )
+    parser.add_argument(
+        "--out_html",
+        type=str,
+        help="the viewer HTML file, defaults to {out_file}_viewer.html",
+        default=None,
+    )
+    args = parser.parse_args()
+
+    try:
+        out_html = args.out_html
+        if out_html is None:
+            out_html = default_viewer_file(
+                str(args.results_file).removesuffix("_results.parquet")
+            )
+        build_results_viewer(args.results_file, out_html)
+    except Exception as e:
+        # exit with error
+        logger.exception(e)
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
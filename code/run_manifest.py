@@ -0,0 +1,146 @@
+import os
+import json
+import hashlib
+import threading
+import time
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from utils import prepare_paths
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class RunManifest:
+    """
+    Append-only JSONL manifest of a batch run. Every query writes a started entry and a completed (or failed) entry
+    with the input hash, the parameter hash, the state of each output artifact, and the timing. The manifest is read
+    once into a dict so that resuming a run checks each spectrum in O(1) instead of looking for output files. Spectra
+    that were started but never completed, e.g., after a crash between writing the matches table and the trees, are
+    not completed and run again.
+    """
+
+    def __init__(self, manifest_file, params: dict):
+        self.manifest_file = str(manifest_file)
+        self.params_hash = hash_inputs(params)
+        self.entries = load_manifest(self.manifest_file)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def has_entries(self):
+        return len(self.entries) > 0
+
+    def is_completed(self, compound_name, input_hash) -> bool:
+        entry = self.entries.get(compound_name)
+        return (
+            entry is not None
+            and entry["state"] == "completed"
+            and entry["input_hash"] == input_hash
+            and entry["params_hash"] == self.params_hash
+        )
+
+    def artifacts(self, compound_name) -> dict:
+        """
+        :return: the output artifacts of the latest completed entry, see complete
+        """
+        entry = self.entries.get(compound_name)
+        return {} if entry is None else entry.get("artifacts", {})
+
+    def start(self, compound_name, input_hash) -> float:
+        """
+        :return: the start time to pass to complete or fail
+        """
+        self._append(
+            {
+                "compound_name": compound_name,
+                "input_hash": input_hash,
+                "state": "started",
+            }
+        )
+        return time.monotonic()
+
+    def complete(self, compound_name, input_hash, started, artifacts: dict):
+        """
+        :param artifacts: state of each output artifact, e.g., {"matches": "written", "library": "empty"}
+        """
+        self._append(
+            {
+                "compound_name": compound_name,
+                "input_hash": input_hash,
+                "state": "completed",
+                "artifacts": artifacts,
+                "seconds": round(time.monotonic() - started, 3),
+            }
+        )
+
+    def fail(self, compound_name, input_hash, started, error: Exception):
+        self._append(
+            {
+                "compound_name": compound_name,
+                "input_hash": input_hash,
+                "state": "failed",
+                "error": "{}: {}".format(type(error).__name__, error),
+                "seconds": round(time.monotonic() - started, 3),
+            }
+        )
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _append(self, entry: dict):
+        entry["params_hash"] = self.params_hash
+        entry["time"] = datetime.now().isoformat(timespec="seconds")
+        line = json.dumps(entry)
+        with self._lock:
+            if self._file is None:
+                prepare_paths(file=self.manifest_file)
+                self._file = open(self.manifest_file, "a", encoding="utf-8")
+                if not ends_with_newline(self.manifest_file):
+                    # end the truncated last line of a crashed run
+                    self._file.write("\n")
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.entries[entry["compound_name"]] = entry
+
+
+def load_manifest(manifest_file) -> dict:
+    """
+    :return: dict of compound name and its latest manifest entry
+    """
+    entries = {}
+    if not Path(manifest_file).is_file():
+        return entries
+    with open(manifest_file, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+                entries[entry["compound_name"]] = entry
+            except (ValueError, KeyError):
+                # last line might be truncated after a crash
+                logger.warning("Skipping invalid manifest line in %s", manifest_file)
+    return entries
+
+
+def ends_with_newline(file) -> bool:
+    """
+    :return: True if the file is empty or ends with a newline
+    """
+    with open(file, "rb") as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def hash_inputs(inputs) -> str:
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def default_manifest_file(out_filename_no_ext):
+    return "{}_manifest.jsonl".format(out_filename_no_ext)
@@ -0,0 +1,81 @@
+import sys
+import time
+import random
+import argparse
+import logging
+from pathlib import Path
+
+# run from the repository root: python code/scripts/benchmark_file_usi.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import usi_utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def random_usis(n_matches, n_files):
+    """
+    :return: match USIs with scans, matches of popular compounds hit the same files many times
+    """
+    files = [
+        "mzspec:MSV{:09d}:peak/sample_{}/file_{}.mzML".format(
+            random.randint(1, 500), i % 7, i
+        )
+        for i in range(n_files)
+    ]
+    return [
+        "{}:scan:{}".format(random.choice(files), random.randint(1, 5000))
+        for _ in range(n_matches)
+    ]
+
+
+def best_seconds(function, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def run_benchmark(n_matches=50000, n_files=5000, repeats=5):
+    random.seed(1)
+    usis = random_usis(n_matches, n_files)
+    scalar_seconds, scalar_result = best_seconds(
+        lambda: [usi_utils.ensure_simple_file_usi(usi) for usi in usis], repeats
+    )
+    usi_utils.clear_file_usi_cache()
+    cold_seconds, _ = best_seconds(lambda: usi_utils.ensure_simple_file_usis(usis), 1)
+    # later spectra find their files in the cache
+    cached_seconds, cached_result = best_seconds(
+        lambda: usi_utils.ensure_simple_file_usis(usis), repeats
+    )
+    logger.info(
+        "%d matches in %d files: per row %.1f ms, column %.1f ms (%.1fx), cached files %.1f ms (%.0fx), "
+        "identical output: %s",
+        n_matches,
+        n_files,
+        scalar_seconds * 1000,
+        cold_seconds * 1000,
+        scalar_seconds / cold_seconds,
+        cached_seconds * 1000,
+        scalar_seconds / cached_seconds,
+        scalar_result == list(cached_result),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the file USI normalization of fastMASST matches"
+    )
+    parser.add_argument(
+        "--matches", type=int, help="number of match USIs", default=50000
+    )
+    parser.add_argument(
+        "--files", type=int, help="number of distinct files", default=5000
+    )
+    parser.add_argument("--repeats", type=int, help="repeats", default=5)
+    args = parser.parse_args()
+    run_benchmark(args.matches, args.files, args.repeats)
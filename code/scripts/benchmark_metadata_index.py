@@ -0,0 +1,115 @@
+import sys
+import time
+import random
+import argparse
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+# run from the repository root: python code/scripts/benchmark_metadata_index.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import metadata_index
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PREFIXES = ["food", "microbe", "plant", "tissue", "personalCareProduct", "microbiome"]
+
+
+def random_metadata(n_files):
+    """
+    :return: metadata tables indexed by file_usi, each table holds a part of all files
+    """
+    files = np.array(
+        [
+            "mzspec:MSV{:09d}:peak/file_{}.mzML".format(i % 3000, i)
+            for i in range(n_files)
+        ],
+        dtype=object,
+    )
+    tables = []
+    for code in range(len(PREFIXES)):
+        usis = files[np.random.rand(n_files) < 0.3]
+        tables.append(
+            pd.DataFrame(
+                {"node_id": np.random.randint(0, 1000, len(usis))},
+                index=pd.Index(usis, name="file_usi"),
+            )
+        )
+    return files, tables
+
+
+def best_seconds(function, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def run_benchmark(n_files=2000000, n_matches=20000, repeats=5):
+    np.random.seed(1)
+    random.seed(1)
+    files, tables = random_metadata(n_files)
+    matches_df = pd.DataFrame(
+        {"file_usi": random.sample(list(files), n_matches), "Cosine": 0.9}
+    )
+
+    def concat_joins():
+        # previous per MASST join, see masst_tree.export_metadata_matches
+        return [
+            len(
+                pd.concat(
+                    [matches_df.set_index("file_usi"), table], axis=1, join="inner"
+                )
+            )
+            for table in tables
+        ]
+
+    start = time.perf_counter()
+    index = metadata_index.create_metadata_index(
+        PREFIXES, [table.index for table in tables]
+    )
+    build_seconds = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as index_dir:
+        metadata_index.write_metadata_index(index, index_dir, special_massts=[])
+        start = time.perf_counter()
+        index = metadata_index.load_metadata_index(index_dir, special_massts=[])
+        load_seconds = time.perf_counter() - start
+
+        def index_lookup():
+            match_rows, massts, rows = index.lookup(matches_df["file_usi"])
+            return [int((massts == code).sum()) for code in range(len(PREFIXES))]
+
+        concat_seconds, concat_result = best_seconds(concat_joins, repeats)
+        index_seconds, index_result = best_seconds(index_lookup, repeats)
+    logger.info(
+        "%d matches in %d metadata files: build %.0f ms, load %.1f ms, concat joins %.1f ms, index lookup %.1f ms "
+        "(%.0fx), identical output: %s",
+        n_matches,
+        n_files,
+        build_seconds * 1000,
+        load_seconds * 1000,
+        concat_seconds * 1000,
+        index_seconds * 1000,
+        concat_seconds / index_seconds,
+        concat_result == index_result,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the join of fastMASST matches with the metadata tables"
+    )
+    parser.add_argument(
+        "--files", type=int, help="number of distinct metadata files", default=2000000
+    )
+    parser.add_argument("--matches", type=int, help="number of matches", default=20000)
+    parser.add_argument("--repeats", type=int, help="repeats", default=5)
+    args = parser.parse_args()
+    run_benchmark(args.files, args.matches, args.repeats)
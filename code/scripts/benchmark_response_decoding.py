@@ -0,0 +1,111 @@
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+import tracemalloc
+from pathlib import Path
+
+# run from the repository root: python code/scripts/benchmark_response_decoding.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import masst_utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def random_response(n_results) -> bytes:
+    """
+    :return: fastMASST response content with all fields of a match
+    """
+    results = []
+    for i in range(n_results):
+        file = i % 5000
+        dataset = "MSV{:09d}".format(file % 500)
+        results.append(
+            {
+                "Delta Mass": round(random.uniform(-0.05, 0.05), 4),
+                "USI": "mzspec:{}:file_{}.mzML:scan:{}".format(dataset, file, i),
+                "Charge": 1,
+                "Cosine": round(random.uniform(0.7, 1.0), 4),
+                "Matching Peaks": random.randint(3, 20),
+                "Unit Delta Mass": 0,
+                "Query Scan": 1,
+                "Query Filename": "query.mgf",
+                "Index UnitPM": random.randint(0, 2000),
+                "Index IdxInUnitPM": random.randint(0, 2000),
+                "Filtered Input Spectrum Path": "/data/{}/file_{}.mzML".format(
+                    dataset, file
+                ),
+                "Dataset": dataset,
+                "Status": "NA",
+                "mzs": [round(random.uniform(50, 500), 4) for _ in range(20)],
+                "intensities": [round(random.uniform(0, 1), 4) for _ in range(20)],
+            }
+        )
+    return json.dumps({"results": results, "grouped_by_dataset": []}).encode()
+
+
+def previous_decoding(content):
+    results_dict = json.loads(content)
+    return masst_utils.extract_matches_from_masst_results(
+        results_dict, 0.05, 3, False, True
+    )
+
+
+def columnar_decoding(content):
+    results_dict = masst_utils.decode_response(content)
+    return masst_utils.extract_matches_from_masst_results(
+        results_dict, 0.05, 3, False, True, columns=masst_utils.MATCH_RESULT_COLUMNS
+    )
+
+
+def measure(function, content, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(content)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    tracemalloc.start()
+    function(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def run_benchmark(n_results=100000, repeats=3):
+    random.seed(1)
+    content = random_response(n_results)
+    previous_seconds, previous_peak, previous_df = measure(
+        previous_decoding, content, repeats
+    )
+    columnar_seconds, columnar_peak, columnar_df = measure(
+        columnar_decoding, content, repeats
+    )
+    logger.info(
+        "%d results (%d MB): json and full frame %.0f ms, peak %.0f MB; %s and selected columns %.0f ms, "
+        "peak %.0f MB; identical matches: %s",
+        n_results,
+        len(content) // 1000000,
+        previous_seconds * 1000,
+        previous_peak / 1e6,
+        "orjson" if masst_utils.orjson is not None else "json",
+        columnar_seconds * 1000,
+        columnar_peak / 1e6,
+        columnar_df.equals(previous_df[columnar_df.columns]),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark decoding fastMASST responses into the matches DataFrame"
+    )
+    parser.add_argument(
+        "--results", type=int, help="number of matches in the response", default=100000
+    )
+    parser.add_argument("--repeats", type=int, help="repeats", default=3)
+    args = parser.parse_args()
+    run_benchmark(args.results, args.repeats)
@@ -0,0 +1,203 @@
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+# run from the repository root: python code/scripts/benchmark_tree_enrichment.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import json_ontology_extender
+import masst_registry
+from masst_utils import SPECIAL_MASSTS
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def legacy_add_data_to_node(
+    node, meta_matched_df: pd.DataFrame, node_field, data_field
+):
+    """
+    Previous implementation with a boolean scan of the matches per node for comparison
+    """
+    try:
+        ncbi = node.get(node_field)
+        if ncbi is not None:
+            filtered = meta_matched_df[meta_matched_df[data_field] == str(ncbi)]
+            if len(filtered) > 0:
+                rowi = filtered.index[0]
+                for col, value in meta_matched_df.items():
+                    if col == "matches_json":
+                        node["matches"] = json.loads(value[rowi])
+                    elif col != data_field:
+                        node[col] = value[rowi]
+    except Exception as ex:
+        logger.exception(ex)
+    if "children" in node:
+        for child in node["children"]:
+            legacy_add_data_to_node(child, meta_matched_df, node_field, data_field)
+
+
+def legacy_enrich(tree, matches_df, node_field, data_field):
+    """
+    Previous recursive passes of add_data_to_ontology_file for comparison
+    """
+    tree = masst_registry.copy_tree(tree)
+    json_ontology_extender.add_data_to_node(tree, matches_df, node_field, data_field)
+    json_ontology_extender.field_missing(tree, node_field, replace_with_field="name")
+    if json_ontology_extender.field_missing(tree, "group_size") > 0:
+        json_ontology_extender.accumulate_field_in_parents(tree, "group_size")
+    if json_ontology_extender.field_missing(tree, "matched_size") > 0:
+        json_ontology_extender.accumulate_field_in_parents(tree, "matched_size")
+    json_ontology_extender.calc_stats(tree)
+    json_ontology_extender.calc_root_stats(tree)
+    json_ontology_extender.add_pie_data_to_node_and_children(tree)
+    return tree
+
+
+def best_seconds(function, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def node_ids(node, node_field):
+    ids = [] if node.get(node_field) is None else [str(node[node_field])]
+    for child in node.get("children", []):
+        ids += node_ids(child, node_field)
+    return ids
+
+
+def random_matches(tree, node_field, data_field, n_matched) -> pd.DataFrame:
+    """
+    :return: matches grouped by ID like masst_tree.group_matches
+    """
+    ids = node_ids(tree, node_field)
+    matched = random.sample(ids, min(n_matched, len(ids)))
+    return pd.DataFrame(
+        {
+            data_field: matched,
+            "matched_size": [random.randint(1, 20) for _ in matched],
+            "matches_json": [
+                json.dumps(
+                    [
+                        {
+                            "USI": "mzspec:X:{}".format(i),
+                            "Cosine": 0.9,
+                            "Matching Peaks": 5,
+                        }
+                    ]
+                )
+                for i, _ in enumerate(matched)
+            ],
+        }
+    )
+
+
+def time_enrichment(function, tree, matches_df, node_field, data_field, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        enriched = masst_registry.copy_tree(tree)
+        function(enriched, matches_df, node_field, data_field)
+    return (time.perf_counter() - start) / repeats, enriched
+
+
+def run_benchmark(n_matched=300, repeats=5):
+    random.seed(1)
+    for special_masst in SPECIAL_MASSTS:
+        if not Path(special_masst.tree_file).is_file():
+            logger.info(
+                "Skipping %s, missing %s", special_masst.prefix, special_masst.tree_file
+            )
+            continue
+        tree = masst_registry.get_tree_template(special_masst)
+        node_field = special_masst.tree_node_key
+        data_field = special_masst.metadata_key
+        matches_df = random_matches(tree, node_field, data_field, n_matched)
+
+        legacy_seconds, legacy_tree = time_enrichment(
+            legacy_add_data_to_node, tree, matches_df, node_field, data_field, repeats
+        )
+        indexed_seconds, indexed_tree = time_enrichment(
+            json_ontology_extender.add_data_to_node,
+            tree,
+            matches_df,
+            node_field,
+            data_field,
+            repeats,
+        )
+        identical = json.dumps(
+            legacy_tree, cls=json_ontology_extender.NpEncoder
+        ) == json.dumps(indexed_tree, cls=json_ontology_extender.NpEncoder)
+        logger.info(
+            "%s: %d nodes, %d matched: scan %.1f ms, indexed %.1f ms (%.0fx), identical output: %s",
+            special_masst.prefix,
+            len(node_ids(tree, node_field)),
+            len(matches_df),
+            legacy_seconds * 1000,
+            indexed_seconds * 1000,
+            legacy_seconds / indexed_seconds,
+            identical,
+        )
+
+        # all passes: recursive dict walks vs. FlatTree arrays
+        flat_tree = masst_registry.get_flat_tree(special_masst)
+        indexed_rows = json_ontology_extender.index_rows(matches_df, data_field)
+        recursive_seconds, recursive_tree = best_seconds(
+            lambda: legacy_enrich(tree, matches_df, node_field, data_field), repeats
+        )
+        aggregate_seconds, counts = best_seconds(
+            lambda: flat_tree.aggregate(indexed_rows), repeats
+        )
+        nested_seconds, flat_result = best_seconds(
+            lambda: flat_tree.to_nested(counts), repeats
+        )
+        identical = json.dumps(
+            recursive_tree, cls=json_ontology_extender.NpEncoder
+        ) == json.dumps(flat_result, cls=json_ontology_extender.NpEncoder)
+        logger.info(
+            "%s: best of recursive enrichment %.1f ms, flat tree aggregation %.2f ms + nested export %.1f ms, "
+            "identical output: %s",
+            special_masst.prefix,
+            recursive_seconds * 1000,
+            aggregate_seconds * 1000,
+            nested_seconds * 1000,
+            identical,
+        )
+
+        # size of the JSON export with only matched nodes and their ancestors
+        pruned_seconds, pruned_result = best_seconds(
+            lambda: flat_tree.to_nested(counts, prune=True), repeats
+        )
+        full_size = len(json.dumps(flat_result, cls=json_ontology_extender.NpEncoder))
+        pruned_size = len(
+            json.dumps(pruned_result, cls=json_ontology_extender.NpEncoder)
+        )
+        logger.info(
+            "%s: pruned nested export %.1f ms, JSON %d kB instead of %d kB",
+            special_masst.prefix,
+            pruned_seconds * 1000,
+            pruned_size // 1000,
+            full_size // 1000,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the tree enrichment of add_data_to_node on the shipped trees"
+    )
+    parser.add_argument(
+        "--matched", type=int, help="number of matched nodes", default=300
+    )
+    parser.add_argument("--repeats", type=int, help="repeats per tree", default=5)
+    args = parser.parse_args()
+    run_benchmark(args.matched, args.repeats)
@@ -0,0 +1,278 @@
+import sys
+import json
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+from usi_utils import create_file_usi_column
+from masst_artifacts import write_atomic_files
+from prepare_sample_counts_tree import NpEncoder
+from prepare_sample_counts_tree import count_ids
+from prepare_check_metadata import sort_metadata_rows
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# optional column of the delta table, rows without action are added
+ACTION_COLUMN = "action"
+ADD = "add"
+REMOVE = "remove"
+
+
+def update_metadata_incremental(
+    metadata_file,
+    delta_file,
+    in_ontology,
+    node_key="NCBI",
+    data_key="Taxa_NCBI",
+    output_file=None,
+    out_ontology=None,
+):
+    """
+    Adds and removes the files of a delta table without rebuilding the metadata table and the tree: only the delta
+    rows are validated and deduplicated against the file_usi of the table, and only the group_size of the nodes of
+    the IDs in the delta and their ancestors is adjusted. The rows of these IDs are recounted, so that running the
+    same delta again repairs a tree that was not written. Existing rows are written unchanged, the table and tree are
+    written to temporary files and moved back to back. Use prepare_check_metadata and prepare_sample_counts_tree for
+    a full rebuild.
+    :param delta_file: table with the columns of the metadata table (or only file_usi for removed files) and an
+    optional action column (add or remove)
+    :param output_file: defaults to metadata_file
+    :param out_ontology: defaults to in_ontology
+    :return: True if the table and tree were updated
+    """
+    try:
+        metadata_df = read_table(metadata_file)
+        added_df, removed_usis, delta_ids = prepare_delta(
+            read_table(delta_file), metadata_df.columns, data_key
+        )
+        metadata_df, changed_ids = apply_delta(
+            metadata_df, added_df, removed_usis, data_key
+        )
+
+        with open(in_ontology) as json_file:
+            tree = json.load(json_file)
+        affected_ids = changed_ids | delta_ids
+        id_counts = count_ids(
+            metadata_df[metadata_df[data_key].isin(affected_ids)], data_key
+        )
+        not_in_tree = adjust_group_sizes(
+            tree,
+            {node_id: id_counts.get(node_id, 0) for node_id in affected_ids},
+            node_key,
+        )
+        not_in_tree = {node_id for node_id in not_in_tree if node_id in changed_ids}
+        if not_in_tree:
+            logger.warning("IDs not in tree: %s", ", ".join(sorted(not_in_tree)))
+
+        write_atomic_files(
+            {
+                output_file
+                or metadata_file: table_bytes(
+                    metadata_df, output_file or metadata_file
+                ),
+                # same format as prepare_sample_counts_tree.update_metadata_on_tree
+                out_ontology
+                or in_ontology: (
+                    json.dumps(tree, indent=2, cls=NpEncoder) + "\n"
+                ).encode(),
+            }
+        )
+        return True
+    except Exception as e:
+        logger.exception(e)
+        return False
+
+
+def read_table(file) -> pd.DataFrame:
+    """
+    All values are read as strings so that existing rows are written unchanged
+    """
+    sep = "\t" if str(file).endswith(".tsv") else ","
+    return pd.read_csv(file, sep=sep, dtype=str, keep_default_na=False)
+
+
+def table_bytes(df: pd.DataFrame, file) -> bytes:
+    sep = "\t" if str(file).endswith(".tsv") else ","
+    return df.to_csv(index=False, sep=sep).encode()
+
+
+def prepare_delta(delta_df: pd.DataFrame, columns, data_key="Taxa_NCBI") -> tuple:
+    """
+    Strips the values and creates the file_usi of the delta rows, added files are deduplicated as in
+    prepare_check_metadata
+    :param columns: columns of the metadata table
+    :return: (added rows with the columns of the metadata table, set of removed file_usi, set of data_key IDs of
+    all delta rows)
+    """
+    delta_df = delta_df.applymap(str.strip)
+    if ACTION_COLUMN not in delta_df.columns:
+        delta_df[ACTION_COLUMN] = ADD
+    actions = delta_df[ACTION_COLUMN].replace("", ADD).str.lower()
+    unknown = set(actions) - {ADD, REMOVE}
+    if unknown:
+        raise ValueError("Unknown actions {}".format(", ".join(sorted(unknown))))
+    if "file_usi" not in delta_df.columns:
+        create_file_usi_column(delta_df)
+    missing_usi = delta_df["file_usi"].isin(["", None])
+    if missing_usi.any():
+        logger.warning("Skipping %d delta rows without file_usi", missing_usi.sum())
+
+    removed_usis = set(delta_df.loc[(actions == REMOVE) & ~missing_usi, "file_usi"])
+    added_df = delta_df[(actions == ADD) & ~missing_usi]
+    unknown_columns = set(added_df.columns) - set(columns) - {ACTION_COLUMN}
+    if len(added_df) > 0 and unknown_columns:
+        raise ValueError(
+            "Delta columns not in the metadata table: {}".format(
+                ", ".join(sorted(unknown_columns))
+            )
+        )
+    delta_ids = set()
+    if data_key in delta_df.columns:
+        delta_ids = set(delta_df.loc[~missing_usi, data_key]) - {""}
+    added_df = added_df.reindex(columns=columns, fill_value="")
+    # keep the first of duplicated files after sorting, same as prepare_check_metadata
+    added_df = sort_metadata_rows(added_df).drop_duplicates(["file_usi"])
+    return added_df, removed_usis, delta_ids
+
+
+def apply_delta(
+    metadata_df: pd.DataFrame, added_df: pd.DataFrame, removed_usis: set, data_key
+) -> tuple:
+    """
+    Removes the removed files and adds the new files. Files that are already in the table are skipped. New rows are
+    inserted at their position in tables sorted by file_usi and appended otherwise.
+    :return: (updated table, set of data_key IDs with a changed number of rows)
+    """
+    removed = metadata_df["file_usi"].isin(removed_usis)
+    id_changes = {}
+    for node_id, count in (
+        metadata_df.loc[removed, data_key].value_counts(sort=False).items()
+    ):
+        id_changes[node_id] = id_changes.get(node_id, 0) - count
+    metadata_df = metadata_df[~removed]
+
+    existing = added_df["file_usi"].isin(metadata_df["file_usi"])
+    if existing.any():
+        logger.info(
+            "Skipping %d files that are already in the metadata", existing.sum()
+        )
+    added_df = added_df[~existing]
+    for node_id, count in added_df[data_key].value_counts(sort=False).items():
+        id_changes[node_id] = id_changes.get(node_id, 0) + count
+    logger.info("Removed %d and added %d files", removed.sum(), len(added_df))
+
+    file_usis = metadata_df["file_usi"]
+    if file_usis.is_monotonic_increasing:
+        # added_df is sorted by file_usi, each new row goes behind the existing rows before it
+        positions = np.searchsorted(
+            file_usis.to_numpy(), added_df["file_usi"].to_numpy(), side="right"
+        )
+        order = np.insert(
+            np.arange(len(metadata_df)),
+            positions,
+            len(metadata_df) + np.arange(len(added_df)),
+        )
+        metadata_df = pd.concat([metadata_df, added_df], ignore_index=True).iloc[order]
+    else:
+        metadata_df = pd.concat([metadata_df, added_df], ignore_index=True)
+    return metadata_df.reset_index(drop=True), {
+        node_id for node_id, change in id_changes.items() if change != 0
+    }
+
+
+def adjust_group_sizes(tree: dict, id_counts: dict, node_key="NCBI") -> set:
+    """
+    Sets the number of rows of each ID on its nodes: the difference to the rows that the group_size of a node
+    counts for its own ID (group_size minus the group_size of its children) is added to the node and all its
+    ancestors
+    :param id_counts: dict of ID and number of rows in the updated table
+    :return: IDs that are not in the tree
+    """
+    if "group_size" not in tree:
+        raise ValueError("The tree has no group sizes, see prepare_sample_counts_tree")
+    found = set()
+    # depth-first walk with the path from the root to the current node
+    path = []
+    stack = [(tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        del path[depth:]
+        path.append(node)
+        count = id_counts.get(node.get(node_key))
+        if count is not None:
+            found.add(node[node_key])
+            own_rows = node.get("group_size", 0) - sum(
+                child.get("group_size", 0) for child in node.get("children", [])
+            )
+            change = count - own_rows
+            if change:
+                for ancestor in path:
+                    ancestor["group_size"] = ancestor.get("group_size", 0) + change
+        stack.extend((child, depth + 1) for child in reversed(node.get("children", [])))
+    return set(id_counts) - found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Add and remove files of a delta table in a metadata table and its tree"
+    )
+    parser.add_argument(
+        "--metadata_file",
+        type=str,
+        help="masst metadata table",
+        default="../data/microbe_masst_table.csv",
+    )
+    parser.add_argument(
+        "--delta_file",
+        type=str,
+        help="new or removed files with an optional action column " "(add or remove)",
+    )
+    parser.add_argument(
+        "--ontology",
+        type=str,
+        help="the json ontology file with children and group sizes",
+        default="../data/microbe_masst_tree.json",
+    )
+    parser.add_argument(
+        "--node_key",
+        type=str,
+        help="the field in the ontology to be compare to the field in the " "data file",
+        default="NCBI",
+    )
+    parser.add_argument(
+        "--data_key",
+        type=str,
+        help="the field in the data file to be compared to the field in the "
+        "ontology",
+        default="Taxa_NCBI",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        help="output metadata table, defaults to metadata_file",
+        default=None,
+    )
+    parser.add_argument(
+        "--out_ontology",
+        type=str,
+        help="output ontology, defaults to ontology",
+        default=None,
+    )
+    args = parser.parse_args()
+
+    if not update_metadata_incremental(
+        args.metadata_file,
+        args.delta_file,
+        args.ontology,
+        args.node_key,
+        args.data_key,
+        args.output_file,
+        args.out_ontology,
+    ):
+        # exit with error
+        sys.exit(1)
+
+    # exit with OK
+    sys.exit(0)
@@ -1,9 +1,16 @@
 import json
 from pathlib import Path
-import requests
+import numpy as np
+import pandas as pd
+from utils import get_session
 
 USI_URL = "https://metabolomics-usi.gnps2.org/json/"
 
+# file USI of each dataset and file key, equal file USIs share one string
+_file_usi_cache = {}
+_file_usi_strings = {}
+MAX_CACHED_FILE_USIS = 1000000
+
 
 def create_simple_file_usi(filename, dataset):
     filename = Path(filename).stem
@@ -18,28 +25,82 @@ def ensure_simple_file_usi(usi):
     # remove scan, check only dataset and filename
     scan = str(usi).rfind(":scan")
     if scan > -1:
-        elements = usi[:scan].split(":")
+        return _file_part_usi(usi[:scan])
     else:
-        elements = usi.split(":")
+        return _file_part_usi(usi)
+
+
+def _file_part_usi(file_part):
+    elements = file_part.split(":")
     # only use filename instead of full path for matching
     filename = Path(elements[-1]).stem
     return "mzspec:{}:{}".format(elements[1], filename)
 
 
+def ensure_simple_file_usis(usis) -> np.ndarray:
+    """
+    Same as ensure_simple_file_usi for a column of USIs. Only the scans are removed per row, each distinct file is
+    converted once and cached, matches of popular compounds hit the same files many times.
+    :param usis: sequence of USIs
+    :return: object array of file USIs
+    """
+    file_parts = [
+        usi[:scan] if (scan := usi.rfind(":scan")) > -1 else usi
+        for usi in map(str, usis)
+    ]
+    codes, uniques = pd.factorize(pd.Series(file_parts, dtype=object), sort=False)
+    return _cached_file_usis(uniques, _file_part_usi)[codes]
+
+
+def create_simple_file_usis(filenames, datasets) -> np.ndarray:
+    """
+    Same as create_simple_file_usi for columns of filenames and datasets
+    :return: object array of file USIs
+    """
+    pairs = pd.MultiIndex.from_arrays(
+        [pd.Series(datasets, dtype=object), pd.Series(filenames, dtype=object)]
+    )
+    codes, uniques = pd.factorize(pairs, sort=False)
+    return _cached_file_usis(
+        uniques, lambda pair: create_simple_file_usi(pair[1], pair[0])
+    )[codes]
+
+
+def _cached_file_usis(keys, create_file_usi) -> np.ndarray:
+    """
+    :param keys: distinct dataset and file keys
+    :param create_file_usi: creates the file USI of a key that is not cached
+    :return: file USI of each key, equal file USIs share one string
+    """
+    if len(_file_usi_cache) > MAX_CACHED_FILE_USIS:
+        clear_file_usi_cache()
+    file_usis = np.empty(len(keys), dtype=object)
+    for i, key in enumerate(keys):
+        file_usi = _file_usi_cache.get(key)
+        if file_usi is None:
+            file_usi = create_file_usi(key)
+            file_usi = _file_usi_strings.setdefault(file_usi, file_usi)
+            _file_usi_cache[key] = file_usi
+        file_usis[i] = file_usi
+    return file_usis
+
+
+def clear_file_usi_cache():
+    _file_usi_cache.clear()
+    _file_usi_strings.clear()
+
+
 def create_file_usi_column(
     df, original_usi_col="USI", dataset_col="MassIVE", filename_col="Filename"
 ):
     if original_usi_col in df.columns:
-        df["file_usi"] = [ensure_simple_file_usi(usi) for usi in df[original_usi_col]]
+        df["file_usi"] = ensure_simple_file_usis(df[original_usi_col])
     else:
         if filename_col not in df.columns:
             raise ValueError("Missing Filename column")
         if dataset_col not in df.columns:
             raise ValueError("Missing MassIVE column for datasets")
-        df["file_usi"] = [
-            create_simple_file_usi(filename, dataset)
-            for filename, dataset in zip(df[filename_col], df[dataset_col])
-        ]
+        df["file_usi"] = create_simple_file_usis(df[filename_col], df[dataset_col])
 
 
 def ensure_usi(usi_or_lib_id):
@@ -60,6 +121,6 @@ def ensure_usi(usi_or_lib_id):
 
 
 def get_spectrum(usi: str):
-    resp = requests.get(USI_URL, params={"usi1": usi})
+    resp = get_session().get(USI_URL, params={"usi1": usi})
     resp.raise_for_status()
     return json.loads(resp.text)
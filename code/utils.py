@@ -1,9 +1,17 @@
 from pathlib import Path
+import threading
 import logging
+import requests
+from requests.adapters import HTTPAdapter
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# shared HTTP session for fasst and USI requests - reuses keep-alive connections across all threads
+_session = None
+_session_pool_size = 10
+_session_lock = threading.Lock()
+
 
 def prepare_paths(file=None, files=None):
     if files is not None:
@@ -17,3 +25,66 @@ def prepare_paths(file=None, files=None):
             Path(file).parent.mkdir(parents=True, exist_ok=True)
         except Exception as e:
             logger.exception(e)
+
+
+def configure_session(pool_size=10):
+    """
+    Sets the connection pool size of the shared HTTP session. Call before starting parallel queries, e.g., with the
+    number of parallel queries. An existing session is closed and recreated on next use.
+    :param pool_size: maximum number of keep-alive connections per host
+    """
+    global _session, _session_pool_size
+    with _session_lock:
+        _session_pool_size = max(1, int(pool_size))
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session() -> requests.Session:
+    """
+    Thread-safe access to the shared HTTP session. Connections are pooled per host and kept alive so that only the
+    first request to fasst.gnps2.org pays for the TCP and TLS handshake. Responses are requested gzip compressed and
+    decoded transparently by requests.
+    :return: the shared session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session(_session_pool_size)
+    return _session
+
+
+def create_async_session(pool_size=10, timeout=300):
+    """
+    Creates an aiohttp session for the asyncio batch engine. Needs to be created and closed within the running event
+    loop, e.g., async with create_async_session(100) as session. aiohttp is optional.
+    :param pool_size: maximum number of open connections
+    :return: the session or None if aiohttp is not installed
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        logger.warning(
+            "aiohttp is not installed, async queries fall back to blocking requests in worker threads"
+        )
+        return None
+
+    connector = aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=timeout),
+        headers={"Accept-Encoding": "gzip, deflate"},
+    )
+
+
+def _create_session(pool_size) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+    )
+    return session
@@ -4,6 +4,13 @@ import re
 import argparse
 import csv
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+    ds = None
+
 def merge_tsv_files_by_schema(input_directory, output_directory, pattern=r"_counts_.*\.tsv$"):
     """
     Merges TSV files by their schema (suffix) and adds a 'Feature' column.
@@ -79,6 +86,66 @@ def merge_tsv_files_by_schema(input_directory, output_directory, pattern=r"_coun
     #         csv_writer = csv.writer(csv_file, delimiter='\t')
     #         csv_writer.writerows(overview)
 
+def open_widened_dataset(directory):
+    """
+    Part files of later runs might hold widened columns (integer to float to string), see code/parquet_dataset.py.
+    Returns the dataset with the widest type of each column across all part files.
+    """
+    dataset = ds.dataset(directory, format="parquet", partitioning="hive")
+    types = {field.name: field.type for field in dataset.schema}
+    for fragment in dataset.get_fragments():
+        for field in fragment.physical_schema:
+            current = types.get(field.name)
+            if current is None or pa.types.is_null(current):
+                types[field.name] = field.type
+            elif not current.equals(field.type) and not pa.types.is_null(field.type):
+                numeric = [
+                    pa.types.is_integer(t) or pa.types.is_floating(t) for t in (current, field.type)
+                ]
+                types[field.name] = pa.float64() if all(numeric) else pa.string()
+    schema = pa.schema(list(types.items()))
+    return ds.dataset(directory, format="parquet", partitioning="hive", schema=schema)
+
+
+def merge_parquet_dataset(dataset_directory, output_directory, compounds=None):
+    """
+    Writes the same summary_counts_*.tsv files as merge_tsv_files_by_schema from the Parquet dataset of a batch run
+    (masst_batch_client.py --parquet_outputs). Each MASST is one scan over table=counts/masst=*, the compound filter
+    is pushed down to the row groups.
+
+    Parameters:
+    - dataset_directory (str): the {out_file}_parquet directory of the batch run.
+    - output_directory (str): Directory to save the summary TSV files.
+    - compounds (list): only merge these compound names, all if None.
+    """
+    if ds is None:
+        raise ImportError("Merging a Parquet dataset needs pyarrow")
+    counts_directory = os.path.join(dataset_directory, "table=counts")
+    if not os.path.isdir(counts_directory):
+        print("No counts table found in the Parquet dataset.")
+        return
+    # the Feature of the TSV files is the file name before _counts_: {out_file}_{compound}
+    out_name = os.path.basename(os.path.normpath(dataset_directory)).removesuffix("_parquet")
+
+    for masst_directory in sorted(os.listdir(counts_directory)):
+        if not masst_directory.startswith("masst="):
+            continue
+        masst = masst_directory.split("=", 1)[1]
+        # one dataset per MASST, the metadata columns differ between MASSTs
+        dataset = open_widened_dataset(os.path.join(counts_directory, masst_directory))
+        row_filter = None if compounds is None else ds.field("compound").isin(list(compounds))
+        merged_df = dataset.to_table(filter=row_filter).to_pandas()
+        if len(merged_df) == 0:
+            print(f"No rows found for MASST '{masst}'")
+            continue
+        merged_df["Feature"] = out_name + "_" + merged_df["compound"].str.replace(" ", "_")
+        merged_df = merged_df.drop(columns=["compound"])
+
+        output_file = os.path.join(output_directory, f"summary_counts_{masst}.tsv")
+        merged_df.to_csv(output_file, sep="\t", index=False)
+        print(f"Summary for MASST '{masst}' with {len(merged_df)} rows saved to: {output_file}")
+
+
 if __name__ == "__main__":
     # Command-line argument parser
     parser = argparse.ArgumentParser(
@@ -87,6 +154,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "-i", "--input", required=True, help="Directory containing TSV files."
     )
+    parser.add_argument(
+        "--parquet_dataset",
+        action="store_true",
+        help="The input is the {out_file}_parquet dataset of masst_batch_client.py --parquet_outputs.",
+    )
     parser.add_argument(
         "-o", "--output", required=True, help="Directory to save summary TSV files."
     )
@@ -96,6 +168,9 @@ if __name__ == "__main__":
     os.makedirs(args.output, exist_ok=True)
 
     # Run the TSV merging function
-    merge_tsv_files_by_schema(args.input, args.output)
+    if args.parquet_dataset:
+        merge_parquet_dataset(args.input, args.output)
+    else:
+        merge_tsv_files_by_schema(args.input, args.output)
 
 # python /workspaces/microbe_masst/pipeline/merge_tsvs.py -i /workspaces/microbe_masst/files/test_mai/out_dir -o /workspaces/microbe_masst/files/test_mai/out_dir
\ No newline at end of file
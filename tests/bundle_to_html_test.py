@@ -0,0 +1,66 @@
+import bundle_to_html
+
+
+def test_compiled_template_inserts_data(tmp_path):
+    in_html = tmp_path / "tree.html"
+    in_html.write_text(
+        "<html><head></head><body><script>"
+        'const root = DATA_PLACEHOLDER; var label = "LABEL_PLACEHOLDER"; console.log(root, label);'
+        "</script></body></html>"
+    )
+    data_file = tmp_path / "data.json"
+    data_file.write_text('{"name": "root"}')
+    replace_dict = {
+        "DATA_PLACEHOLDER": str(data_file),
+        "LABEL_PLACEHOLDER": 'a "quoted" label',
+    }
+    for compress in [False, True]:
+        out_html = tmp_path / "out_{}.html".format(compress)
+        bundle_to_html.build_dist_html(in_html, out_html, replace_dict, compress)
+        text = out_html.read_text()
+        assert '{"name": "root"}' in text
+        assert "PLACEHOLDER" not in text
+        assert 'a \\"quoted\\" label' in text or 'a "quoted" label`' in text
+
+    template = bundle_to_html.get_compiled_template(in_html, replace_dict.keys(), False)
+    assert template.placeholders == ["DATA_PLACEHOLDER", "LABEL_PLACEHOLDER"]
+    assert template.quotes == [None, '"']
+
+
+def test_shared_html_references_assets(tmp_path):
+    (tmp_path / "viewer.js").write_text(
+        'const root = DATA_PLACEHOLDER; var label = "LABEL_PLACEHOLDER";'
+    )
+    in_html = tmp_path / "tree.html"
+    in_html.write_text(
+        '<html><head></head><body><div id="tree"></div></body><script src="{}"></script></html>'.format(
+            tmp_path / "viewer.js"
+        )
+    )
+    replace_dict = {
+        "DATA_PLACEHOLDER": '{"name": "</script>"}',
+        "LABEL_PLACEHOLDER": "label",
+    }
+    for name in ["a", "b"]:
+        bundle_to_html.build_output_html(
+            in_html,
+            tmp_path / "out_{}.html".format(name),
+            replace_dict,
+            html_output="shared",
+        )
+
+    js = (tmp_path / bundle_to_html.SHARED_ASSETS_JS).read_text()
+    assert (
+        js
+        == 'const root = MASST_DATA["DATA_PLACEHOLDER"]; var label = MASST_DATA["LABEL_PLACEHOLDER"];'
+    )
+    html = (tmp_path / "out_a.html").read_text()
+    assert (
+        'var MASST_DATA={"DATA_PLACEHOLDER":{"name": "<\\/script>"},"LABEL_PLACEHOLDER":"label"};'
+        in html
+    )
+    assert '<script src="masst_viewer.js">' in html
+    assert str(tmp_path / "viewer.js") not in html
+
+    index_file = bundle_to_html.write_shared_index(tmp_path / "out")
+    assert '["out_a.html", "out_b.html"]' in index_file.read_text()
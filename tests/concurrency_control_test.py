@@ -0,0 +1,21 @@
+from concurrency_control import AdaptiveConcurrency, retry_after_seconds
+
+
+def test_additive_increase_multiplicative_decrease():
+    controller = AdaptiveConcurrency(initial=4, maximum=8)
+    for _ in range(20):
+        controller.release(controller.acquire())
+    assert controller.limit > 6
+
+    limit = controller.limit
+    controller.release(controller.acquire(), error=TimeoutError())
+    assert controller.limit == limit * 0.5
+    # errors of requests that were in flight at the same time only shrink once
+    controller.release(controller.acquire(), status=502)
+    assert controller.limit == limit * 0.5
+
+
+def test_retry_after():
+    assert retry_after_seconds({"Retry-After": "3"}) == 3
+    assert retry_after_seconds({}) is None
+    assert retry_after_seconds({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
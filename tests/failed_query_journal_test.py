@@ -0,0 +1,28 @@
+import requests
+
+from failed_query_journal import FailedQueryJournal
+from failed_query_journal import read_journal
+
+
+def test_journal_keeps_latest_failure_per_query(tmp_path):
+    journal_file = tmp_path / "out_failed_queries.jsonl"
+    journal = FailedQueryJournal(journal_file)
+    journal.close()
+    # only created on the first failure
+    assert not journal_file.exists()
+
+    journal.record(
+        "usi", "a", {"usi_or_lib_id": "a"}, requests.exceptions.ConnectionError()
+    )
+    journal.record("usi", "b", {"usi_or_lib_id": "b"}, ValueError("bad input"))
+    journal.record("usi", "a", {"usi_or_lib_id": "a"}, KeyError("results"))
+    journal.close()
+    assert journal.failed == 3
+    assert journal.error_classes == {"transient": 1, "permanent": 2}
+
+    entries = {entry["compound_name"]: entry for entry in read_journal(journal_file)}
+    assert set(entries) == {"a", "b"}
+    assert entries["a"]["error_class"] == "permanent"
+    assert entries["a"]["error"].startswith("KeyError")
+    assert entries["b"]["inputs"] == {"usi_or_lib_id": "b"}
+    assert entries["b"]["query_type"] == "usi"
@@ -0,0 +1,53 @@
+import json
+
+import fastmasst_cache
+
+
+def _spectrum_params(peaks, analog="No", delta_mass_below=130):
+    return {
+        "library": "metabolomicspanrepo_index_latest",
+        "analog": analog,
+        "delta_mass_below": delta_mass_below,
+        "delta_mass_above": 200,
+        "pm_tolerance": 0.05,
+        "fragment_tolerance": "0.02",
+        "cosine_threshold": 0.7,
+        "query_spectrum": json.dumps(
+            {
+                "n_peaks": len(peaks),
+                "peaks": peaks,
+                "precursor_mz": 183.078,
+                "precursor_charge": 1,
+            }
+        ),
+    }
+
+
+def test_cache_key_normalizes_request():
+    key = fastmasst_cache.cache_key(_spectrum_params([[80.973396, 10.0]]))
+    # rounding of peaks and the analog window without analog search do not change the key
+    assert key == fastmasst_cache.cache_key(_spectrum_params([[80.9733961, 10.01]]))
+    assert key == fastmasst_cache.cache_key(
+        _spectrum_params([[80.973396, 10.0]], delta_mass_below=50)
+    )
+    assert key != fastmasst_cache.cache_key(
+        _spectrum_params([[80.973396, 10.0]], analog="Yes")
+    )
+
+
+def test_cache_ttl_and_lru_eviction(tmp_path):
+    cache = fastmasst_cache.FastMasstCache(tmp_path / "cache.sqlite", ttl_days=1)
+    cache.put("a", b'{"results": []}')
+    assert cache.get("a") == b'{"results": []}'
+    assert cache.get("b") is None
+
+    cache.ttl_seconds = -1
+    assert cache.get("a") is None
+
+    cache.ttl_seconds = 3600
+    cache.max_size_bytes = 1000
+    for i in range(20):
+        cache.put(str(i), bytes(range(256)) * 2)
+    assert cache.get("0") is None
+    assert cache.get("19") is not None
+    cache.close()
@@ -0,0 +1,73 @@
+import json
+
+import json_ontology_extender
+import masst_registry
+import pandas as pd
+from flat_tree import FlatTree
+
+
+def _recursive_enrich(tree, matches_df):
+    tree = masst_registry.copy_tree(tree)
+    json_ontology_extender.add_data_to_node(tree, matches_df, "ID", "ID")
+    json_ontology_extender.field_missing(tree, "ID", replace_with_field="name")
+    if json_ontology_extender.field_missing(tree, "group_size") > 0:
+        json_ontology_extender.accumulate_field_in_parents(tree, "group_size")
+    if json_ontology_extender.field_missing(tree, "matched_size") > 0:
+        json_ontology_extender.accumulate_field_in_parents(tree, "matched_size")
+    json_ontology_extender.calc_stats(tree)
+    json_ontology_extender.calc_root_stats(tree)
+    json_ontology_extender.add_pie_data_to_node_and_children(tree)
+    return tree
+
+
+def test_flat_tree_enrichment_matches_recursive_passes():
+    tree = {
+        "name": "root",
+        "children": [
+            {
+                "ID": 1,
+                "children": [{"ID": 2, "group_size": 4}, {"ID": 3, "group_size": 0}],
+            },
+            {"ID": 4, "group_size": 5, "children": [{"ID": 2, "group_size": 1}]},
+        ],
+    }
+    matches_df = pd.DataFrame(
+        {
+            "ID": ["2", "4"],
+            "matched_size": [3, 1],
+            "matches_json": ['[{"USI": "a"}]', "[]"],
+        }
+    )
+    flat_tree = FlatTree(tree, "ID")
+    enriched = flat_tree.enrich(json_ontology_extender.index_rows(matches_df, "ID"))
+    assert json.dumps(enriched) == json.dumps(_recursive_enrich(tree, matches_df))
+    assert enriched["matched_size"] == 7
+    assert "matched_size" not in tree["children"][0]
+
+
+def test_pruned_tree_keeps_matched_nodes_and_ancestors():
+    tree = {
+        "name": "root",
+        "children": [
+            {
+                "ID": 1,
+                "children": [{"ID": 2, "group_size": 4}, {"ID": 3, "group_size": 2}],
+            },
+            {
+                "ID": 4,
+                "children": [{"ID": 5, "group_size": 1}, {"ID": 6, "group_size": 3}],
+            },
+        ],
+    }
+    matches_df = pd.DataFrame(
+        {"ID": ["2"], "matched_size": [3], "matches_json": ["[]"]}
+    )
+    pruned = FlatTree(tree, "ID").enrich(
+        json_ontology_extender.index_rows(matches_df, "ID"), prune=True
+    )
+    matched, stub = pruned["children"]
+    assert [child["ID"] for child in matched["children"][:1]] == [2]
+    assert matched["children"][1]["stub"] and matched["children"][1]["group_size"] == 2
+    # the unmatched subtree of ID 4 is one stub with all 3 nodes
+    assert stub["stub"] and stub["collapsed_nodes"] == 3 and stub["group_size"] == 4
+    assert pruned["group_size"] == 10 and pruned["matched_size"] == 3
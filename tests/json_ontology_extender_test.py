@@ -0,0 +1,25 @@
+import pandas as pd
+
+import json_ontology_extender
+
+
+def test_add_data_to_node_uses_first_matching_row():
+    tree = {
+        "ID": 1,
+        "children": [{"ID": 2}, {"ID": 3, "children": [{"name": "no id"}]}],
+    }
+    matches_df = pd.DataFrame(
+        {
+            "ID": ["2", "3", "3"],
+            "matched_size": [4, 1, 9],
+            "matches_json": ['[{"USI": "a"}]', "[]", "[]"],
+        }
+    )
+    json_ontology_extender.add_data_to_node(tree, matches_df, "ID", "ID")
+    assert "matched_size" not in tree
+    assert tree["children"][0] == {
+        "ID": 2,
+        "matched_size": 4,
+        "matches": [{"USI": "a"}],
+    }
+    assert tree["children"][1]["matched_size"] == 1
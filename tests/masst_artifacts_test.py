@@ -0,0 +1,84 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import masst_artifacts
+from flat_tree import FlatTree
+from masst_utils import SpecialMasst
+
+
+def test_metadata_artifact_equals_table_and_follows_changes(tmp_path):
+    metadata_file = tmp_path / "food_masst_table.csv"
+    metadata_file.write_text(
+        "file_usi,node_id,size,flag\nmzspec:A:f1,a,1.5,True\nmzspec:A:f2,,2.0,False\n"
+    )
+    special_masst = SpecialMasst(
+        "food", "food", "", str(metadata_file), "name", "node_id"
+    )
+    artifact_dir = tmp_path / "artifacts"
+    reads = []
+
+    def read_metadata():
+        reads.append(1)
+        return pd.read_csv(metadata_file).set_index("file_usi")
+
+    built = masst_artifacts.load_metadata(special_masst, read_metadata, artifact_dir)
+    loaded = masst_artifacts.load_metadata(special_masst, read_metadata, artifact_dir)
+    pd.testing.assert_frame_equal(built, loaded)
+    assert np.isnan(loaded["node_id"].iloc[1])
+    assert len(reads) == 1
+    # numeric columns are not copied from the memory maps
+    assert isinstance(loaded["size"].to_numpy().base, np.memmap)
+
+    metadata_file.write_text("file_usi,node_id,size,flag\nmzspec:A:f3,b,1.0,True\n")
+    changed = masst_artifacts.load_metadata(special_masst, read_metadata, artifact_dir)
+    assert list(changed.index) == ["mzspec:A:f3"]
+    assert len(reads) == 2
+
+
+def test_tree_artifact_is_memory_mapped(tmp_path):
+    tree = {
+        "name": "root",
+        "children": [
+            {"name": "a", "node_id": "1", "group_size": 2, "children": [{"name": "b"}]},
+            {"name": "c", "node_id": "2", "group_size": 3},
+        ],
+    }
+    tree_file = tmp_path / "food_masst_tree.json"
+    tree_file.write_text(json.dumps(tree))
+    special_masst = SpecialMasst("food", "food", str(tree_file), "", "name", "node_id")
+    artifact_dir = tmp_path / "artifacts"
+    builds = []
+
+    def build_flat_tree():
+        builds.append(1)
+        return FlatTree(tree, special_masst.tree_node_key)
+
+    built = masst_artifacts.load_flat_tree(special_masst, build_flat_tree, artifact_dir)
+    loaded = masst_artifacts.load_flat_tree(
+        special_masst, build_flat_tree, artifact_dir
+    )
+    assert len(builds) == 1
+    assert not list(artifact_dir.glob("*.pickle"))
+    for array in masst_artifacts.TREE_ARRAYS:
+        assert isinstance(getattr(loaded, array), np.memmap)
+        np.testing.assert_array_equal(getattr(loaded, array), getattr(built, array))
+    assert loaded.id_index == built.id_index
+    rows = {"2": [("matched_size", 1)]}
+    assert loaded.enrich(rows) == built.enrich(rows)
+    assert loaded.enrich(rows, prune=True) == built.enrich(rows, prune=True)
+
+
+def test_string_columns_are_not_padded(tmp_path):
+    special_masst = SpecialMasst("food", "food", "", str(tmp_path / "t.csv"), "", "")
+    df = pd.DataFrame(
+        {"file_usi": ["mzspec:A:f1", "mzspec:A:f2"], "note": ["x" * 1000, "ü"]}
+    ).set_index("file_usi")
+    artifact_dir = tmp_path / "artifacts"
+    (tmp_path / "t.csv").write_text("")
+
+    masst_artifacts.load_metadata(special_masst, lambda: df, artifact_dir)
+    loaded = masst_artifacts.load_metadata(special_masst, lambda: None, artifact_dir)
+    pd.testing.assert_frame_equal(df, loaded)
+    assert (artifact_dir / "food_metadata.1.strings.npy").stat().st_size < 1200
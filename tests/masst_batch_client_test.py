@@ -0,0 +1,55 @@
+import pytest
+import requests
+
+import masst_batch_client
+from failed_query_journal import FailedQueryJournal
+from failed_query_journal import read_journal
+
+
+def write_failed_queries(journal_file, compound_names):
+    journal = FailedQueryJournal(journal_file)
+    for name in compound_names:
+        journal.record(
+            "usi",
+            name,
+            {"usi_or_lib_id": "CCMSLIB0000000000{}".format(name)},
+            requests.exceptions.ConnectionError(),
+        )
+    journal.close()
+
+
+def test_interrupted_retry_keeps_failed_queries(tmp_path, monkeypatch):
+    out = str(tmp_path / "out")
+    journal_file = masst_batch_client.default_journal_file(out)
+    write_failed_queries(journal_file, ["1", "2", "3"])
+
+    def interrupted_run_queries(jobs, *args, journal=None, **kwargs):
+        # the first query fails again, the run crashes before the others are replayed
+        (_, _, name), _ = jobs[0]
+        journal.record(
+            "usi", name, {"usi_or_lib_id": name}, requests.exceptions.Timeout()
+        )
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(masst_batch_client, "run_queries", interrupted_run_queries)
+    with pytest.raises(KeyboardInterrupt):
+        masst_batch_client.retry_failed_queries(out, html_output="none")
+    assert {entry["compound_name"] for entry in read_journal(journal_file)} == {
+        "1",
+        "2",
+        "3",
+    }
+
+    def run_queries(jobs, *args, journal=None, **kwargs):
+        (_, _, name), _ = jobs[0]
+        journal.record(
+            "usi", name, {"usi_or_lib_id": name}, requests.exceptions.Timeout()
+        )
+        return [False] + [True] * (len(jobs) - 1)
+
+    monkeypatch.setattr(masst_batch_client, "run_queries", run_queries)
+    assert masst_batch_client.retry_failed_queries(out, html_output="none") == 2 / 3
+    # the finished replay replaces the journal with the queries that failed again
+    entries = read_journal(journal_file)
+    assert [entry["compound_name"] for entry in entries] == ["1"]
+    assert entries[0]["error"].startswith("Timeout")
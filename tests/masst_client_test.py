@@ -0,0 +1,166 @@
+from pathlib import Path
+
+import masst_client
+import masst_utils
+from query_deduplication import QueryDeduplicator
+from query_deduplication import count_keys
+from failed_query_journal import FailedQueryJournal
+from run_manifest import RunManifest
+
+
+def test_library_search_if_needed(monkeypatch):
+    requests = []
+
+    def fast_masst_params(params):
+        requests.append(params["library"])
+        return {"results": [] if params["library"] == "empty" else [{"USI": "x"}]}
+
+    monkeypatch.setattr(masst_utils, "fast_masst_params", fast_masst_params)
+
+    matches, library_matches = masst_client.search_masst(
+        {"library": "datasets"}, {"library": "gnpslibrary"}
+    )
+    assert library_matches == {"results": [{"USI": "x"}]}
+    assert sorted(requests) == ["datasets", "gnpslibrary"]
+
+    # no library search without dataset matches
+    for library_search in ["after_matches", "if_needed"]:
+        requests.clear()
+        matches, library_matches = masst_client.search_masst(
+            {"library": "empty"}, {"library": "gnpslibrary"}, library_search
+        )
+        assert requests == ["empty"]
+        assert library_matches == {"results": []}
+
+    # the concurrent library search is always sent
+    requests.clear()
+    masst_client.search_masst(
+        {"library": "empty"}, {"library": "gnpslibrary"}, "always"
+    )
+    assert sorted(requests) == ["empty", "gnpslibrary"]
+
+    # no library search for known library IDs
+    _, library_params = masst_client.usi_search_params(
+        "CCMSLIB00005883950", library_search="if_needed"
+    )
+    assert library_params is None
+
+
+def test_skipped_library_searches_release_their_key(monkeypatch):
+    usi = "mzspec:MSV000084900:15NAVY01_V1_ALL_GB2_01_39810.mzXML:scan:1"
+    args = ("out", usi, "a", 0.05, 0.02, 0.7, 4, True, 100, 200)
+    # positional arguments match query_usi_or_id
+    assert masst_client.usi_query_keys(*args) == masst_client.usi_query_keys(
+        "out",
+        usi,
+        "a",
+        precursor_mz_tol=0.05,
+        mz_tol=0.02,
+        min_cos=0.7,
+        min_matched_signals=4,
+        analog=True,
+        analog_mass_below=100,
+        analog_mass_above=200,
+    )
+    params, library_params = masst_client.usi_search_params(
+        usi, 0.05, 0.02, 0.7, True, 100, 200
+    )
+    keys = masst_client.usi_query_keys(*args) * 2
+    assert keys[1] == masst_utils.query_key(library_params)
+
+    deduplicator = QueryDeduplicator(count_keys(keys))
+    monkeypatch.setattr(masst_utils, "_deduplicator", deduplicator)
+    monkeypatch.setattr(
+        masst_utils, "fast_masst_params", lambda params: {"results": []}
+    )
+    for _ in range(2):
+        masst_client.search_masst(params, library_params)
+    # both library searches were skipped, no expected query is left
+    assert deduplicator.remaining[keys[1]] == 0
+
+
+def test_worker_results_are_replayed_in_parent(tmp_path, monkeypatch):
+    # the SpecialMasst files are relative to the repository root, spawned workers inherit the working directory
+    monkeypatch.chdir(Path(__file__).resolve().parents[1])
+    usi = "mzspec:MSV000084900:15NAVY01_V1_ALL_GB2_01_39810.mzXML:scan:1"
+    matches = {
+        "results": [
+            {
+                "Delta Mass": 0.0,
+                "USI": usi,
+                "Charge": 1,
+                "Cosine": 0.9,
+                "Matching Peaks": 5,
+                "Dataset": "MSV000084900",
+                "Status": "NA",
+            }
+        ],
+        "grouped_by_dataset": [{"Dataset": "MSV000084900", "Frequency": 1}],
+    }
+    args = masst_client.usi_process_args(
+        str(tmp_path / "out"),
+        usi,
+        "a",
+        matches,
+        {"results": []},
+        0.05,
+        0.02,
+        0.7,
+        3,
+        False,
+        130,
+        200,
+    )
+
+    class Store:
+        def __init__(self):
+            self.calls = []
+
+        def add_spectrum(self, compound_name, input_label, params_label, usi=None):
+            self.calls.append(("spectrum", compound_name))
+
+        def add(self, table, compound_name, df, masst=None):
+            self.calls.append((table, compound_name, masst, len(df)))
+
+    store = Store()
+    executor = masst_client.create_post_executor("processes", 1)
+    try:
+        # process_matches runs in a spawned worker, its rows are pickled and replayed to the store of this process
+        artifacts = masst_client.run_process_matches(
+            executor, args, results_store=store, massts="food", html_output="none"
+        )
+    finally:
+        executor.shutdown()
+    assert artifacts["matches"] == "written"
+    assert artifacts["results_store"] == "written"
+    assert (tmp_path / "out_a_matches.tsv").is_file()
+    assert ("matches", "a", None, 1) in store.calls
+    assert any(call[0] == "nodes" and call[2] == "food" for call in store.calls)
+    # the spectrum row is replayed last
+    assert store.calls[-1] == ("spectrum", "a")
+    assert masst_client.create_post_executor("threads") is None
+
+
+def test_spectra_with_too_few_signals_are_not_journaled(monkeypatch, tmp_path):
+    def fast_masst_params(params):
+        raise AssertionError("spectra with too few signals are not queried")
+
+    monkeypatch.setattr(masst_utils, "fast_masst_params", fast_masst_params)
+    journal = FailedQueryJournal(tmp_path / "out_failed_queries.jsonl")
+    manifest = RunManifest(tmp_path / "out_manifest.jsonl", {})
+
+    success = masst_client.query_spectrum(
+        str(tmp_path / "out"),
+        "a",
+        200.0,
+        1,
+        [100.0],
+        [1.0],
+        journal=journal,
+        manifest=manifest,
+    )
+    journal.close()
+    manifest.close()
+    assert not success
+    assert journal.failed == 0
+    assert manifest.entries["a"]["artifacts"] == masst_client.NOT_QUERYABLE_ARTIFACTS
@@ -0,0 +1,36 @@
+import masst_registry
+
+
+def test_copy_tree_keeps_template_unchanged():
+    template = {
+        "name": "root",
+        "children": [{"name": "a", "children": []}, {"name": "b"}],
+    }
+    tree = masst_registry.copy_tree(template)
+    tree["group_size"] = 3
+    tree["children"][0]["matched_size"] = 1
+    tree["children"][0]["children"].append({"name": "c"})
+    assert template == {
+        "name": "root",
+        "children": [{"name": "a", "children": []}, {"name": "b"}],
+    }
+
+
+def test_files_are_loaded_once(tmp_path, monkeypatch):
+    tree_file = tmp_path / "tree.json"
+    tree_file.write_text('{"name": "root"}')
+    loads = []
+    read_tree = masst_registry.read_tree
+    monkeypatch.setattr(
+        masst_registry, "read_tree", lambda file: loads.append(file) or read_tree(file)
+    )
+
+    class Masst:
+        pass
+
+    special_masst = Masst()
+    special_masst.tree_file = tree_file
+    assert masst_registry.get_tree_template(special_masst) == {"name": "root"}
+    assert masst_registry.get_tree_template(special_masst) == {"name": "root"}
+    assert len(loads) == 1
+    masst_registry.clear()
@@ -0,0 +1,30 @@
+import pandas as pd
+
+import masst_tree
+import masst_utils
+
+
+def test_group_matches_with_shared_records_equals_group_json():
+    matches_df = pd.DataFrame(
+        {
+            "node_id": ["b", "a", "b", "c", "a"],
+            "USI": ["mzspec:MSV1:f{}.mzML:scan:1".format(i) for i in range(5)],
+            "Cosine": [0.9, 0.75, 0.8123, 0.7, 1.0],
+            "Matching Peaks": [5, 3, 4, 6, 10],
+        }
+    )
+    grouped_df = masst_tree.group_matches(masst_utils.FOOD_MASST, matches_df)
+    records = masst_tree.match_json_records(matches_df)
+    shared_df = masst_tree.group_matches(
+        masst_utils.FOOD_MASST, matches_df.iloc[[0, 2, 3]], records[[0, 2, 3]]
+    )
+
+    grouped = matches_df.groupby("node_id")
+    assert list(grouped_df["node_id"]) == ["a", "b", "c"]
+    assert list(grouped_df["matched_size"]) == [2, 2, 1]
+    assert list(grouped_df["matches_json"]) == [
+        df[["USI", "Cosine", "Matching Peaks"]].to_json(orient="records")
+        for _, df in grouped
+    ]
+    assert list(shared_df["node_id"]) == ["b", "c"]
+    assert list(shared_df["matches_json"]) == list(grouped_df["matches_json"][1:])
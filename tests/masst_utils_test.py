@@ -0,0 +1,130 @@
+import json
+import pytest
+import requests
+
+import masst_utils
+
+
+def test_selected_match_columns_equal_full_frame():
+    results = [
+        {
+            "Delta Mass": 0.001 * i,
+            "USI": "mzspec:MSV1:f{}.mzML:scan:{}".format(i % 3, i),
+            "Charge": 1,
+            "Cosine": 0.5 + i / 20,
+            "Matching Peaks": 3 + i,
+            **{col: 0 for col in masst_utils.UNUSED_RESULT_COLUMNS},
+            "Dataset": "MSV1",
+            "Status": "NA",
+            "mzs": [1.0, 2.0],
+            "intensities": [3.0, 4.0],
+        }
+        for i in range(6)
+    ]
+    content = json.dumps({"results": results, "grouped_by_dataset": []}).encode()
+    results_dict = masst_utils.decode_response(content)
+    assert results_dict == json.loads(content)
+
+    args = (results_dict, 0.05, 4, False, True)
+    full_df = masst_utils.extract_matches_from_masst_results(*args)
+    selected_df = masst_utils.extract_matches_from_masst_results(
+        *args, columns=masst_utils.MATCH_RESULT_COLUMNS
+    )
+    assert list(selected_df.columns) == masst_utils.MATCH_RESULT_COLUMNS + ["file_usi"]
+    assert selected_df.equals(full_df[selected_df.columns])
+    assert (
+        len(
+            masst_utils.extract_matches_from_masst_results(
+                {"results": []},
+                0.05,
+                4,
+                False,
+                True,
+                columns=masst_utils.MATCH_RESULT_COLUMNS,
+            )
+        )
+        == 0
+    )
+    # json accepts NaN values
+    assert masst_utils.decode_response(b'{"Cosine": NaN}')["Cosine"] != 0
+
+
+def test_select_special_massts_keeps_order():
+    assert masst_utils.select_special_massts() == [masst_utils.MICROBE_MASST]
+    assert masst_utils.select_special_massts("microbiome, food") == [
+        masst_utils.FOOD_MASST,
+        masst_utils.MICROBIOME_MASST,
+    ]
+    assert masst_utils.select_special_massts("all") == masst_utils.SPECIAL_MASSTS
+    with pytest.raises(ValueError):
+        masst_utils.select_special_massts("microbe,fungi")
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(response=response)
+
+
+def test_error_class():
+    assert masst_utils.error_class(masst_utils.EmptyResponseError()) == "transient"
+    assert masst_utils.error_class(requests.exceptions.ConnectionError()) == "transient"
+    assert masst_utils.error_class(requests.exceptions.ReadTimeout()) == "transient"
+    assert masst_utils.error_class(http_error(503)) == "transient"
+    assert masst_utils.error_class(http_error(429)) == "transient"
+    assert masst_utils.error_class(http_error(400)) == "permanent"
+    assert masst_utils.error_class(ValueError("bad input")) == "permanent"
+
+
+def test_retry_delay(monkeypatch):
+    monkeypatch.setattr(masst_utils, "_max_retries", 3)
+    monkeypatch.setattr(masst_utils, "_retry_base_delay", 2.0)
+    monkeypatch.setattr(masst_utils, "_retry_max_delay", 10.0)
+    error = requests.exceptions.ConnectionError()
+    for attempt in range(3):
+        assert (
+            0
+            <= masst_utils.retry_delay(error, attempt)
+            <= min(10.0, 2.0 * 2**attempt)
+        )
+    assert masst_utils.retry_delay(error, 3) is None
+    assert masst_utils.retry_delay(http_error(400), 0) is None
+    # Retry-After is respected up to the maximum delay
+    assert masst_utils.retry_delay(http_error(503, {"Retry-After": "5"}), 0) == 5.0
+    assert masst_utils.retry_delay(http_error(503, {"Retry-After": "60"}), 0) == 10.0
+
+
+def test_empty_responses_are_retried(monkeypatch):
+    monkeypatch.setattr(masst_utils, "_max_retries", 3)
+    monkeypatch.setattr(masst_utils, "_retry_base_delay", 0.0)
+    responses = [
+        requests.exceptions.ConnectionError(),
+        b"{}",
+        b'{"results": [], "grouped_by_dataset": []}',
+    ]
+
+    def post_fast_masst(params):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(masst_utils, "_post_fast_masst", post_fast_masst)
+    assert masst_utils.fast_masst_params({"library": "x"}) == {
+        "results": [],
+        "grouped_by_dataset": [],
+    }
+    assert responses == []
+
+    # gives up after all retries with the transient error
+    responses.extend([b"{}"] * 4)
+    with pytest.raises(masst_utils.EmptyResponseError):
+        masst_utils.fast_masst_params({"library": "x"})
+    assert responses == []
+
+    # permanent errors are not retried
+    responses.extend([http_error(400), b"{}"])
+    with pytest.raises(requests.exceptions.HTTPError):
+        masst_utils.fast_masst_params({"library": "x"})
+    assert len(responses) == 1
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+
+import metadata_index
+from masst_utils import SpecialMasst
+
+
+def special_masst(tmp_path, prefix, file_usis):
+    metadata_file = tmp_path / "{}_masst_table.csv".format(prefix)
+    rows = ["{},{}\n".format(usi, i) for i, usi in enumerate(file_usis)]
+    metadata_file.write_text("file_usi,node_id\n" + "".join(rows))
+    return SpecialMasst(prefix, prefix, "", str(metadata_file), "name", "node_id")
+
+
+def test_lookup_returns_all_assignments_in_match_order(tmp_path):
+    special_massts = [
+        special_masst(tmp_path, "food", ["mzspec:A:f1", "mzspec:A:f2", "mzspec:A:f1"]),
+        special_masst(tmp_path, "microbe", ["mzspec:A:f3", "mzspec:A:f1"]),
+        SpecialMasst(
+            "plant", "plant", "", str(tmp_path / "missing.csv"), "name", "node_id"
+        ),
+    ]
+    index = metadata_index.build_metadata_index(special_massts)
+    assert index.prefixes == ["food", "microbe"]
+    assert index.masst_code(special_massts[2]) is None
+
+    match_rows, massts, rows = index.lookup(
+        ["mzspec:A:f9", "mzspec:A:f1", "mzspec:A:f3"]
+    )
+    assert match_rows.tolist() == [1, 1, 1, 2]
+    assert massts.tolist() == [0, 0, 1, 1]
+    assert rows.tolist() == [0, 2, 1, 0]
+
+    metadata_index.write_metadata_index(index, tmp_path / "index", special_massts)
+    loaded = metadata_index.load_metadata_index(tmp_path / "index", special_massts)
+    assert isinstance(loaded.keys, np.memmap)
+    assert [a.tolist() for a in loaded.lookup(["mzspec:A:f1"])] == [
+        [0, 0, 0],
+        [0, 0, 1],
+        [0, 2, 1],
+    ]
+
+    # a touched file with the same content keeps the index, changed content rebuilds it
+    os.utime(special_massts[0].metadata_file, ns=(0, 0))
+    assert (
+        metadata_index.load_metadata_index(tmp_path / "index", special_massts)
+        is not None
+    )
+    with open(special_massts[0].metadata_file, "a") as f:
+        f.write("mzspec:A:f4,3\n")
+    assert (
+        metadata_index.load_metadata_index(tmp_path / "index", special_massts) is None
+    )
@@ -0,0 +1,100 @@
+import pytest
+import pandas as pd
+
+try:
+    import pyarrow.dataset as ds
+except ImportError:
+    pytest.skip("the Parquet dataset needs pyarrow", allow_module_level=True)
+
+from parquet_dataset import ParquetDataset
+from parquet_dataset import read_dataset
+from parquet_dataset import list_massts
+
+
+def test_parquet_dataset_partitions_and_appends(tmp_path):
+    dataset_dir = tmp_path / "out_parquet"
+    dataset = ParquetDataset(dataset_dir, row_group_size=10)
+    dataset.add(
+        "counts",
+        "a",
+        pd.DataFrame({"file_usi": ["f1", "f2"], "ncbi": [1, 2]}),
+        masst="microbe",
+    )
+    dataset.add(
+        "counts",
+        "b",
+        pd.DataFrame({"file_usi": ["f3"], "ncbi": [None]}),
+        masst="microbe",
+    )
+    dataset.add(
+        "counts", "a", pd.DataFrame({"file_usi": ["f1"], "Sample": ["x"]}), masst="food"
+    )
+    dataset.add("matches", "a", pd.DataFrame({"USI": ["u1"], "Cosine": [0.9]}))
+    dataset.add_spectrum("a", "input", "params")
+    dataset.add_spectrum("b", "input", "params")
+    # unfinished files are hidden from readers
+    assert len(read_dataset(dataset_dir, "counts", "microbe")) == 0
+    dataset.close()
+
+    # a resumed run adds a new part file and skips compounds that were already written
+    dataset = ParquetDataset(dataset_dir)
+    assert dataset.has_compound("a")
+    assert not dataset.has_compound("c")
+    dataset.add(
+        "counts", "c", pd.DataFrame({"file_usi": ["f4"], "ncbi": [4]}), masst="microbe"
+    )
+    dataset.add_spectrum("c", "input", "params")
+    dataset.add(
+        "counts", "a", pd.DataFrame({"file_usi": ["f1"], "ncbi": [1]}), masst="microbe"
+    )
+    dataset.add_spectrum("a", "input", "params")
+    dataset.close()
+
+    assert list_massts(dataset_dir, "counts") == ["food", "microbe"]
+    microbe_df = read_dataset(dataset_dir, "counts", "microbe").sort_values("file_usi")
+    assert list(microbe_df["compound"]) == ["a", "a", "b", "c"]
+    assert microbe_df["ncbi"].isna().tolist() == [False, False, True, False]
+    assert set(microbe_df["masst"]) == {"microbe"}
+    compound_df = read_dataset(
+        dataset_dir, "counts", "microbe", filter=ds.field("compound") == "a"
+    )
+    assert len(compound_df) == 2
+    assert list(read_dataset(dataset_dir, "matches")["USI"]) == ["u1"]
+    assert sorted(read_dataset(dataset_dir, "spectrum")["compound"]) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("row_group_size", [1, 100])
+def test_parquet_dataset_widens_columns(tmp_path, row_group_size):
+    # values that do not fit the first spectrum are widened within a part file and across part files
+    dataset_dir = tmp_path / "out_parquet"
+    dataset = ParquetDataset(dataset_dir, row_group_size=row_group_size)
+    for compound, ncbi in [("a", 1), ("b", 1.5), ("c", "562")]:
+        dataset.add("counts", compound, pd.DataFrame({"ncbi": [ncbi]}), masst="microbe")
+        dataset.add_spectrum(compound, "input", "params")
+    dataset.add(
+        "counts", "d", pd.DataFrame({"ncbi": [2], "Sample": ["x"]}), masst="microbe"
+    )
+    dataset.add_spectrum("d", "input", "params")
+    dataset.close()
+
+    counts_df = read_dataset(dataset_dir, "counts", "microbe").sort_values("compound")
+    assert [float(value) for value in counts_df["ncbi"][:3]] == [1, 1.5, 562]
+    assert counts_df["Sample"].isna().tolist() == [True, True, True, False]
+
+
+def test_parquet_dataset_keeps_flushed_spectra_after_crash(tmp_path):
+    dataset_dir = tmp_path / "out_parquet"
+    dataset = ParquetDataset(dataset_dir, row_group_size=1)
+    dataset.add("matches", "a", pd.DataFrame({"USI": ["u1"]}))
+    dataset.add_spectrum("a", "input", "params")
+    # crash before the spectrum row of b, the dataset is never closed
+    dataset.add("matches", "b", pd.DataFrame({"USI": ["u2"]}))
+
+    assert list(read_dataset(dataset_dir, "matches")["compound"]) == ["a"]
+    dataset = ParquetDataset(dataset_dir, row_group_size=1)
+    assert dataset.has_compound("a")
+    assert not dataset.has_compound("b")
+    dataset.add("matches", "b", pd.DataFrame({"USI": ["u2"]}))
+    dataset.add_spectrum("b", "input", "params")
+    dataset.close()
+    assert sorted(read_dataset(dataset_dir, "matches")["compound"]) == ["a", "b"]
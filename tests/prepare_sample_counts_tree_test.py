@@ -0,0 +1,22 @@
+import pandas as pd
+
+import prepare_sample_counts_tree
+
+
+def test_group_size_sums_rows_of_subtree():
+    tree = {
+        "NCBI": "1",
+        "children": [
+            {"NCBI": "2", "children": [{"NCBI": "4"}, {"NCBI": "5"}]},
+            {"NCBI": "3", "children": []},
+        ],
+    }
+    df = pd.DataFrame({"Taxa_NCBI": ["2", "4", "4", "5", "3", "9", "1"]})
+    assert prepare_sample_counts_tree.update_group_size(tree, df) == 6
+    assert tree["children"][0]["group_size"] == 4
+    assert tree["children"][0]["children"][0]["group_size"] == 2
+    assert tree["children"][1]["group_size"] == 1
+
+    id_counts = prepare_sample_counts_tree.count_ids(df)
+    ids = prepare_sample_counts_tree.get_id_set(tree)
+    assert set(id_counts).difference(ids) == {"9"}
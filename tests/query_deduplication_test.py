@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from query_deduplication import QueryDeduplicator
+from query_deduplication import count_keys
+
+
+def test_duplicate_queries_share_one_request():
+    deduplicator = QueryDeduplicator(count_keys(["a", "a", "a", "b", None]))
+    assert deduplicator.tracks("a")
+    assert not deduplicator.tracks("b")
+
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return b"response"
+
+    with ThreadPoolExecutor(2) as executor:
+        # the second query waits for the request in flight
+        futures = [executor.submit(deduplicator.fetch, "a", fetch) for _ in range(2)]
+        release.set()
+        assert [f.result() for f in futures] == [b"response", b"response"]
+    # the last query reuses the finished response, which is then released
+    assert deduplicator.fetch("a", fetch) == b"response"
+    assert len(calls) == 1
+    assert deduplicator.saved == 2
+    assert len(deduplicator._responses) == 0
+
+
+def test_streamed_queries_share_recent_responses():
+    # without expected counts all keys are tracked and the most recent responses are kept
+    deduplicator = QueryDeduplicator(max_entries=1)
+    assert deduplicator.tracks("a")
+
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return b"response"
+
+    assert deduplicator.fetch("a", fetch) == b"response"
+    assert deduplicator.fetch("a", fetch) == b"response"
+    assert len(calls) == 1
+    # evicted keys are requested again
+    deduplicator.fetch("b", fetch)
+    deduplicator.fetch("a", fetch)
+    assert len(calls) == 3
+    assert deduplicator.saved == 1
+
+
+def test_released_queries_drop_their_response():
+    deduplicator = QueryDeduplicator(count_keys(["a", "a", "a"]))
+    assert deduplicator.fetch("a", lambda: b"response") == b"response"
+    # a query that skips its request releases the expected reuse
+    deduplicator.release("a")
+    assert len(deduplicator._responses) == 1
+    deduplicator.release("a")
+    assert len(deduplicator._responses) == 0
@@ -0,0 +1,70 @@
+import pytest
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pytest.skip("the results store needs pyarrow", allow_module_level=True)
+
+from results_store import ResultsStore
+from results_store import read_results
+
+
+def test_results_store_keeps_rows_on_resume(tmp_path):
+    results_file = tmp_path / "out_results.parquet"
+    store = ResultsStore(results_file, row_group_size=2)
+    store.add(
+        "matches",
+        "a",
+        pd.DataFrame({"USI": ["u1", "u2"], "Cosine": [0.9, 0.8], "Extra": [1, 2]}),
+    )
+    store.add(
+        "nodes",
+        "a",
+        pd.DataFrame({"node_index": [0, 3], "matched_size": [2, 1]}),
+        masst="food",
+    )
+    store.add_spectrum("a", "input", "params", "mzspec:X")
+    store.close()
+
+    store = ResultsStore(results_file, resume=True)
+    assert store.has_compound("a")
+    store.add("matches", "b", pd.DataFrame({"USI": ["u3"], "Matching Peaks": [4]}))
+    store.add_spectrum("b", "input", "params")
+    store.close()
+
+    matches_df = read_results(
+        results_file, "matches", columns=["compound", "USI", "Cosine"]
+    )
+    assert list(matches_df["compound"]) == ["a", "a", "b"]
+    assert matches_df["Cosine"].isna().tolist() == [False, False, True]
+    nodes_df = read_results(results_file, "nodes")
+    assert list(nodes_df["masst"]) == ["food", "food"]
+    assert list(nodes_df["node_index"]) == [0, 3]
+    assert not (tmp_path / "out_results.parquet.tmp").exists()
+    assert not (tmp_path / "out_results.parquet.parts").exists()
+
+    # a new run replaces the results
+    ResultsStore(results_file).close()
+    assert len(read_results(results_file)) == 0
+
+
+def test_results_store_recovers_written_row_groups_after_crash(tmp_path):
+    results_file = tmp_path / "out_results.parquet"
+    store = ResultsStore(results_file, row_group_size=1)
+    store.add("matches", "a", pd.DataFrame({"USI": ["u1"]}))
+    store.add_spectrum("a", "input", "params")
+    store.add("matches", "b", pd.DataFrame({"USI": ["u2"]}))
+    store.add_spectrum("b", "input", "params")
+    # crash before the spectrum row of c, the store is never closed
+    store.add("matches", "c", pd.DataFrame({"USI": ["u3"]}))
+
+    store = ResultsStore(results_file, resume=True)
+    assert store.has_compound("a") and store.has_compound("b")
+    # spectra without rows in the store run again
+    assert not store.has_compound("c")
+    store.add("matches", "c", pd.DataFrame({"USI": ["u3"]}))
+    store.add_spectrum("c", "input", "params")
+    store.close()
+    matches_df = read_results(results_file, "matches")
+    assert list(matches_df["compound"]) == ["a", "b", "c"]
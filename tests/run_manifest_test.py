@@ -0,0 +1,30 @@
+from run_manifest import RunManifest
+from run_manifest import hash_inputs
+
+
+def test_manifest_resumes_completed_queries(tmp_path):
+    manifest_file = tmp_path / "out_manifest.jsonl"
+    params = {"min_cos": 0.7}
+    manifest = RunManifest(manifest_file, params)
+    started = manifest.start("a", hash_inputs({"usi": "a"}))
+    manifest.complete("a", hash_inputs({"usi": "a"}), started, {"matches": "written"})
+    manifest.start("b", hash_inputs({"usi": "b"}))
+    manifest.close()
+    # truncated line after a crash
+    with open(manifest_file, "a") as file:
+        file.write('{"compound_name": "c", "sta')
+
+    resumed = RunManifest(manifest_file, params)
+    # the first entry after the truncated line is kept
+    resumed.start("d", hash_inputs({"usi": "d"}))
+    resumed.close()
+
+    resumed = RunManifest(manifest_file, params)
+    assert resumed.entries["d"]["state"] == "started"
+    assert resumed.is_completed("a", hash_inputs({"usi": "a"}))
+    assert resumed.artifacts("a") == {"matches": "written"}
+    assert not resumed.is_completed("a", hash_inputs({"usi": "changed"}))
+    assert not resumed.is_completed("b", hash_inputs({"usi": "b"}))
+    assert not RunManifest(manifest_file, {"min_cos": 0.8}).is_completed(
+        "a", hash_inputs({"usi": "a"})
+    )
@@ -0,0 +1,74 @@
+import json
+
+import pandas as pd
+
+import prepare_sample_counts_tree
+import update_metadata_incremental
+
+
+def test_delta_matches_full_recount(tmp_path):
+    tree = {
+        "NCBI": "1",
+        "children": [{"NCBI": "2", "children": [{"NCBI": "3"}]}, {"NCBI": "4"}],
+    }
+    table = pd.DataFrame(
+        {
+            "file_usi": ["mzspec:A:a", "mzspec:A:c", "mzspec:A:e"],
+            "Taxa_NCBI": ["3", "4", "2"],
+            "note": ["x", "", "1.50"],
+        }
+    )
+    prepare_sample_counts_tree.update_group_size(tree, table)
+    (tmp_path / "tree.json").write_text(json.dumps(tree))
+    table.to_csv(tmp_path / "table.csv", index=False)
+    pd.DataFrame(
+        {
+            "file_usi": ["mzspec:A:c", " mzspec:A:b ", "mzspec:A:d", "mzspec:A:a"],
+            "Taxa_NCBI": ["", "3", "9", "4"],
+            "action": ["remove", "add", "", "add"],
+        }
+    ).to_csv(tmp_path / "delta.csv", index=False)
+
+    assert update_metadata_incremental.update_metadata_incremental(
+        tmp_path / "table.csv", tmp_path / "delta.csv", tmp_path / "tree.json"
+    )
+    updated = pd.read_csv(tmp_path / "table.csv", dtype=str, keep_default_na=False)
+    # sorted table stays sorted, existing rows keep their values, mzspec:A:a is not added twice
+    assert list(updated["file_usi"]) == [
+        "mzspec:A:a",
+        "mzspec:A:b",
+        "mzspec:A:d",
+        "mzspec:A:e",
+    ]
+    assert list(updated["note"]) == ["x", "", "", "1.50"]
+
+    expected = {
+        "NCBI": "1",
+        "children": [{"NCBI": "2", "children": [{"NCBI": "3"}]}, {"NCBI": "4"}],
+    }
+    prepare_sample_counts_tree.update_group_size(expected, updated)
+    assert json.loads((tmp_path / "tree.json").read_text()) == json.loads(
+        json.dumps(expected, cls=prepare_sample_counts_tree.NpEncoder)
+    )
+
+
+def test_rerun_repairs_tree_after_crash(tmp_path):
+    tree = {"NCBI": "1", "children": [{"NCBI": "2"}, {"NCBI": "3"}]}
+    table = pd.DataFrame({"file_usi": ["mzspec:A:a"], "Taxa_NCBI": ["2"]})
+    prepare_sample_counts_tree.update_group_size(tree, table)
+    (tmp_path / "tree.json").write_text(json.dumps(tree))
+    pd.DataFrame(
+        {"file_usi": ["mzspec:A:b", "mzspec:A:c"], "Taxa_NCBI": ["3", "3"]}
+    ).to_csv(tmp_path / "delta.csv", index=False)
+    # crash after the table was updated, before the tree was written
+    pd.concat([table, pd.read_csv(tmp_path / "delta.csv", dtype=str)]).to_csv(
+        tmp_path / "table.csv", index=False
+    )
+
+    assert update_metadata_incremental.update_metadata_incremental(
+        tmp_path / "table.csv", tmp_path / "delta.csv", tmp_path / "tree.json"
+    )
+    updated_tree = json.loads((tmp_path / "tree.json").read_text())
+    assert updated_tree["group_size"] == 3
+    assert [child["group_size"] for child in updated_tree["children"]] == [1, 2]
+    assert len(pd.read_csv(tmp_path / "table.csv")) == 3
@@ -0,0 +1,24 @@
+import pandas as pd
+
+import usi_utils
+
+
+def test_file_usi_columns_match_single_values():
+    usis = [
+        "mzspec:MSV1:peak/sample/a.mzML:scan:5",
+        "mzspec:MSV1:peak/sample/a.mzML:scan:6",
+        "mzspec:MSV1:a.mzML",
+        "mzspec:MSV2:f.tar.gz:scan:1:scan:2",
+        "mzspec:MSV2:.hidden:scan:1",
+        "mzspec:MSV2:dir/./:scan:1",
+        "mzspec:MSV2:a.b",
+    ]
+    # a cached file USI must not be mistaken for a file of another row
+    usi_utils.ensure_simple_file_usis(["mzspec:MSV2:a.b.c"])
+    file_usis = usi_utils.ensure_simple_file_usis(pd.Series(usis))
+    assert list(file_usis) == [usi_utils.ensure_simple_file_usi(usi) for usi in usis]
+    assert file_usis[0] is file_usis[1]
+
+    df = pd.DataFrame({"Filename": ["x/b.mzXML", "c.raw"], "MassIVE": ["MSV3", "MSV4"]})
+    usi_utils.create_file_usi_column(df)
+    assert list(df["file_usi"]) == ["mzspec:MSV3:b", "mzspec:MSV4:c"]